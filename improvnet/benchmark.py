@@ -0,0 +1,536 @@
+import yaml
+import pickle
+import os
+import glob
+import time
+import random
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import argparse
+import numpy as np
+import pretty_midi
+import torch
+from torch.cuda import is_available as cuda_available
+from ariautils.midi import MidiDict
+from ariautils.tokenizer import AbsTokenizer
+
+from corruptions import DataCorruption, SegmentStore
+from codec import TokenCodec
+from generation import generate, refine_sequence_batch, get_novel_note_numbers
+from inference import get_cpu_split, load_fusion_model
+from decoding import DECODING_STATS, reset_decoding_stats
+from scheduler import JobScheduler, longest_first
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+from utils.tokens import flatten
+from utils.novelty import hash_file
+from utils.import_check import IMPORT_BUDGET_MS, measure_token_helper_import
+
+
+def get_corrupted_segments(midi_file_path, convert_to, context_before, context_after, corruption_type, n_segments):
+    """
+    Build the corrupted encoder inputs for the first n_segments T-segments of a piece.
+    """
+    mid = MidiDict.from_midi(midi_file_path)
+    aria_tokenizer = AbsTokenizer()
+    tokenized_sequence = aria_tokenizer.tokenize(mid)[2:-1]
+    tokenized_sequence = flatten(tokenized_sequence, add_special_tokens=True)
+
+    segment_store = SegmentStore(tokenized_sequence)
+
+    corrupted_sequences = []
+    for t_segment_ind in range(min(n_segments, len(segment_store))):
+        output_dict = segment_store.corrupt(t_segment_ind, context_before=context_before, context_after=context_after, meta_data=[convert_to],
+                                            inference=True, corruption_type=corruption_type, run_corruption=True)
+        corrupted_sequences.append(output_dict['corrupted_sequence'])
+
+    return corrupted_sequences
+
+
+def time_refinement(corrupted_sequences, tokenizer, decode_tokenizer, model, configs, batch_size=1, seed=0, **refine_kwargs):
+    """
+    Refine the corrupted sequences in batches and return the latency per segment of every batch in seconds.
+    """
+    encoder_max_sequence_length = configs['model']['encoder_max_sequence_length']
+    decoder_max_sequence_length = configs['model']['decoder_max_sequence_length']
+    temperature = configs['generation']['temperature']
+
+    random.seed(seed)
+    torch.manual_seed(seed)
+    latencies = []
+    for i in range(0, len(corrupted_sequences), batch_size):
+        batch = corrupted_sequences[i:i + batch_size]
+        start_time = time.perf_counter()
+        refine_sequence_batch(batch, tokenizer, decode_tokenizer, model, encoder_max_sequence_length, decoder_max_sequence_length,
+                              temperature=temperature, **refine_kwargs)
+        latencies.append((time.perf_counter() - start_time) / len(batch))
+
+    return latencies
+
+
+def benchmark_padding(args, configs, tokenizer, decode_tokenizer, model):
+    """
+    Compare fixed padding to encoder_max_sequence_length against dynamic padding on the example pieces.
+    """
+    pad_to_multiple_of = configs.get('inference', {}).get('pad_to_multiple_of', 64)
+    midi_file_paths = sorted(glob.glob(os.path.join(args.input_folder, "*.mid")))
+
+    print(f"{'Piece':<60} {'Segments':>8} {'Tokens':>7} {'Fixed ms':>9} {'Dynamic ms':>11} {'Speedup':>8}")
+    all_fixed, all_dynamic = [], []
+    for midi_file_path in midi_file_paths:
+        corrupted_sequences = get_corrupted_segments(midi_file_path, configs['generation']['convert_to'], args.context_before, args.context_after,
+                                                     args.corruption_type, args.n_segments)
+        if len(corrupted_sequences) == 0:
+            continue
+        codec = TokenCodec.from_vocab(tokenizer)
+        mean_length = np.mean([len(codec.encode_flattened(sequence, skip_unknown=True)) for sequence in corrupted_sequences])
+
+        # Warm up both shapes before timing
+        time_refinement(corrupted_sequences[:1], tokenizer, decode_tokenizer, model, configs, dynamic_padding=False)
+        time_refinement(corrupted_sequences[:1], tokenizer, decode_tokenizer, model, configs, dynamic_padding=True, pad_to_multiple_of=pad_to_multiple_of)
+
+        fixed = time_refinement(corrupted_sequences, tokenizer, decode_tokenizer, model, configs, batch_size=args.batch_size, seed=args.seed,
+                                dynamic_padding=False)
+        dynamic = time_refinement(corrupted_sequences, tokenizer, decode_tokenizer, model, configs, batch_size=args.batch_size, seed=args.seed,
+                                  dynamic_padding=True, pad_to_multiple_of=pad_to_multiple_of)
+        all_fixed += fixed
+        all_dynamic += dynamic
+
+        print(f"{os.path.basename(midi_file_path)[:60]:<60} {len(corrupted_sequences):>8} {mean_length:>7.0f} {1000 * np.mean(fixed):>9.1f} "
+              f"{1000 * np.mean(dynamic):>11.1f} {np.mean(fixed) / np.mean(dynamic):>7.2f}x")
+
+    print(f"Overall: fixed {1000 * np.mean(all_fixed):.1f} ms/segment, dynamic {1000 * np.mean(all_dynamic):.1f} ms/segment, "
+          f"speedup {np.mean(all_fixed) / np.mean(all_dynamic):.2f}x")
+
+
+def benchmark_early_stopping(args, configs, tokenizer, decode_tokenizer, model):
+    """
+    Compare decoding every segment until <E> or the maximum length against stopping at the segment boundary.
+    """
+    midi_file_paths = sorted(glob.glob(os.path.join(args.input_folder, "*.mid")))
+
+    print(f"{'Piece':<60} {'Segments':>8} {'Full ms':>8} {'Stopped ms':>11} {'Stops':>6} {'Steps saved':>12}")
+    for midi_file_path in midi_file_paths:
+        corrupted_sequences = get_corrupted_segments(midi_file_path, configs['generation']['convert_to'], args.context_before, args.context_after,
+                                                     args.corruption_type, args.n_segments)
+        if len(corrupted_sequences) == 0:
+            continue
+        full = time_refinement(corrupted_sequences, tokenizer, decode_tokenizer, model, configs, batch_size=args.batch_size, seed=args.seed, dynamic_padding=True)
+        reset_decoding_stats()
+        stopped = time_refinement(corrupted_sequences, tokenizer, decode_tokenizer, model, configs, batch_size=args.batch_size, seed=args.seed, dynamic_padding=True,
+                                  early_stopping=True)
+        n_stops = DECODING_STATS['boundary_stops'] + DECODING_STATS['note_budget_stops']
+
+        print(f"{os.path.basename(midi_file_path)[:60]:<60} {len(corrupted_sequences):>8} {1000 * np.mean(full):>8.1f} {1000 * np.mean(stopped):>11.1f} "
+              f"{n_stops:>6} {DECODING_STATS['tokens_saved']:>12}")
+
+
+def benchmark_grammar(args, configs, tokenizer, decode_tokenizer, model):
+    """
+    Compare free decoding against grammar-constrained decoding: latency and fraction of decoded tokens parsed into notes.
+    """
+    midi_file_paths = sorted(glob.glob(os.path.join(args.input_folder, "*.mid")))
+
+    print(f"{'Piece':<60} {'Segments':>8} {'Free ms':>8} {'Free parsed':>12} {'Grammar ms':>11} {'Grammar parsed':>15}")
+    for midi_file_path in midi_file_paths:
+        corrupted_sequences = get_corrupted_segments(midi_file_path, configs['generation']['convert_to'], args.context_before, args.context_after,
+                                                     args.corruption_type, args.n_segments)
+        if len(corrupted_sequences) == 0:
+            continue
+        results = []
+        for grammar_constraint in [False, True]:
+            reset_decoding_stats()
+            latencies = time_refinement(corrupted_sequences, tokenizer, decode_tokenizer, model, configs, batch_size=args.batch_size, seed=args.seed, dynamic_padding=True,
+                                        grammar_constraint=grammar_constraint)
+            results.append((1000 * np.mean(latencies), 100 * DECODING_STATS['parsed_tokens'] / max(DECODING_STATS['decoded_tokens'], 1)))
+
+        print(f"{os.path.basename(midi_file_path)[:60]:<60} {len(corrupted_sequences):>8} {results[0][0]:>8.1f} {results[0][1]:>11.1f}% "
+              f"{results[1][0]:>11.1f} {results[1][1]:>14.1f}%")
+
+
+def benchmark_segments(args, configs, tokenizer, decode_tokenizer, model):
+    """
+    Host time per corrupted segment of apply_random_corruption on the whole sequence against the segment store,
+    on the example pieces repeated to increasing lengths.
+    """
+    corruption_obj = DataCorruption()
+    midi_file_paths = sorted(glob.glob(os.path.join(args.input_folder, "*.mid")))
+    tokenized_sequence = []
+    for midi_file_path in midi_file_paths:
+        mid = MidiDict.from_midi(midi_file_path)
+        tokenized_sequence += flatten(AbsTokenizer().tokenize(mid)[2:-1], add_special_tokens=True)
+
+    print(f"{'Segments':>8} {'Full sequence ms':>17} {'Segment store ms':>17}")
+    for repeat in [1, 4, 16]:
+        sequence = tokenized_sequence * repeat
+        segment_store = SegmentStore(sequence, corruption_obj)
+        n_segments = min(args.n_segments, len(segment_store))
+
+        random.seed(args.seed)
+        start_time = time.perf_counter()
+        for t_segment_ind in range(n_segments):
+            corruption_obj.apply_random_corruption(sequence, context_before=args.context_before, context_after=args.context_after, meta_data=[configs['generation']['convert_to']],
+                                                   t_segment_ind=t_segment_ind, inference=True, corruption_type=args.corruption_type, run_corruption=True)
+        full_time = (time.perf_counter() - start_time) / n_segments
+
+        random.seed(args.seed)
+        start_time = time.perf_counter()
+        for t_segment_ind in range(n_segments):
+            segment_store.corrupt(t_segment_ind, context_before=args.context_before, context_after=args.context_after, meta_data=[configs['generation']['convert_to']],
+                                  inference=True, corruption_type=args.corruption_type, run_corruption=True)
+        store_time = (time.perf_counter() - start_time) / n_segments
+
+        print(f"{len(segment_store):>8} {1000 * full_time:>17.2f} {1000 * store_time:>17.3f}")
+
+
+def benchmark_novelty(args, configs, tokenizer, decode_tokenizer, model):
+    """
+    Time of the symbolic novelty backend per example piece, from the MIDI file to the novel note numbers.
+    """
+    novel_peaks_pct = configs['generation']['novel_peaks_pct']
+    midi_file_paths = sorted(glob.glob(os.path.join(args.input_folder, "*.mid")))
+    symbolic_configs = {**configs, 'generation': {**configs['generation'], 'novelty_backend': 'symbolic', 'novel_peaks_pct': max(novel_peaks_pct, 0.05)}}
+
+    print(f"{'Piece':<60} {'Segments':>8} {'Novel notes':>11} {'ms':>8}")
+    for midi_file_path in midi_file_paths:
+        mid = MidiDict.from_midi(midi_file_path)
+        tokenized_sequence = AbsTokenizer().tokenize(mid)[2:-1]
+        start_time = time.perf_counter()
+        novel_note_numbers = get_novel_note_numbers(midi_file_path, None, mid, tokenized_sequence, symbolic_configs, quiet=True)
+        elapsed = time.perf_counter() - start_time
+        n_t_segments = len([t for t in tokenized_sequence if t == "<T>"])
+        print(f"{os.path.basename(midi_file_path)[:60]:<60} {n_t_segments:>8} {len(novel_note_numbers):>11} {1000 * elapsed:>8.1f}")
+
+
+def benchmark_cpu_pool(args, configs, tokenizer, decode_tokenizer, model):
+    """
+    Throughput of the CPU worker pool sharing memory-mapped weights, over splits of the cores into workers and threads.
+    """
+    n_cores = get_cpu_split(1)[1]
+    midi_file_paths = longest_first(glob.glob(os.path.join(args.input_folder, "*.mid")))
+    corruption_passes = {'pass_1': {'corruption_rate': 1.0, 'corruption_type': args.corruption_type}}
+    output_folder = tempfile.mkdtemp()
+    jobs = [{'task': 'generate',
+             'kwargs': dict(midi_file_path=midi_file_path, audio_file_path=None, configs=configs, novel_peaks_pct=0, t_segment_start=0,
+                            convert_to=configs['generation']['convert_to'], context_before=args.context_before, context_after=args.context_after,
+                            corruption_passes=corruption_passes, output_folder=output_folder, quiet=True, t_segment_stop=args.n_segments,
+                            batch_size=args.batch_size)}
+            for midi_file_path in midi_file_paths]
+
+    print(f"{'Workers':>7} {'Threads':>7} {'Wall s':>8} {'Pieces/s':>9} {'Segments/s':>11}")
+    n_workers = 1
+    while n_workers <= n_cores:
+        n_workers, n_threads = get_cpu_split(n_workers)
+        with JobScheduler(configs, ["cpu"], n_workers, num_threads=n_threads, mmap_weights=True) as scheduler:
+            random.seed(args.seed)
+            torch.manual_seed(args.seed)
+            start_time = time.perf_counter()
+            results = scheduler.run(jobs, quiet=True)
+            wall_time = time.perf_counter() - start_time
+        n_done = len([result for result in results if result['error'] is None])
+        print(f"{n_workers:>7} {n_threads:>7} {wall_time:>8.1f} {n_done / wall_time:>9.3f} {n_done * args.n_segments / wall_time:>11.2f}")
+        n_workers *= 2
+    shutil.rmtree(output_folder)
+
+
+def benchmark_determinism(args, configs, tokenizer, decode_tokenizer, model):
+    """
+    Check that seeded pieces give the same MIDI file when refined sequentially, in batches of args.batch_size and in
+    parallel worker processes. The global RNGs are reseeded differently before every run, a seeded piece must not use them.
+    Exits with an error if any run differs.
+    """
+    midi_file_paths = sorted(glob.glob(os.path.join(args.input_folder, "*.mid")))
+    corruption_passes = {f'pass_{n}': {'corruption_rate': 0.5, 'corruption_type': args.corruption_type} for n in range(1, 3)}
+    output_folder = tempfile.mkdtemp()
+
+    def get_kwargs(midi_file_path, run_name, batch_size):
+        return dict(midi_file_path=midi_file_path, audio_file_path=None, configs=configs, novel_peaks_pct=0, t_segment_start=0,
+                    convert_to=configs['generation']['convert_to'], context_before=args.context_before, context_after=args.context_after,
+                    corruption_passes=corruption_passes, output_folder=os.path.join(output_folder, run_name), quiet=True, t_segment_stop=args.n_segments,
+                    batch_size=batch_size, strict_dependencies=True)
+
+    for run_seed, (run_name, batch_size) in enumerate([("sequential", 1), ("batched", args.batch_size)]):
+        for midi_file_path in midi_file_paths:
+            random.seed(run_seed)
+            torch.manual_seed(run_seed)
+            generate(fusion_model=model, tokenizer=tokenizer, decode_tokenizer=decode_tokenizer, seed=args.seed, **get_kwargs(midi_file_path, run_name, batch_size))
+
+    # The workers take the pieces in reverse order
+    devices = ["cuda:0"] if cuda_available() else ["cpu"]
+    jobs = [{'task': 'generate', 'seed': args.seed, 'kwargs': get_kwargs(midi_file_path, "parallel", args.batch_size)} for midi_file_path in reversed(midi_file_paths)]
+    with JobScheduler(configs, devices, 2) as scheduler:
+        scheduler.run(jobs, quiet=True)
+
+    n_different = 0
+    print(f"{'Piece':<60} {'Batched':>8} {'Parallel':>9}")
+    for midi_file_path in midi_file_paths:
+        filename = "generated_" + os.path.basename(midi_file_path)
+        hashes = {run_name: hash_file(os.path.join(output_folder, run_name, filename)) for run_name in ["sequential", "batched", "parallel"]}
+        same = {run_name: hashes[run_name] == hashes['sequential'] for run_name in ["batched", "parallel"]}
+        n_different += list(same.values()).count(False)
+        print(f"{os.path.basename(midi_file_path)[:60]:<60} {'same' if same['batched'] else 'DIFFERENT':>8} "
+              f"{'same' if same['parallel'] else 'DIFFERENT':>9}")
+    shutil.rmtree(output_folder)
+    if n_different > 0:
+        sys.exit(f"{n_different} seeded runs differ from the sequential run")
+
+
+def benchmark_variations(args, configs, tokenizer, decode_tokenizer, model):
+    """
+    Time args.num_variations variations of every piece from one call to generate against as many separate calls.
+    """
+    midi_file_paths = sorted(glob.glob(os.path.join(args.input_folder, "*.mid")))
+    corruption_passes = {'pass_1': {'corruption_rate': 1.0, 'corruption_type': args.corruption_type}}
+    output_folder = tempfile.mkdtemp()
+
+    def run(midi_file_path, num_variations):
+        start_time = time.perf_counter()
+        generate(midi_file_path, None, model, configs, 0, 0, configs['generation']['convert_to'], args.context_before, args.context_after,
+                 corruption_passes, tokenizer, decode_tokenizer, output_folder, quiet=True, t_segment_stop=args.n_segments,
+                 batch_size=args.batch_size, seed=args.seed, num_variations=num_variations)
+        return time.perf_counter() - start_time
+
+    print(f"{'Piece':<60} {'Separate s':>10} {'Shared s':>9} {'Speedup':>8}")
+    for midi_file_path in midi_file_paths:
+        separate_time = sum(run(midi_file_path, 1) for _ in range(args.num_variations))
+        shared_time = run(midi_file_path, args.num_variations)
+        print(f"{os.path.basename(midi_file_path)[:60]:<60} {separate_time:>10.1f} {shared_time:>9.1f} {separate_time / shared_time:>7.2f}x")
+    shutil.rmtree(output_folder)
+
+
+def get_note_statistics(midi_file_path):
+    """
+    Note count and mean pitch, velocity and duration of a MIDI file.
+    """
+    notes = [note for instrument in pretty_midi.PrettyMIDI(midi_file_path).instruments for note in instrument.notes]
+    if len(notes) == 0:
+        return {'notes': 0, 'pitch': 0.0, 'velocity': 0.0, 'duration': 0.0}
+    return {'notes': len(notes), 'pitch': np.mean([note.pitch for note in notes]), 'velocity': np.mean([note.velocity for note in notes]),
+            'duration': np.mean([note.end - note.start for note in notes])}
+
+
+def benchmark_quantization(args, configs, tokenizer, decode_tokenizer, model):
+    """
+    Compare the fp32 and int8 backends on CPU: decoded tokens per second, and the genre probabilities and note
+    statistics of the same seeded generation of every piece.
+    """
+    # Imported here, the genre classifier pulls in the evaluation dependencies
+    from run_eval_metrics import StyleTransferEvaluator
+
+    evaluator = StyleTransferEvaluator(configs)
+    midi_file_paths = sorted(glob.glob(os.path.join(args.input_folder, "*.mid")))
+    corruption_passes = {'pass_1': {'corruption_rate': 1.0, 'corruption_type': args.corruption_type}}
+    convert_to = configs['generation']['convert_to']
+    target_genre = convert_to.capitalize()
+    output_folder = tempfile.mkdtemp()
+
+    print(f"{'Piece':<50} {'Backend':>7} {'Tokens/s':>9} {'P(' + target_genre + ')':>12} {'Notes':>6} {'Pitch':>6} {'Velocity':>8} {'Duration':>8}")
+    for backend in ["torch", "int8"]:
+        backend_model = load_fusion_model(configs, device="cpu", backend=backend)
+        all_tokens, all_time = 0, 0.0
+        for midi_file_path in midi_file_paths:
+            start_time = time.perf_counter()
+            # A single pass, so the decoding stats left by generate cover the whole piece
+            generate(midi_file_path, None, backend_model, configs, 0, 0, convert_to, args.context_before, args.context_after,
+                     corruption_passes, tokenizer, decode_tokenizer, os.path.join(output_folder, backend), quiet=True, t_segment_stop=args.n_segments,
+                     batch_size=args.batch_size, seed=args.seed)
+            elapsed = time.perf_counter() - start_time
+            all_tokens += DECODING_STATS['decoded_tokens']
+            all_time += elapsed
+
+            generated_midi_file_path = os.path.join(output_folder, backend, "generated_" + os.path.basename(midi_file_path))
+            genre_probs = evaluator.get_genre_probabilities(generated_midi_file_path)
+            note_stats = get_note_statistics(generated_midi_file_path)
+            print(f"{os.path.basename(midi_file_path)[:50]:<50} {backend:>7} {DECODING_STATS['decoded_tokens'] / elapsed:>9.1f} {genre_probs[target_genre]:>12.3f} "
+                  f"{note_stats['notes']:>6} {note_stats['pitch']:>6.1f} {note_stats['velocity']:>8.1f} {note_stats['duration']:>8.3f}")
+        print(f"Overall {backend}: {all_tokens / all_time:.1f} tokens/s")
+        del backend_model
+    shutil.rmtree(output_folder)
+
+
+def benchmark_onnx(args, configs, tokenizer, decode_tokenizer, model):
+    """
+    Per-segment latency of ONNX Runtime against torch eager, both on CPU, at batch 1 and batch 8.
+    """
+    pad_to_multiple_of = configs.get('inference', {}).get('pad_to_multiple_of', 64)
+    corrupted_sequences = []
+    for midi_file_path in sorted(glob.glob(os.path.join(args.input_folder, "*.mid"))):
+        corrupted_sequences += get_corrupted_segments(midi_file_path, configs['generation']['convert_to'], args.context_before, args.context_after,
+                                                      args.corruption_type, args.n_segments)
+
+    print(f"{'Backend':>7} {'Batch':>5} {'Segments':>8} {'ms/segment':>11} {'p90 ms':>8}")
+    for backend in ["torch", "onnx"]:
+        backend_model = load_fusion_model(configs, device="cpu", backend=backend)
+        # Warm up before timing
+        time_refinement(corrupted_sequences[:1], tokenizer, decode_tokenizer, backend_model, configs, dynamic_padding=True, pad_to_multiple_of=pad_to_multiple_of)
+        for batch_size in [1, 8]:
+            latencies = time_refinement(corrupted_sequences, tokenizer, decode_tokenizer, backend_model, configs, batch_size=batch_size, seed=args.seed,
+                                        dynamic_padding=True, pad_to_multiple_of=pad_to_multiple_of)
+            print(f"{backend:>7} {batch_size:>5} {len(corrupted_sequences):>8} {1000 * np.mean(latencies):>11.1f} {1000 * np.percentile(latencies, 90):>8.1f}")
+        del backend_model
+
+
+def benchmark_compile(args, configs, tokenizer, decode_tokenizer, model):
+    """
+    Warm-up cost and steady-state latency per decoder call of the eager and the compiled torch model.
+    """
+    pad_to_multiple_of = configs.get('inference', {}).get('pad_to_multiple_of', 64)
+    corrupted_sequences = []
+    for midi_file_path in sorted(glob.glob(os.path.join(args.input_folder, "*.mid"))):
+        corrupted_sequences += get_corrupted_segments(midi_file_path, configs['generation']['convert_to'], args.context_before, args.context_after,
+                                                      args.corruption_type, args.n_segments)
+
+    print(f"{'Model':>8} {'Warm-up calls':>13} {'Warm-up s':>10} {'Steady calls':>12} {'Steady ms':>10}")
+    for compile_model in [False, True]:
+        backend_model = load_fusion_model({**configs, 'inference': {**configs.get('inference', {}), 'compile': compile_model}}, backend="torch")
+        reset_decoding_stats()
+        time_refinement(corrupted_sequences, tokenizer, decode_tokenizer, backend_model, configs, batch_size=args.batch_size, seed=args.seed,
+                        dynamic_padding=True, pad_to_multiple_of=pad_to_multiple_of)
+        stats = DECODING_STATS
+        steady_latency = stats['steady_time'] / stats['steady_calls'] if stats['steady_calls'] > 0 else 0.0
+        print(f"{'compiled' if compile_model else 'eager':>8} {stats['warmup_calls']:>13} {stats['warmup_time']:>10.1f} {stats['steady_calls']:>12} "
+              f"{1000 * steady_latency:>10.1f}")
+        del backend_model
+
+
+# Run by benchmark_startup in a fresh interpreter: the startup of a CLI run up to its first refined segment
+STARTUP_SCRIPT = """
+import time
+start_time = time.perf_counter()
+import sys
+import json
+options = json.loads(sys.argv[1])
+sys.path.insert(0, options['script_dir'])
+import yaml
+from ariautils.midi import MidiDict
+from ariautils.tokenizer import AbsTokenizer
+from corruptions import SegmentStore
+from generation import refine_sequence_batch
+from inference import load_tokenizer, load_fusion_model
+from utils.tokens import flatten
+timings = {'imports': time.perf_counter() - start_time}
+
+with open(options['config'], 'r') as f:
+    configs = yaml.safe_load(f)
+configs['inference'] = {**configs.get('inference', {}), 'fast_load': options['fast_load']}
+tokenizer, decode_tokenizer = load_tokenizer(configs)
+timings['tokenizer'] = time.perf_counter() - start_time
+fusion_model = load_fusion_model(configs)
+timings['model'] = time.perf_counter() - start_time
+
+tokenized_sequence = flatten(AbsTokenizer().tokenize(MidiDict.from_midi(options['midi_file_path']))[2:-1], add_special_tokens=True)
+output_dict = SegmentStore(tokenized_sequence).corrupt(0, context_before=options['context_before'], context_after=options['context_after'],
+                                                       meta_data=[configs['generation']['convert_to']], inference=True,
+                                                       corruption_type=options['corruption_type'], run_corruption=True)
+refine_sequence_batch([output_dict['corrupted_sequence']], tokenizer, decode_tokenizer, fusion_model, configs['model']['encoder_max_sequence_length'],
+                      configs['model']['decoder_max_sequence_length'], temperature=configs['generation']['temperature'])
+timings['first_segment'] = time.perf_counter() - start_time
+print(json.dumps(timings))
+"""
+
+
+def benchmark_startup(args, configs, tokenizer, decode_tokenizer, model):
+    """
+    Time to the first refined segment of a fresh process, from_pretrained against the memory-mapped fast load.
+    Every step is cumulative from the start of the interpreter's imports, Wall also covers the interpreter startup.
+    """
+    midi_file_path = sorted(glob.glob(os.path.join(args.input_folder, "*.mid")))[0]
+
+    print(f"{'Load':>15} {'Imports s':>9} {'Tokenizer s':>11} {'Model s':>8} {'First segment s':>15} {'Wall s':>7}")
+    # The first round fills the page cache, so both loads read warm files in the second
+    for _ in range(2):
+        for fast_load in [False, True]:
+            options = {'script_dir': SCRIPT_DIR, 'config': args.config, 'midi_file_path': midi_file_path, 'fast_load': fast_load,
+                       'context_before': args.context_before, 'context_after': args.context_after, 'corruption_type': args.corruption_type}
+            start_time = time.perf_counter()
+            result = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, json.dumps(options)], capture_output=True, text=True, check=True)
+            wall_time = time.perf_counter() - start_time
+            timings = json.loads(result.stdout.strip().splitlines()[-1])
+            print(f"{'fast load' if fast_load else 'from_pretrained':>15} {timings['imports']:>9.2f} {timings['tokenizer']:>11.2f} {timings['model']:>8.2f} "
+                  f"{timings['first_segment']:>15.2f} {wall_time:>7.2f}")
+
+
+def benchmark_imports(args, configs, tokenizer, decode_tokenizer, model):
+    """
+    Import time of `from utils.utils import flatten` in a fresh interpreter, the best of 5 runs. Exits with an error
+    if it exceeds args.import_budget_ms or loads one of utils.import_check.HEAVY_MODULES, so it can guard the import time in CI.
+    """
+    import_time, heavy_modules = measure_token_helper_import()
+
+    print(f"from utils.utils import flatten: {1000 * import_time:.1f} ms (budget {args.import_budget_ms:.0f} ms), "
+          f"heavy modules loaded: {heavy_modules if len(heavy_modules) > 0 else 'none'}")
+    if 1000 * import_time > args.import_budget_ms or len(heavy_modules) > 0:
+        sys.exit("Token helper import is over budget")
+
+
+BENCHMARKS = {
+    'padding': benchmark_padding,
+    'early_stopping': benchmark_early_stopping,
+    'grammar': benchmark_grammar,
+    'segments': benchmark_segments,
+    'novelty': benchmark_novelty,
+    'cpu_pool': benchmark_cpu_pool,
+    'determinism': benchmark_determinism,
+    'variations': benchmark_variations,
+    'quantization': benchmark_quantization,
+    'onnx': benchmark_onnx,
+    'compile': benchmark_compile,
+    'startup': benchmark_startup,
+    'imports': benchmark_imports,
+}
+# Benchmarks that do not need the fusion model in this process, or load their own
+HOST_BENCHMARKS = ['segments', 'novelty', 'cpu_pool', 'quantization', 'onnx', 'compile', 'startup', 'imports']
+
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default=os.path.normpath("configs/config_style_transfer.yaml"),
+                        help="Path to the config file")
+    parser.add_argument("--benchmark", type=str, default="padding", choices=list(BENCHMARKS.keys()),
+                        help="Name of the benchmark to run")
+    parser.add_argument("--input_folder", type=str, default="input",
+                        help="Folder with the example MIDI pieces")
+    parser.add_argument("--n_segments", type=int, default=8,
+                        help="Number of T-segments refined per piece")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="Number of segments refined per generate call")
+    parser.add_argument("--context_before", type=int, default=5,
+                        help="Number of context segments before the corrupted segment")
+    parser.add_argument("--context_after", type=int, default=5,
+                        help="Number of context segments after the corrupted segment")
+    parser.add_argument("--corruption_type", type=str, default="pitch_velocity_mask",
+                        help="Corruption applied to every benchmarked segment")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed used before every timed run")
+    parser.add_argument("--num_variations", type=int, default=4,
+                        help="Number of variations generated per piece")
+    parser.add_argument("--import_budget_ms", type=float, default=IMPORT_BUDGET_MS,
+                        help="Import time budget of the token helpers in the imports benchmark")
+    args = parser.parse_args()
+
+    # Load config file
+    with open(args.config, 'r') as f:
+        configs = yaml.safe_load(f)
+
+    artifact_folder = configs["raw_data"]["artifact_folder"]
+
+    # Load the tokenizer dictionary
+    with open(os.path.join(artifact_folder, "style_transfer", "vocab_corrupted.pkl"), "rb") as f:
+        tokenizer = pickle.load(f)
+
+    # Reverse the tokenizer
+    decode_tokenizer = {v: k for k, v in tokenizer.items()}
+
+    # Load the fusion model
+    fusion_model = None
+    if args.benchmark not in HOST_BENCHMARKS:
+        fusion_model = load_fusion_model(configs)
+        print("Fusion model loaded on", fusion_model.device)
+
+    with torch.no_grad():
+        BENCHMARKS[args.benchmark](args, configs, tokenizer, decode_tokenizer, fusion_model)
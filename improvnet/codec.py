@@ -0,0 +1,307 @@
+import os
+import sys
+import time
+import pickle
+import random
+import argparse
+import yaml
+import numpy as np
+
+# Token kinds stored in the decode tables
+OTHER, PIANO, ONSET, DUR = 0, 1, 2, 3
+KIND_IDS = {"piano": PIANO, "onset": ONSET, "dur": DUR}
+# Order of the note fields in a note array
+NOTE_FIELDS = {"piano": (0, 1), "onset": 2, "dur": 3}
+# Order the decoder emits and the corrupted encoder inputs contain
+DEFAULT_ORDER = ("onset", "dur", "piano")
+
+_CODEC_CACHE = {}
+
+
+class TokenCodec:
+    """
+    Array-backed replacement for the vocab_corrupted.pkl dictionary lookups.
+    Note tokens are encoded with NumPy lookup tables indexed by pitch, velocity and time,
+    and ids are decoded with tables indexed by token id.
+    """
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.vocab_size = max(tokenizer.values()) + 1
+
+        # Encode tables, 0 marks a value that is not in the vocabulary
+        max_onset = max(token[1] for token in tokenizer if type(token) == tuple and token[0] == "onset")
+        max_dur = max(token[1] for token in tokenizer if type(token) == tuple and token[0] == "dur")
+        self.piano_table = np.zeros((128, 128), dtype=np.int32)
+        self.onset_table = np.zeros(max_onset + 1, dtype=np.int32)
+        self.dur_table = np.zeros(max_dur + 1, dtype=np.int32)
+        self.special_ids = {}
+
+        # Decode tables indexed by token id
+        self.kinds = np.zeros(self.vocab_size, dtype=np.int8)
+        self.pitches = np.full(self.vocab_size, -1, dtype=np.int32)
+        self.velocities = np.full(self.vocab_size, -1, dtype=np.int32)
+        self.times = np.full(self.vocab_size, -1, dtype=np.int32)
+        self.id_to_token = [None] * self.vocab_size
+
+        for token, idx in tokenizer.items():
+            self.id_to_token[idx] = token
+            kind = KIND_IDS.get(token[0], OTHER) if type(token) == tuple else OTHER
+            if kind == PIANO:
+                self.piano_table[token[1], token[2]] = idx
+                self.pitches[idx], self.velocities[idx] = token[1], token[2]
+            elif kind == ONSET:
+                self.onset_table[token[1]] = idx
+                self.times[idx] = token[1]
+            elif kind == DUR:
+                self.dur_table[token[1]] = idx
+                self.times[idx] = token[1]
+            else:
+                self.special_ids[token] = idx
+            self.kinds[idx] = kind
+
+    @classmethod
+    def from_vocab(cls, tokenizer):
+        """
+        Codec for a loaded tokenizer dictionary, built once per dictionary.
+        """
+        codec = _CODEC_CACHE.get(id(tokenizer))
+        if codec is None or codec.tokenizer is not tokenizer:
+            codec = cls(tokenizer)
+            _CODEC_CACHE[id(tokenizer)] = codec
+        return codec
+
+    def _lookup(self, kinds, first, second, ids):
+        # Fill the ids of the note tokens, values outside the tables stay 0
+        piano = (kinds == PIANO) & (first >= 0) & (first < 128) & (second >= 0) & (second < 128)
+        ids[piano] = self.piano_table[first[piano], second[piano]]
+        for kind, table in ((ONSET, self.onset_table), (DUR, self.dur_table)):
+            valid = (kinds == kind) & (first >= 0) & (first < len(table))
+            ids[valid] = table[first[valid]]
+        return ids
+
+    def _encode_tokens(self, sequence):
+        # Ids of a token sequence, 0 for tokens missing from the vocabulary
+        n = len(sequence)
+        ids, kinds, first, second = [0] * n, [OTHER] * n, [0] * n, [0] * n
+        special_ids = self.special_ids
+        for i, token in enumerate(sequence):
+            if type(token) == str:
+                ids[i] = special_ids.get(token, 0)
+                continue
+            kind = KIND_IDS.get(token[0], OTHER)
+            if kind == PIANO:
+                first[i], second[i] = token[1], token[2]
+            elif kind != OTHER:
+                first[i] = token[1]
+            else:
+                ids[i] = special_ids.get(tuple(token), 0)
+            kinds[i] = kind
+
+        return self._lookup(np.asarray(kinds, dtype=np.int8), np.asarray(first, dtype=np.int64), np.asarray(second, dtype=np.int64),
+                            np.asarray(ids, dtype=np.int32))
+
+    @staticmethod
+    def _drop_unknown(ids, items, item_index, skip_unknown):
+        unknown = ids == 0
+        if unknown.any():
+            if not skip_unknown:
+                raise KeyError(items[item_index[int(np.argmax(unknown))]])
+            ids = ids[~unknown]
+        return ids
+
+    def encode(self, sequence, skip_unknown=False):
+        """
+        Encode a token sequence to an int32 id array. Tokens missing from the vocabulary
+        raise a KeyError like the dictionary, or are dropped with skip_unknown.
+        """
+        ids = self._encode_tokens(sequence)
+        return self._drop_unknown(ids, sequence, np.arange(len(ids)), skip_unknown)
+
+    def encode_flattened(self, sequence, skip_unknown=False, order=DEFAULT_ORDER):
+        """
+        Encode a flattened sequence of [pitch, velocity, onset, duration] notes and string tokens directly.
+        Gives the same ids as encoding unflatten_corrupted(sequence), without building the token tuples.
+        """
+        is_note = np.fromiter((type(item) == list for item in sequence), dtype=bool, count=len(sequence))
+        lengths = np.where(is_note, 3, 1)
+        starts = np.cumsum(lengths) - lengths
+        ids = np.zeros(int(lengths.sum()), dtype=np.int32)
+        item_index = np.repeat(np.arange(len(sequence)), lengths)
+
+        other_positions = np.flatnonzero(~is_note)
+        if len(other_positions) > 0:
+            ids[starts[other_positions]] = self._encode_tokens([sequence[n] for n in other_positions.tolist()])
+
+        note_positions = np.flatnonzero(is_note)
+        if len(note_positions) > 0:
+            notes = [sequence[n] for n in note_positions.tolist()]
+            try:
+                values = np.array(notes, dtype=np.int64).reshape(-1, 4)
+                masked = np.zeros(values.shape, dtype=bool)
+            except (ValueError, TypeError):
+                # Masked fields are strings, they map to the PVM, O and D tokens
+                fields = np.array(notes, dtype=object).reshape(-1, 4)
+                masked = np.frompyfunc(type, 1, 1)(fields) != int
+                values = np.where(masked, -1, fields).astype(np.int64)
+            for column, name in enumerate(order):
+                kinds = np.full(len(notes), KIND_IDS[name], dtype=np.int8)
+                if name == "piano":
+                    column_ids = self._lookup(kinds, values[:, 0], values[:, 1], np.zeros(len(notes), dtype=np.int32))
+                    column_ids[masked[:, 0]] = self.special_ids.get("PVM", 0)
+                else:
+                    field = NOTE_FIELDS[name]
+                    column_ids = self._lookup(kinds, values[:, field], values[:, field], np.zeros(len(notes), dtype=np.int32))
+                    column_ids[masked[:, field]] = self.special_ids.get("O" if name == "onset" else "D", 0)
+                ids[starts[note_positions] + column] = column_ids
+
+        return self._drop_unknown(ids, sequence, item_index, skip_unknown)
+
+    def decode(self, ids):
+        """
+        Decode an id array to tokens, skipping padding.
+        """
+        id_to_token = self.id_to_token
+        return [id_to_token[idx] for idx in np.asarray(ids).tolist() if idx != 0]
+
+    def decode_batch(self, batch_ids):
+        """
+        Decode a batch of generated ids (array or tensor) with a single device to host copy.
+        """
+        if hasattr(batch_ids, "cpu"):
+            batch_ids = batch_ids.cpu().numpy()
+        return [self.decode(row) for row in batch_ids]
+
+    def encode_notes(self, notes, order=DEFAULT_ORDER):
+        """
+        Encode a (N, 4) note array of [pitch, velocity, onset, duration] to N * 3 ids in the given token order.
+        """
+        notes = np.asarray(notes, dtype=np.int64).reshape(-1, 4)
+        ids = np.zeros((len(notes), 3), dtype=np.int32)
+        for column, name in enumerate(order):
+            kinds = np.full(len(notes), KIND_IDS[name], dtype=np.int8)
+            if name == "piano":
+                first, second = notes[:, 0], notes[:, 1]
+            else:
+                first, second = notes[:, NOTE_FIELDS[name]], np.zeros(len(notes), dtype=np.int64)
+            ids[:, column] = self._lookup(kinds, first, second, ids[:, column].copy())
+        if (ids == 0).any():
+            raise KeyError(f"Note values outside the vocabulary: {notes[(ids == 0).any(axis=1)][0].tolist()}")
+        return ids.reshape(-1)
+
+    def decode_notes(self, ids, order=DEFAULT_ORDER):
+        """
+        Decode N * 3 ids in the given token order back to a (N, 4) note array.
+        """
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1, 3)
+        notes = np.zeros((len(ids), 4), dtype=np.int32)
+        for column, name in enumerate(order):
+            if (self.kinds[ids[:, column]] != KIND_IDS[name]).any():
+                raise ValueError(f"Expected {name} tokens in position {column} of every note")
+            if name == "piano":
+                notes[:, 0] = self.pitches[ids[:, column]]
+                notes[:, 1] = self.velocities[ids[:, column]]
+            else:
+                notes[:, NOTE_FIELDS[name]] = self.times[ids[:, column]]
+        return notes
+
+
+def pad_ids(ids, padded_length):
+    """
+    Pad an id array with 0 or truncate it to padded_length, as int64 for the model.
+    """
+    padded = np.zeros(padded_length, dtype=np.int64)
+    ids = ids[:padded_length]
+    padded[:len(ids)] = ids
+    return padded
+
+
+def check_round_trip(tokenizer, unflatten_corrupted, n_random=100000, seed=0):
+    """
+    Check the codec against the dictionary vocabulary on every vocab token, random token sequences
+    and random flattened corrupted sequences. Returns the dictionary and codec encoding times.
+    """
+    codec = TokenCodec.from_vocab(tokenizer)
+    decode_tokenizer = {v: k for k, v in tokenizer.items()}
+    velocities = sorted(set(token[2] for token in tokenizer if type(token) == tuple and token[0] == "piano"))
+
+    # Every vocabulary token encodes to its dictionary id and decodes back
+    vocab_tokens = list(tokenizer.keys())
+    assert codec.encode(vocab_tokens).tolist() == [tokenizer[token] for token in vocab_tokens]
+    assert codec.decode(codec.encode(vocab_tokens)) == vocab_tokens
+
+    # Random sequences with out of vocabulary tokens and list tokens as stored in the datasets
+    rng = random.Random(seed)
+    sequence = []
+    for _ in range(n_random):
+        choice = rng.random()
+        if choice < 0.3:
+            sequence.append(("piano", rng.randint(-2, 130), rng.choice(velocities + [64])))
+        elif choice < 0.6:
+            sequence.append(("onset", rng.randrange(-20, 5100, 5)))
+        elif choice < 0.9:
+            sequence.append(["dur", rng.randrange(0, 5100, 10)])
+        else:
+            sequence.append(rng.choice(["<T>", "<D>", "SEP", "O", "D", "PVM", "<N>", "classical", ("prefix", "instrument", "piano")]))
+    expected = [tokenizer[tuple(token) if isinstance(token, list) else token] for token in sequence
+                if (tuple(token) if isinstance(token, list) else token) in tokenizer]
+    assert codec.encode(sequence, skip_unknown=True).tolist() == expected
+    assert codec.decode(expected) == [decode_tokenizer[idx] for idx in expected]
+    try:
+        codec.encode(sequence)
+        raise AssertionError("Unknown tokens were not reported")
+    except KeyError:
+        pass
+
+    # Flattened corrupted sequences with masked fields against unflatten_corrupted and the dictionary
+    flattened_sequence = []
+    for _ in range(n_random // 3):
+        choice = rng.random()
+        note = [rng.randint(0, 127), rng.choice(velocities), rng.randrange(0, 5001, 10), rng.randrange(0, 5001, 10)]
+        if choice < 0.1:
+            flattened_sequence.append(rng.choice(["<T>", "<D>", "SEP", "<N>", "pitch_velocity_mask", "jazz", "mask"]))
+        elif choice < 0.2:
+            flattened_sequence.append(['P', 'V', note[2], note[3]])
+        elif choice < 0.3:
+            flattened_sequence.append([note[0], note[1], 'O', 'D'])
+        else:
+            flattened_sequence.append(note)
+    start_time = time.perf_counter()
+    expected = [tokenizer[token] for token in unflatten_corrupted(flattened_sequence) if token in tokenizer.keys()]
+    dict_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    encoded = codec.encode_flattened(flattened_sequence, skip_unknown=True)
+    codec_time = time.perf_counter() - start_time
+    assert encoded.tolist() == expected
+
+    # Note arrays
+    notes = np.array([[rng.randint(0, 127), rng.choice(velocities), rng.randrange(0, 5001, 10), rng.randrange(0, 5001, 10)] for _ in range(1000)])
+    note_ids = codec.encode_notes(notes)
+    assert note_ids.tolist() == [tokenizer[token] for p, v, o, d in notes.tolist() for token in [("onset", o), ("dur", d), ("piano", p, v)]]
+    assert (codec.decode_notes(note_ids) == notes).all()
+
+    return dict_time, codec_time
+
+
+if __name__ == "__main__":
+    SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.dirname(SCRIPT_DIR))
+    from utils.tokens import unflatten_corrupted
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default=os.path.normpath("configs/config_style_transfer.yaml"),
+                        help="Path to the config file")
+    args = parser.parse_args()
+
+    # Load config file
+    with open(args.config, 'r') as f:
+        configs = yaml.safe_load(f)
+
+    artifact_folder = configs["raw_data"]["artifact_folder"]
+
+    # Load the tokenizer dictionary
+    with open(os.path.join(artifact_folder, "style_transfer", "vocab_corrupted.pkl"), "rb") as f:
+        tokenizer = pickle.load(f)
+
+    dict_time, codec_time = check_round_trip(tokenizer, unflatten_corrupted)
+    print(f"Round trip checks passed. Encoding a flattened sequence: dictionary {1000 * dict_time:.1f} ms, codec {1000 * codec_time:.1f} ms")
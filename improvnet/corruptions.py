@@ -97,9 +97,11 @@ class DataCorruption:
         """
         Permute the pitches in the data segment.
         """
+        # Seeded segments pass their own random stream
+        rng = kwargs.get('rng') or random
         if not kwargs.get('inference'):
             pitches = [note[0] for note in data if type(note) == list]
-            random.shuffle(pitches)
+            rng.shuffle(pitches)
 
             for note in data:
                 if type(note) == list:
@@ -111,12 +113,13 @@ class DataCorruption:
         """
         Permute the pitches and velocities in the data segment.
         """
+        rng = kwargs.get('rng') or random
         if not kwargs.get('inference'):
             pitches = [note[0] for note in data if type(note) == list]
-            random.shuffle(pitches)
+            rng.shuffle(pitches)
 
             velocities = [note[1] for note in data if type(note) == list]
-            random.shuffle(velocities)
+            rng.shuffle(velocities)
 
             for note in data:
                 if type(note) == list:
@@ -129,9 +132,10 @@ class DataCorruption:
         """
         Fragment the data segment.
         """
+        rng = kwargs.get('rng') or random
         len_segment = len(data)
         # Choose a random percentage between 0.2-0.5 to fragment the data
-        fragment_percentage = random.uniform(0.2, 0.5)
+        fragment_percentage = rng.uniform(0.2, 0.5)
         fragment_length = int(len_segment * fragment_percentage)
 
         fragmented_data = []
@@ -148,13 +152,14 @@ class DataCorruption:
         """
         Transpose the pitches in the data segment by a random value.
         """
+        rng = kwargs.get('rng') or random
         if not kwargs.get('inference'):
             add_by = 5
             subtract_by = -5
             for n, note in enumerate(data):
                 if type(data[n]) == list:
-                    if random.choice([True, False]) and (data[n][0] < 127-add_by or data[n][0] > 0+subtract_by):
-                        data[n][0] += random.randint(-5, 5)
+                    if rng.choice([True, False]) and (data[n][0] < 127-add_by or data[n][0] > 0+subtract_by):
+                        data[n][0] += rng.randint(-5, 5)
                 else:
                     data[n] = data[n]
 
@@ -170,6 +175,7 @@ class DataCorruption:
         """
         Modify the notes in the data segment by either omitting them or adding in new notes.
         """
+        rng = kwargs.get('rng') or random
         data_copy = copy.deepcopy(data)
         omitted_data = [i for i in data_copy if type(i) == str]
         data_copy = [i for i in data_copy if type(i) == list]
@@ -177,8 +183,8 @@ class DataCorruption:
         for n, note in enumerate(data_copy):
             if type(data_copy[n]) == list and n < (len(data_copy)-1) and n not in skip_idx:
                 # Note omission with dynamic probability
-                prob = random.uniform(0.1, 0.4)
-                if random.uniform(0, 1) < prob:
+                prob = rng.uniform(0.1, 0.4)
+                if rng.uniform(0, 1) < prob:
                     skip_idx.append(n+1)
                     next_note_onset = data_copy[n+1][2]
                     curr_next_note_onset_diff = abs(data_copy[n][2] - next_note_onset)
@@ -198,8 +204,8 @@ class DataCorruption:
         for n, note in enumerate(omitted_data):
             if type(omitted_data[n]) == list:
                 # Note addition with dynamic probability
-                prob = random.uniform(0.1, 0.4)
-                if random.uniform(0, 1) < prob and omitted_data[n][3] > 500 and n < (len(omitted_data)-1):
+                prob = rng.uniform(0.1, 0.4)
+                if rng.uniform(0, 1) < prob and omitted_data[n][3] > 500 and n < (len(omitted_data)-1):
                     # Add current note
                     tmp = copy.deepcopy(omitted_data[n])
                     # Modify the duration of the current note
@@ -208,16 +214,16 @@ class DataCorruption:
                     added_data.append(tmp)
                     # Add the new note
                     # New pitch between -5 and 5 semitones from the current pitch
-                    new_pitch = tmp[0] + random.randint(-5, 5)
+                    new_pitch = tmp[0] + rng.randint(-5, 5)
                     # New velocity between 45 and 105
-                    new_velocity = random.choice([45, 60, 75, 90, 105])
+                    new_velocity = rng.choice([45, 60, 75, 90, 105])
                     diff_curr_next_onset = abs(omitted_data[n+1][2] - tmp[2])
                     # New onset should be between the current onset and the next onset
-                    new_onset = tmp[2] + random.randint(0, diff_curr_next_onset)
+                    new_onset = tmp[2] + rng.randint(0, diff_curr_next_onset)
                     # Round the new onset to the nearest 10
                     new_onset = self.round_to_nearest_n(new_onset)
                     # New duration should be the tmp[3] + or - 10% of the tmp[3]
-                    new_duration = min((tmp[3] + random.randint(-int(tmp[3] * 0.1), int(tmp[3] * 0.1))), 5000)
+                    new_duration = min((tmp[3] + rng.randint(-int(tmp[3] * 0.1), int(tmp[3] * 0.1))), 5000)
                     # Round the new duration to the nearest 10
                     new_duration = self.round_to_nearest_n(new_duration, 10)
                     added_data.append([new_pitch, new_velocity, new_onset, new_duration])
@@ -402,6 +408,99 @@ class DataCorruption:
         return output
 
 
+class SegmentStore:
+    """
+    Keep a flattened sequence as the separately addressable items of seperateitems, with the
+    positions of the corruptible segments indexed once. Corrupting a segment copies only that
+    segment and reads only its context window, and replacing a segment is a single assignment.
+    """
+    def __init__(self, data: List, corruption_obj: DataCorruption = None, exclude_novelty: bool = True):
+        self.corruption_obj = corruption_obj if corruption_obj is not None else DataCorruption()
+        self.items = self.corruption_obj.seperateitems(data)
+        # Get the indices of the novelty tokens
+        self.novelty_segments = [n for n, i in enumerate(self.items) if '<N>' in i] if exclude_novelty else []
+        novelty_set = set(self.novelty_segments)
+        self.segment_indices = [n for n, i in enumerate(self.items) if type(i) == list and n not in novelty_set]
+
+    def __len__(self) -> int:
+        return len(self.segment_indices)
+
+    def get_window(self, t_segment_ind: int, context_before: int, context_after: int, inference: bool = False, rng=None) -> Tuple[int, int]:
+        """
+        Item range of the context window around a segment, as computed by shorten_list.
+        """
+        rng = rng or random
+        index = self.segment_indices[t_segment_ind]
+        start_index = max(t_segment_ind - context_before, 0)
+        end_index = min(t_segment_ind + context_after, len(self.segment_indices) - 1)
+        if rng.uniform(0, 1) < 0.1 and index != 0 and not inference:
+            return self.segment_indices[start_index], self.segment_indices[end_index] # no context after the corrupted segment
+        return self.segment_indices[start_index], self.segment_indices[end_index] + 1
+
+    def corrupt(self, t_segment_ind: int, context_before: int = 5, context_after: int = 1,
+                meta_data: List = [], inference: bool = False, corruption_type: str = None,
+                run_corruption: bool = True, rng: random.Random = None) -> Dict:
+        """
+        Corrupt one segment like apply_random_corruption, without copying or rebuilding the whole sequence.
+        With rng, every random choice of the corruption is drawn from it instead of the global random module.
+        """
+        assert t_segment_ind < len(self.segment_indices), "t_segment_ind should be less than the number of segments in the data"
+        rng = rng or random
+
+        if corruption_type is not None and corruption_type != 'random':
+            corruption_function = self.corruption_obj.corruption_functions[corruption_type]
+        else:
+            corruption_function = rng.choice(list(self.corruption_obj.corruption_functions.values()))
+
+        index = self.segment_indices[t_segment_ind]
+        segment = self.items[index]
+        segment_copy = copy.deepcopy(segment)
+
+        if run_corruption:
+            corrupted_segment, corruption_type = corruption_function(segment_copy, meta_data=meta_data, inference=inference, rng=rng)
+            corrupted_segment = ['SEP'] + corrupted_segment + ['SEP']
+        elif corruption_type == 'skyline':
+            corrupted_segment = ['SEP'] + ['skyline'] + meta_data + segment_copy + ['SEP']
+        else:
+            corrupted_segment = segment_copy
+            corruption_type = None
+
+        # Concatenate only the context window around the corrupted segment
+        window_start, window_end = self.get_window(t_segment_ind, context_before, context_after, inference=inference, rng=rng)
+        corrupted_data_sequence = []
+        for n in range(window_start, window_end):
+            element = corrupted_segment if n == index else self.items[n]
+            if type(element) == list:
+                corrupted_data_sequence += element
+            else:
+                corrupted_data_sequence.append(element)
+
+        output = {
+            't_segment_ind': t_segment_ind,
+            'index': index,
+            'all_segment_indices': self.segment_indices,
+            'corrupted_sequence': corrupted_data_sequence,
+            'original_segment': segment,
+            'corrupted_segment': corrupted_segment,
+            'corruption_type': corruption_type,
+            'last_idx_flag': index == len(self.items) - 1
+        }
+
+        return output
+
+    def replace(self, index: int, segment: List):
+        """
+        Replace the item at index, as returned by corrupt, with a refined segment.
+        """
+        self.items[index] = segment
+
+    def to_sequence(self) -> List:
+        """
+        Concatenate the items back into a flattened sequence.
+        """
+        return self.corruption_obj.concatenate_list(self.items)
+
+
 if __name__ == '__main__':
     # Load the data from a file
     data = DataCorruption.read_data_from_file('/homes/kb658/fusion/2_style_transfer/corruptions.txt')
@@ -16,10 +16,11 @@ from ariautils.midi import MidiDict
 from ariautils.tokenizer import AbsTokenizer
 
 from corruptions import DataCorruption
+from codec import TokenCodec, pad_ids
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
-from utils.utils import flatten, unflatten, unflatten_corrupted
+from utils.tokens import flatten, unflatten, unflatten_corrupted
 
 
 class Fusion_Dataset(Dataset):
@@ -38,6 +39,7 @@ class Fusion_Dataset(Dataset):
         # Load the pickled tokenizer dictionary
         with open(tokenizer_filepath, 'rb') as f:
             self.tokenizer = pickle.load(f)
+        self.codec = TokenCodec.from_vocab(self.tokenizer)
 
         self.corruption_obj = DataCorruption()
 
@@ -67,7 +69,7 @@ class Fusion_Dataset(Dataset):
         return sequence_copy
     
     
-    def get_corrupted_sequence(self, sequence, meta_data):
+    def get_corrupted_sequence(self, sequence, meta_data, return_ids=False):
         # Take the 3rd token as the start token until the 2nd last token
         sequence = sequence[2:-1]
 
@@ -87,6 +89,10 @@ class Fusion_Dataset(Dataset):
         corrupted_sequence = output_dict['corrupted_sequence']
         original_segment = output_dict['original_segment']
 
+        if return_ids:
+            # Encode the flattened sequences directly to token ids
+            return self.codec.encode_flattened(corrupted_sequence), self.codec.encode_flattened(original_segment)
+
         corrupted_sequence, original_segment = unflatten_corrupted(corrupted_sequence), unflatten(original_segment)
 
         return corrupted_sequence, original_segment
@@ -103,24 +109,14 @@ class Fusion_Dataset(Dataset):
         pitch_aug_function = self.aria_tokenizer.export_pitch_aug(12)
         tokenized_sequence = pitch_aug_function(tokenized_sequence)
 
-        input_tokens, original = self.get_corrupted_sequence(tokenized_sequence, meta_tokens)
+        input_tokens, original = self.get_corrupted_sequence(tokenized_sequence, meta_tokens, return_ids=True)
         
         # Add the start and end tokens
-        original = ["<S>"] + original + ["<E>"]
-
-        # Tokenize the sequences
-        input_tokens = [self.tokenizer[tuple(token)] if isinstance(token, list) else self.tokenizer[token] for token in input_tokens]
-        original = [self.tokenizer[tuple(token)] if isinstance(token, list) else self.tokenizer[token] for token in original]
+        original = np.concatenate([[self.tokenizer["<S>"]], original, [self.tokenizer["<E>"]]])
 
         # Pad the sequences
-        if len(original) < self.decoder_max_sequence_length:
-            original = F.pad(torch.tensor(original), (0, self.decoder_max_sequence_length - len(original))).to(torch.int64)
-        else:
-            original = torch.tensor(original[0:self.decoder_max_sequence_length]).to(torch.int64)
-        if len(input_tokens) < self.encoder_max_sequence_length:
-            input_tokens = F.pad(torch.tensor(input_tokens), (0, self.encoder_max_sequence_length - len(input_tokens))).to(torch.int64)
-        else:
-            input_tokens = torch.tensor(input_tokens[0:self.encoder_max_sequence_length]).to(torch.int64)
+        original = torch.from_numpy(pad_ids(original, self.decoder_max_sequence_length))
+        input_tokens = torch.from_numpy(pad_ids(input_tokens, self.encoder_max_sequence_length))
 
         # Attention mask based on non-padded tokens of the phrase
         attention_mask = torch.where(input_tokens != 0, 1, 0).type(torch.bool)
@@ -146,6 +142,7 @@ class Genre_Classifier_Dataset(Dataset):
         # Load the pickled tokenizer dictionary
         with open(tokenizer_filepath, 'rb') as f:
             self.tokenizer = pickle.load(f)
+        self.codec = TokenCodec.from_vocab(self.tokenizer)
 
         self.corruption_obj = DataCorruption()
 
@@ -174,7 +171,7 @@ class Genre_Classifier_Dataset(Dataset):
         return sequence_copy
     
     
-    def get_cropped_sequence(self, sequence, meta_data, t_segment_ind=None):
+    def get_cropped_sequence(self, sequence, meta_data, t_segment_ind=None, return_ids=False):
         # Take the 3rd token as the start token until the 2nd last token
         sequence = sequence[2:-1]
 
@@ -195,6 +192,10 @@ class Genre_Classifier_Dataset(Dataset):
         # Actually this is not a corrupted sequence, but the cropped original sequence 
         cropped_sequence = output_dict['corrupted_sequence']
 
+        if return_ids:
+            # Encode the flattened sequence directly to token ids
+            return self.codec.encode_flattened(cropped_sequence)
+
         cropped_sequence = unflatten_corrupted(cropped_sequence)
 
         return cropped_sequence
@@ -211,10 +212,7 @@ class Genre_Classifier_Dataset(Dataset):
         pitch_aug_function = self.aria_tokenizer.export_pitch_aug(12)
         tokenized_sequence = pitch_aug_function(tokenized_sequence)
 
-        input_tokens = self.get_cropped_sequence(tokenized_sequence, meta_tokens, t_segment_ind=None)
-
-        # Tokenize the sequences
-        input_tokens = [self.tokenizer[tuple(token)] if isinstance(token, list) else self.tokenizer[token] for token in input_tokens]
+        input_tokens = self.get_cropped_sequence(tokenized_sequence, meta_tokens, t_segment_ind=None, return_ids=True)
         
         # Define labels based on genre
         if genre == "classical":
@@ -225,10 +223,7 @@ class Genre_Classifier_Dataset(Dataset):
             label = 2
 
         # Pad the sequences
-        if len(input_tokens) < self.encoder_max_sequence_length:
-            input_tokens = F.pad(torch.tensor(input_tokens), (0, self.encoder_max_sequence_length - len(input_tokens))).to(torch.int64)
-        else:
-            input_tokens = torch.tensor(input_tokens[0:self.encoder_max_sequence_length]).to(torch.int64)
+        input_tokens = torch.from_numpy(pad_ids(input_tokens, self.encoder_max_sequence_length))
 
         # Attention mask based on non-padded tokens of the phrase
         attention_mask = torch.where(input_tokens != 0, 1, 0).type(torch.bool)
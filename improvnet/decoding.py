@@ -0,0 +1,281 @@
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+from codec import TokenCodec, OTHER, PIANO, ONSET, DUR
+
+
+# Corruptions whose refined segment has the notes of the corrupted segment, as named in the corrupted sequence
+NOTE_PRESERVING_CORRUPTIONS = ['pitch_velocity_mask', 'onset_duration_mask', 'pitch_permutation', 'pitch_velocity_permutation', 'incorrect_transposition']
+# Decoding counts of this process since the last reset: rows stopped by SegmentBoundaryStopping, the decoded
+# tokens of refined segments that survive parse_generation, and the time of warm-up and steady-state decoder calls
+DECODING_STATS = {'rows': 0, 'boundary_stops': 0, 'note_budget_stops': 0, 'tokens_saved': 0, 'decoded_tokens': 0, 'parsed_tokens': 0,
+                  'warmup_calls': 0, 'warmup_time': 0.0, 'steady_calls': 0, 'steady_time': 0.0}
+# Input shapes already decoded by this process. The first call of a shape pays for compilation and cache warm-up.
+_DECODED_SHAPES = set()
+
+# Token classes of the segment grammar beyond the note token kinds of the codec
+DIM, START, END, TIME = 4, 5, 6, 7
+# Classes that may follow each class in a refined segment: notes are onset, dur, piano and <D> or <E> come between notes.
+# A segment never holds <T>, and finished or unknown rows may only end so no row runs out of tokens.
+GRAMMAR = {
+    OTHER: [END],
+    PIANO: [ONSET, DIM, END],
+    ONSET: [DUR],
+    DUR: [PIANO],
+    DIM: [ONSET, DIM, END],
+    START: [ONSET, DIM, END],
+    END: [END],
+    TIME: [END],
+}
+
+
+class SameOnsetChordConstraint(LogitsProcessor):
+    """
+    Force chords while harmonizing: after a note whose onset stack holds fewer than chord_strength onsets,
+    the next onset must lie within onset_window ms after the last stacked onset.
+    """
+    def __init__(self, tokenizer, chord_strength=3, onset_window=50):
+        self.chord_strength = chord_strength
+        self.onset_window = onset_window
+
+        # Lookup tables built once from the vocabulary, indexed by token id
+        vocab_size = max(tokenizer.values()) + 1
+        self.onset_values = torch.full((vocab_size,), -1, dtype=torch.int64)
+        self.is_piano = torch.zeros(vocab_size, dtype=torch.bool)
+        for token, idx in tokenizer.items():
+            if type(token) == tuple and token[0] == "onset":
+                self.onset_values[idx] = token[1]
+            elif type(token) == tuple and "piano" in token:
+                self.is_piano[idx] = True
+        onset_ids = torch.nonzero(self.onset_values >= 0).squeeze(-1)
+        self.onset_id_range = (onset_ids.min().item(), onset_ids.max().item() + 1)
+
+        self.stack_length = None
+        self.last_onset = None
+        self.active = None
+
+    def reset(self, batch_size, device):
+        self.onset_values = self.onset_values.to(device)
+        self.is_piano = self.is_piano.to(device)
+        self.stack_length = torch.zeros(batch_size, dtype=torch.int64, device=device)
+        self.last_onset = torch.zeros(batch_size, dtype=torch.int64, device=device)
+        self.active = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+    def update(self, last_tokens):
+        # Push onsets that start the stack or fall close enough to the previous onset of the chord
+        onset_values = self.onset_values[last_tokens]
+        push = (onset_values >= 0) & ((self.stack_length == 0) | ((self.last_onset - onset_values).abs() <= self.onset_window))
+        self.last_onset = torch.where(push, onset_values, self.last_onset)
+        self.stack_length = self.stack_length + push.to(torch.int64)
+        # A note token with an unfinished chord activates the constraint for the next step
+        self.active = self.is_piano[last_tokens] & (self.stack_length >= 1) & (self.stack_length < self.chord_strength)
+
+    def __call__(self, input_ids, scores):
+        if self.stack_length is None or input_ids.shape[1] == 1:
+            # A new generation starts with only the <S> token
+            self.reset(input_ids.shape[0], input_ids.device)
+        else:
+            self.update(input_ids[:, -1])
+
+        if self.active.any():
+            start, end = self.onset_id_range
+            onset_values = self.onset_values[start:end].unsqueeze(0)
+            allowed = torch.zeros_like(scores, dtype=torch.bool)
+            allowed[:, start:end] = (onset_values >= self.last_onset.unsqueeze(1)) & (onset_values <= self.last_onset.unsqueeze(1) + self.onset_window)
+            scores = scores.masked_fill(self.active.unsqueeze(1) & ~allowed, float('-inf'))
+
+        return scores
+
+
+class TokenGrammarConstraint(LogitsProcessor):
+    """
+    Mask the next tokens that would break the grammar of a refined segment, so every decoded token ends up in a note.
+    The class of the last token selects the allowed classes from GRAMMAR, and onsets may not decrease within the segment.
+    """
+    def __init__(self, tokenizer):
+        codec = TokenCodec.from_vocab(tokenizer)
+        # Class and onset value of every token id
+        self.token_classes = torch.from_numpy(codec.kinds.astype('int64'))
+        for token, token_class in [("<D>", DIM), ("<S>", START), ("<E>", END), ("<T>", TIME)]:
+            if token in tokenizer:
+                self.token_classes[tokenizer[token]] = token_class
+        self.onset_values = torch.where(self.token_classes == ONSET, torch.from_numpy(codec.times.astype('int64')), -1)
+        self.allowed_classes = torch.zeros((len(GRAMMAR), len(GRAMMAR)), dtype=torch.bool)
+        for token_class, next_classes in GRAMMAR.items():
+            self.allowed_classes[token_class, next_classes] = True
+
+        self.last_onset = None
+
+    def reset(self, batch_size, vocab_size, device):
+        # Ids the tokenizer does not know are never sampled
+        n_unknown = max(vocab_size - len(self.token_classes), 0)
+        self.token_classes = torch.cat([self.token_classes, torch.full((n_unknown,), OTHER, dtype=torch.int64)]).to(device)
+        self.onset_values = torch.cat([self.onset_values, torch.full((n_unknown,), -1, dtype=torch.int64)]).to(device)
+        self.allowed_classes = self.allowed_classes.to(device)
+        self.last_onset = torch.zeros(batch_size, dtype=torch.int64, device=device)
+
+    def __call__(self, input_ids, scores):
+        if self.last_onset is None or input_ids.shape[1] == 1:
+            # A new generation starts with only the <S> token
+            self.reset(input_ids.shape[0], scores.shape[-1], input_ids.device)
+        last_tokens = input_ids[:, -1]
+        self.last_onset = torch.maximum(self.last_onset, self.onset_values[last_tokens])
+
+        states = self.token_classes[last_tokens]
+        if input_ids.shape[1] == 1:
+            # The first step starts the segment whatever the decoder start token is
+            states = torch.full_like(states, START)
+        allowed = self.allowed_classes[states][:, self.token_classes]
+        onset_values = self.onset_values.unsqueeze(0)
+        allowed = allowed & ((onset_values < 0) | (onset_values >= self.last_onset.unsqueeze(1)))
+
+        return scores.masked_fill(~allowed, float('-inf'))
+
+
+class SeededSampler(LogitsProcessor):
+    """
+    Sample every row of a batch from its own seeded stream. The temperature-scaled top-k scores are perturbed with Gumbel noise
+    drawn from the row's generator, so the greedy choice of generate is a sample that does not depend on the other rows.
+    """
+    def __init__(self, seeds, temperature=1.0, top_k=50):
+        self.seeds = seeds
+        self.temperature = temperature
+        self.top_k = top_k
+        self.generators = None
+
+    def __call__(self, input_ids, scores):
+        if self.generators is None or input_ids.shape[1] == 1:
+            # A new generation starts with only the <S> token
+            self.generators = [torch.Generator(device=scores.device).manual_seed(seed) for seed in self.seeds]
+
+        scores = scores / self.temperature
+        if self.top_k is not None and self.top_k < scores.shape[-1]:
+            kth_scores = torch.topk(scores, self.top_k, dim=-1).values[:, -1:]
+            scores = scores.masked_fill(scores < kth_scores, float('-inf'))
+
+        uniform = torch.stack([torch.rand(scores.shape[-1], generator=generator, device=scores.device) for generator in self.generators])
+        gumbel = -torch.log(-torch.log(uniform.clamp_min(torch.finfo(uniform.dtype).tiny)))
+
+        return scores + gumbel.to(scores.dtype)
+
+
+def get_note_budget(corrupted_sequence):
+    """
+    Number of notes of the refined segment when its corruption keeps the note count, -1 otherwise.
+    """
+    if 'SEP' not in corrupted_sequence:
+        return -1
+    start = corrupted_sequence.index('SEP')
+    segment = corrupted_sequence[start + 1:corrupted_sequence.index('SEP', start + 1)]
+    if len(segment) == 0 or segment[0] not in NOTE_PRESERVING_CORRUPTIONS:
+        return -1
+    return len([item for item in segment if type(item) == list])
+
+
+class SegmentBoundaryStopping(StoppingCriteria):
+    """
+    Stop decoding a row once its refined segment is complete. Onsets of a segment never decrease and stay within its
+    5 second window, so a <T> token or an onset earlier than the previous one starts the next segment. A row with a note
+    budget is also complete when it starts a note beyond the budget. The token that overran the segment is dropped:
+    stop_lengths holds the number of tokens of every row to keep, -1 for rows that ended on their own.
+    """
+    def __init__(self, tokenizer, note_budgets, max_length):
+        self.max_length = max_length
+        vocab_size = max(tokenizer.values()) + 1
+        self.onset_values = torch.full((vocab_size,), -1, dtype=torch.int64)
+        self.is_piano = torch.zeros(vocab_size, dtype=torch.bool)
+        self.is_boundary = torch.zeros(vocab_size, dtype=torch.bool)
+        for token, idx in tokenizer.items():
+            if type(token) == tuple and token[0] == "onset":
+                self.onset_values[idx] = token[1]
+            elif type(token) == tuple and token[0] == "piano":
+                self.is_piano[idx] = True
+            elif token == "<T>":
+                self.is_boundary[idx] = True
+        self.note_budgets = torch.tensor(note_budgets, dtype=torch.int64)
+
+        self.stop_lengths = None
+        self.boundary_stops = None
+
+    def reset(self, batch_size, device):
+        self.onset_values = self.onset_values.to(device)
+        self.is_piano = self.is_piano.to(device)
+        self.is_boundary = self.is_boundary.to(device)
+        self.note_budgets = self.note_budgets.to(device)
+        self.last_onset = torch.full((batch_size,), -1, dtype=torch.int64, device=device)
+        self.n_notes = torch.zeros(batch_size, dtype=torch.int64, device=device)
+        self.stop_lengths = torch.full((batch_size,), -1, dtype=torch.int64, device=device)
+        self.boundary_stops = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.stop_lengths is None:
+            self.reset(input_ids.shape[0], input_ids.device)
+
+        last_tokens = input_ids[:, -1]
+        running = self.stop_lengths < 0
+        onset_values = self.onset_values[last_tokens]
+        starts_note = onset_values >= 0
+        crossed = running & (self.is_boundary[last_tokens] | (starts_note & (onset_values < self.last_onset)))
+        over_budget = running & ~crossed & starts_note & (self.note_budgets >= 0) & (self.n_notes >= self.note_budgets)
+
+        self.stop_lengths = torch.where(crossed | over_budget, input_ids.shape[1] - 1, self.stop_lengths)
+        self.boundary_stops = self.boundary_stops | crossed
+        self.last_onset = torch.where(starts_note, onset_values, self.last_onset)
+        self.n_notes = self.n_notes + self.is_piano[last_tokens].to(torch.int64)
+
+        return self.stop_lengths >= 0
+
+    def truncate(self, output_tokens):
+        """
+        Replace the tokens of every stopped row from its overrun onwards with padding, and add the row counts to the stats.
+        """
+        if self.stop_lengths is None:
+            return output_tokens
+        stopped = self.stop_lengths >= 0
+        positions = torch.arange(output_tokens.shape[1], device=output_tokens.device).unsqueeze(0)
+        output_tokens = output_tokens.masked_fill(stopped.unsqueeze(1) & (positions >= self.stop_lengths.unsqueeze(1)), 0)
+
+        DECODING_STATS['rows'] += len(stopped)
+        DECODING_STATS['boundary_stops'] += int(self.boundary_stops.sum())
+        DECODING_STATS['note_budget_stops'] += int((stopped & ~self.boundary_stops).sum())
+        # Stopped rows could have run on to the maximum length
+        DECODING_STATS['tokens_saved'] += int((self.max_length - self.stop_lengths[stopped]).sum())
+
+        return output_tokens
+
+
+def count_parsed_tokens(decoded_sequence, parsed_sequence):
+    """
+    Add the tokens of a decoded row and those left of it after parse_generation to the stats, <S> and <E> excluded.
+    """
+    DECODING_STATS['decoded_tokens'] += len([token for token in decoded_sequence if token not in ["<S>", "<E>"]])
+    DECODING_STATS['parsed_tokens'] += len(parsed_sequence)
+
+
+def record_decode_latency(shape, seconds):
+    """
+    Count a decoder call as warm-up if it is the first with this input shape, as steady state otherwise.
+    """
+    phase = 'steady' if shape in _DECODED_SHAPES else 'warmup'
+    _DECODED_SHAPES.add(shape)
+    DECODING_STATS[f'{phase}_calls'] += 1
+    DECODING_STATS[f'{phase}_time'] += seconds
+
+
+def reset_decoding_stats():
+    for key in DECODING_STATS:
+        DECODING_STATS[key] = 0
+
+
+def print_decoding_stats():
+    stats = DECODING_STATS
+    if stats['decoded_tokens'] > 0:
+        print(f"Decoding: {stats['parsed_tokens']} of {stats['decoded_tokens']} decoded tokens parsed into notes "
+              f"({100 * stats['parsed_tokens'] / stats['decoded_tokens']:.1f}%)")
+    if stats['rows'] > 0:
+        print(f"Early stopping: {stats['boundary_stops']} segment boundary and {stats['note_budget_stops']} note budget stops in {stats['rows']} rows, "
+              f"up to {stats['tokens_saved']} decoder steps saved")
+    if stats['warmup_calls'] + stats['steady_calls'] > 0:
+        steady_latency = stats['steady_time'] / stats['steady_calls'] if stats['steady_calls'] > 0 else 0.0
+        print(f"Latency: {stats['warmup_calls']} warm-up calls in {stats['warmup_time']:.1f} s, "
+              f"{stats['steady_calls']} steady-state calls at {1000 * steady_latency:.1f} ms each")
@@ -5,159 +5,393 @@ import os
 import random
 import numpy as np
 import copy
+import time
 import sys
 import argparse
 from tqdm import tqdm
 import pretty_midi
 import torch
 from torch.nn import functional as F
-from transformers import EncoderDecoderModel
-from torch.cuda import is_available as cuda_available
+from transformers import LogitsProcessorList, StoppingCriteriaList
 from ariautils.midi import MidiDict
 from ariautils.tokenizer import AbsTokenizer
 
-from corruptions import DataCorruption
+from corruptions import DataCorruption, SegmentStore
+from codec import TokenCodec, pad_ids
+from refinement_cache import get_refinement_cache
+from decoding import SeededSampler, SegmentBoundaryStopping, TokenGrammarConstraint, get_note_budget, count_parsed_tokens, record_decode_latency, reset_decoding_stats, print_decoding_stats
+from inference import load_fusion_model, inference_context, INFERENCE_SETTINGS
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
-from utils.utils import flatten, unflatten_corrupted, parse_generation, unflatten_for_aria, Segment_Novelty
-
-
-def refine_sequence(corrupted_sequence, tokenizer, decode_tokenizer, model, encoder_max_sequence_length, decoder_max_sequence_length, temperature=1.0):
-    # Tokenize the sequence
-    # input_tokens = [tokenizer[tuple(token)] if isinstance(token, list) else tokenizer[token] for token in corrupted_sequence]
-    input_tokens = [tokenizer[token] for token in corrupted_sequence if token in tokenizer.keys()]
+from utils.tokens import flatten, parse_generation, unflatten_for_aria, add_novelty_segment_token
+from utils.novelty import Segment_Novelty, Symbolic_Novelty, get_midi_notes_from_tick
+
+
+def get_padded_length(lengths, encoder_max_sequence_length, dynamic_padding=False, pad_to_multiple_of=64):
+    """
+    Length the encoder inputs are padded to: the fixed maximum, or the longest input rounded up to pad_to_multiple_of,
+    then to the length bucket of a compiled model.
+    """
+    if not dynamic_padding:
+        return encoder_max_sequence_length
+    padded_length = int(np.ceil(max(max(lengths), 1) / pad_to_multiple_of) * pad_to_multiple_of)
+    if INFERENCE_SETTINGS['length_buckets'] is not None:
+        padded_length = min([length for length in INFERENCE_SETTINGS['length_buckets'] if length >= padded_length] + [encoder_max_sequence_length])
+    return min(padded_length, encoder_max_sequence_length)
+
+
+def refine_sequence_batch(corrupted_sequences, tokenizer, decode_tokenizer, model, encoder_max_sequence_length, decoder_max_sequence_length, temperature=1.0, logits_processor=None, 
+                          dynamic_padding=False, pad_to_multiple_of=64, cache=None, seeds=None, num_return_sequences=1, early_stopping=False, 
+                          grammar_constraint=False):
+    """
+    Refine several flattened corrupted sequences with a single padded call to model.generate.
+    With a RefinementCache, cached segments are reused and only the others are decoded.
+    With one seed per output row, every row is sampled from its own stream instead of the global torch RNG.
+    With num_return_sequences, every sequence is encoded once and sampled that many times, the samples of a sequence
+    following each other in the output.
+    With early_stopping, a row stops as soon as its segment is complete, see SegmentBoundaryStopping.
+    With grammar_constraint, tokens that could not be parsed into notes are never sampled, see TokenGrammarConstraint.
+    """
+    codec = TokenCodec.from_vocab(tokenizer)
+
+    # Tokenize the sequences
+    batch_input_ids = [codec.encode_flattened(corrupted_sequence, skip_unknown=True) for corrupted_sequence in corrupted_sequences]
+
+    # Constrained decoding depends on the state of the logits processor, so it is never cached. Unseeded rows are
+    # fresh samples of the global RNG and are never cached either, a cache hit would replay an earlier sample.
+    if cache is not None and seeds is not None and logits_processor is None and num_return_sequences == 1:
+        return refine_sequence_batch_cached(corrupted_sequences, batch_input_ids, tokenizer, decode_tokenizer, model, encoder_max_sequence_length, decoder_max_sequence_length, 
+                                            temperature, dynamic_padding, pad_to_multiple_of, cache, seeds, early_stopping, grammar_constraint)
+
+    padded_length = get_padded_length([len(input_ids) for input_ids in batch_input_ids], encoder_max_sequence_length, 
+                                      dynamic_padding=dynamic_padding, pad_to_multiple_of=pad_to_multiple_of)
     # Pad the sequences
-    if len(input_tokens) < encoder_max_sequence_length:
-        input_tokens = F.pad(torch.tensor(input_tokens), (0, encoder_max_sequence_length - len(input_tokens))).to(torch.int64)
-    else:
-        input_tokens = torch.tensor(input_tokens[0:encoder_max_sequence_length]).to(torch.int64)
+    input_tokens = torch.from_numpy(np.stack([pad_ids(input_ids, padded_length) for input_ids in batch_input_ids]))
 
     # Attention mask based on non-padded tokens of the phrase
     attention_mask = torch.where(input_tokens != 0, 1, 0).type(torch.bool)
 
-    # Generate the output sequence
-    output_tokens = model.generate(input_ids=input_tokens.unsqueeze(0).to("cuda" if cuda_available() else "cpu"),
-                                    attention_mask=attention_mask.unsqueeze(0).to("cuda" if cuda_available() else "cpu"),
-                                    max_length=decoder_max_sequence_length,
-                                    num_beams=1,
-                                    early_stopping=False,
-                                    do_sample=True,
-                                    temperature=temperature,
-                                    top_k=50,
-                                    top_p=1.0,
-                                    pad_token_id=0,
-                                    eos_token_id=tokenizer["<E>"],
-                                    bos_token_id=tokenizer["<S>"])
-
-    # Decode the output tokens
-    output_sequence = [decode_tokenizer[token.item()] for token in output_tokens[0]]
-
-    generated_sequences = parse_generation(output_sequence, add_special_tokens = True)
+    if grammar_constraint:
+        logits_processor = LogitsProcessorList(list(logits_processor or []) + [TokenGrammarConstraint(tokenizer)])
 
-    # Remove special tokens
-    generated_sequences = [token for token in generated_sequences if token not in ["<S>", "<E>", "<SEP>"]]
-
-    return generated_sequences
-
-
-def generate_one_pass(tokenized_sequence, fusion_model, configs, 
+    if seeds is None:
+        sampling_kwargs = dict(do_sample=True, temperature=temperature, top_k=50, top_p=1.0)
+    else:
+        # The seeded sampler turns greedy decoding into sampling from the streams of the rows
+        sampling_kwargs = dict(do_sample=False)
+        logits_processor = LogitsProcessorList(list(logits_processor or []) + [SeededSampler(seeds, temperature=temperature, top_k=50)])
+
+    segment_stopping = None
+    if early_stopping:
+        note_budgets = [get_note_budget(corrupted_sequence) for corrupted_sequence in corrupted_sequences for _ in range(num_return_sequences)]
+        segment_stopping = SegmentBoundaryStopping(tokenizer, note_budgets, decoder_max_sequence_length)
+
+    # Inputs go to the model's device, the int8 backend stays on CPU on GPU hosts
+    device = model.device
+    start_time = time.perf_counter()
+    with inference_context():
+        if num_return_sequences > 1:
+            # Run the encoder once per sequence and decode every sample from a copy of its outputs
+            encoder_outputs = model.get_encoder()(input_ids=input_tokens.to(device), attention_mask=attention_mask.to(device), return_dict=True)
+            encoder_outputs.last_hidden_state = encoder_outputs.last_hidden_state.repeat_interleave(num_return_sequences, dim=0)
+            model_inputs = dict(encoder_outputs=encoder_outputs, attention_mask=attention_mask.to(device).repeat_interleave(num_return_sequences, dim=0))
+        else:
+            model_inputs = dict(input_ids=input_tokens.to(device), attention_mask=attention_mask.to(device))
+
+        # Generate the output sequences
+        output_tokens = model.generate(**model_inputs,
+                                        max_length=decoder_max_sequence_length,
+                                        num_beams=1,
+                                        early_stopping=False,
+                                        **sampling_kwargs,
+                                        pad_token_id=0,
+                                        eos_token_id=tokenizer["<E>"],
+                                        bos_token_id=tokenizer["<S>"],
+                                        logits_processor=logits_processor,
+                                        stopping_criteria=StoppingCriteriaList([segment_stopping]) if segment_stopping is not None else None)
+    record_decode_latency((id(model), *input_tokens.shape, num_return_sequences), time.perf_counter() - start_time)
+    if segment_stopping is not None:
+        output_tokens = segment_stopping.truncate(output_tokens)
+
+    refined_segments = []
+    # Decode the output tokens, skipping the padding added after <E> for shorter rows
+    for output_sequence in codec.decode_batch(output_tokens):
+        generated_sequences = parse_generation(output_sequence, add_special_tokens = True)
+
+        # Remove special tokens
+        generated_sequences = [token for token in generated_sequences if token not in ["<S>", "<E>", "<SEP>"]]
+        count_parsed_tokens(output_sequence, generated_sequences)
+        refined_segments.append(generated_sequences)
+
+    return refined_segments
+
+
+def refine_sequence_batch_cached(corrupted_sequences, batch_input_ids, tokenizer, decode_tokenizer, model, encoder_max_sequence_length, decoder_max_sequence_length, 
+                                 temperature, dynamic_padding, pad_to_multiple_of, cache, seeds, early_stopping=False, grammar_constraint=False):
+    """
+    Look up every sequence in the cache and decode the misses together. The key includes the seed of the row,
+    so different seeds never share refinements.
+    """
+    # The int8 and ONNX backends of a checkpoint sample differently from its fp32 model
+    sampling_parameters = {'model': getattr(model.config, '_name_or_path', ''), 'backend': getattr(model, 'inference_backend', 'torch'),
+                           'backend_signature': getattr(model, 'backend_signature', None), 'decoder_max_sequence_length': decoder_max_sequence_length, 
+                           'temperature': temperature, 'top_k': 50, 'top_p': 1.0, 'early_stopping': early_stopping, 
+                           'grammar_constraint': grammar_constraint}
+    keys = [cache.get_key(input_ids, sampling_parameters, seed) for input_ids, seed in zip(batch_input_ids, seeds)]
+    refined_segments = [cache.get(key) for key in keys]
+    missing = [n for n, refined_segment in enumerate(refined_segments) if refined_segment is None]
+    if len(missing) == 0:
+        return refined_segments
+
+    # Seeded rows never touch the global RNG and decode the same way in any batch
+    decoded_segments = refine_sequence_batch([corrupted_sequences[n] for n in missing], tokenizer, decode_tokenizer, model, encoder_max_sequence_length, 
+                                             decoder_max_sequence_length, temperature=temperature, dynamic_padding=dynamic_padding, pad_to_multiple_of=pad_to_multiple_of, 
+                                             seeds=[seeds[n] for n in missing], early_stopping=early_stopping, grammar_constraint=grammar_constraint)
+    for n, refined_segment in zip(missing, decoded_segments):
+        refined_segments[n] = refined_segment
+    cache.put_many([(keys[n], refined_segments[n]) for n in missing])
+
+    return refined_segments
+
+
+def refine_variations_batch(variation_sequences, tokenizer, decode_tokenizer, model, encoder_max_sequence_length, decoder_max_sequence_length, temperature=1.0, logits_processor=None, 
+                            dynamic_padding=False, pad_to_multiple_of=64, cache=None, variation_seeds=None, early_stopping=False, 
+                            grammar_constraint=False):
+    """
+    Refine a group of corrupted sequences for every variation of a piece, variation_sequences[v][n] being segment n of
+    variation v and variation_seeds[v][n] its seed. While the variations still share their sequence state their inputs
+    are equal, so every segment is encoded once and sampled once per variation. Otherwise the rows of all variations
+    are refined in one call. Returns the refined segments of every variation.
+    """
+    num_variations = len(variation_sequences)
+    n_segments = len(variation_sequences[0])
+    if num_variations > 1 and all(sequences == variation_sequences[0] for sequences in variation_sequences[1:]):
+        seeds = None if variation_seeds is None else [variation_seeds[v][n] for n in range(n_segments) for v in range(num_variations)]
+        refined_segments = refine_sequence_batch(variation_sequences[0], tokenizer, decode_tokenizer, model, encoder_max_sequence_length, decoder_max_sequence_length, 
+                                                 temperature=temperature, logits_processor=logits_processor, dynamic_padding=dynamic_padding, 
+                                                 pad_to_multiple_of=pad_to_multiple_of, seeds=seeds, num_return_sequences=num_variations, early_stopping=early_stopping, 
+                                                 grammar_constraint=grammar_constraint)
+        return [refined_segments[v::num_variations] for v in range(num_variations)]
+
+    seeds = None if variation_seeds is None else [seed for seeds in variation_seeds for seed in seeds]
+    refined_segments = refine_sequence_batch([sequence for sequences in variation_sequences for sequence in sequences], tokenizer, decode_tokenizer, model, 
+                                             encoder_max_sequence_length, decoder_max_sequence_length, temperature=temperature, logits_processor=logits_processor, 
+                                             dynamic_padding=dynamic_padding, pad_to_multiple_of=pad_to_multiple_of, cache=cache, seeds=seeds, early_stopping=early_stopping, 
+                                             grammar_constraint=grammar_constraint)
+    return [refined_segments[v * n_segments:(v + 1) * n_segments] for v in range(num_variations)]
+
+
+def plan_refinement_groups(planned_segments, context_before, batch_size=1, strict_dependencies=True):
+    """
+    Split the segments planned for corruption in one pass into groups that can be refined together.
+    With strict_dependencies, a segment never shares a group with a segment inside its context_before
+    window, so every group sees exactly the sequence state of a sequential pass.
+    """
+    groups = []
+    current_group = []
+    for t_segment_ind, corruption_type in planned_segments:
+        if len(current_group) > 0:
+            group_full = len(current_group) >= batch_size
+            depends_on_group = strict_dependencies and t_segment_ind - current_group[-1][0] <= context_before
+            if group_full or depends_on_group:
+                groups.append(current_group)
+                current_group = []
+        current_group.append((t_segment_ind, corruption_type))
+    if current_group:
+        groups.append(current_group)
+
+    return groups
+
+
+# Independent random streams of every segment of a seeded piece, 'pass' is for the choices made once per pass
+RNG_STREAMS = ['corruption', 'decoding', 'pass']
+
+
+def segment_seed(seed, pass_number, t_segment_ind, stream, variation=0):
+    """
+    Seed of one random stream of a segment in one pass of a seeded piece. It only depends on its arguments,
+    so the segment draws the same numbers whatever the batch, the processing order or the process.
+    Variation 0 has the seeds of a run without variations.
+    """
+    entropy = [seed, pass_number, t_segment_ind, RNG_STREAMS.index(stream)] + ([variation] if variation > 0 else [])
+    seed_sequence = np.random.SeedSequence(entropy)
+    return int(seed_sequence.generate_state(1, dtype=np.uint64)[0] % 2**63)
+
+
+def get_segment_rng(seed, pass_number, t_segment_ind, stream='corruption'):
+    """
+    Random generator of the corruption choices of a segment, the global random module for unseeded pieces.
+    """
+    if seed is None:
+        return random
+    return random.Random(segment_seed(seed, pass_number, t_segment_ind, stream))
+
+
+def get_variation_rngs(rng, num_variations):
+    """
+    Copies of the corruption generator of a segment for every variation. Variations corrupt a shared sequence state the
+    same way, so their encoder inputs only differ once their refinements do. An unseeded piece forks the global stream.
+    """
+    if num_variations == 1:
+        return [rng]
+    if rng is random:
+        rng = random.Random(random.getrandbits(63))
+    state = rng.getstate()
+    rngs = []
+    for _ in range(num_variations):
+        variation_rng = random.Random()
+        variation_rng.setstate(state)
+        rngs.append(variation_rng)
+
+    return rngs
+
+
+def get_decoding_seed(seed, pass_number, t_segment_ind, variation=0):
+    """
+    Sampling seed of a refined segment, None for unseeded pieces so they sample from the global torch RNG.
+    """
+    if seed is None:
+        return None
+    return segment_seed(seed, pass_number, t_segment_ind, 'decoding', variation=variation)
+
+
+def get_variation_seeds(seed, pass_number, t_segment_inds, num_variations):
+    """
+    Sampling seeds of the segments of a group for every variation, None for unseeded pieces.
+    """
+    if seed is None:
+        return None
+    return [[get_decoding_seed(seed, pass_number, t_segment_ind, variation=v) for t_segment_ind in t_segment_inds] for v in range(num_variations)]
+
+
+def generate_one_pass(tokenized_sequences, fusion_model, configs, 
                       t_segment_start, convert_to, context_before, 
                       context_after, corruption_type, corruption_rate, 
-                      tokenizer, decode_tokenizer, quiet, temperature=1.0, end_original=True, t_segment_stop=-1):
+                      tokenizer, decode_tokenizer, quiet, temperature=1.0, end_original=True, t_segment_stop=-1,
+                      batch_size=1, strict_dependencies=True, seed=None, pass_number=1):
+    """
+    Refine one pass over the sequences of every variation of a piece. The variations share the corruption plan
+    of the pass and are refined together. Returns the refined sequences.
+    """
 
     # Get the encoder and decoder max sequence length
     encoder_max_sequence_length = configs['model']['encoder_max_sequence_length']
     decoder_max_sequence_length = configs['model']['decoder_max_sequence_length']
+    # Pad encoder inputs to their true length instead of the maximum
+    dynamic_padding = configs.get('inference', {}).get('dynamic_padding', False)
+    pad_to_multiple_of = configs.get('inference', {}).get('pad_to_multiple_of', 64)
+    # Stop decoding segments once they are complete
+    early_stopping = configs.get('inference', {}).get('early_stopping', False)
+    # Only sample tokens that parse into notes
+    grammar_constraint = configs.get('inference', {}).get('grammar_constraint', False)
+    reset_decoding_stats()
+    # Reuse refinements of identical inputs from earlier seeded runs, unseeded runs draw fresh samples
+    num_variations = len(tokenized_sequences)
+    refinement_cache = get_refinement_cache(configs) if seed is not None else None
     
     corruption_obj = DataCorruption()
-    separated_sequence = corruption_obj.seperateitems(tokenized_sequence)
-    # Get the indices of the novelty tokens
-    novelty_segments = [n for n, i in enumerate(separated_sequence) if '<N>' in i]
-    all_segment_indices, _, _, _ = corruption_obj.get_segment_to_corrupt(separated_sequence, t_segment_ind=t_segment_start, exclude_idx=novelty_segments)
+    # Index the segments once, novelty segments are never corrupted
+    segment_stores = [SegmentStore(tokenized_sequence, corruption_obj) for tokenized_sequence in tokenized_sequences]
+    all_segment_indices = segment_stores[0].segment_indices
 
     if end_original:
         n_iterations = len(all_segment_indices) - 1
     else:
         n_iterations = len(all_segment_indices)
 
-    t_segment_ind = t_segment_start
     if t_segment_stop <= t_segment_start:
         t_segment_stop = n_iterations
         # print("t_segment_stop is less than or equal to t_segment_start. Setting t_segment_stop to the end of the sequence.")
 
-    # Initialize tqdm
-    progress_bar = tqdm(total=n_iterations, disable=quiet)
-    jump_every = 1
-
-    while t_segment_ind < n_iterations:
-
-        if t_segment_ind >= t_segment_stop:
-            break
-
-        if random.random() < corruption_rate:
+    # Plan which segments get corrupted in this pass, a seeded piece draws every choice of a segment from its own stream
+    planned_segments = []
+    segment_rngs = {}
+    for t_segment_ind in range(t_segment_start, min(n_iterations, t_segment_stop)):
+        rng = get_segment_rng(seed, pass_number, t_segment_ind)
+        if rng.random() < corruption_rate:
             if corruption_type == "random":
-                corruption_type_tmp = random.choice(list(corruption_obj.corruption_functions.keys()))
-                output_dict = corruption_obj.apply_random_corruption(tokenized_sequence, context_before=context_before, context_after=context_after, meta_data=[convert_to], t_segment_ind=t_segment_ind, inference=False, corruption_type=corruption_type_tmp, run_corruption=True, exclude_idx=novelty_segments)
+                planned_segments.append((t_segment_ind, rng.choice(list(corruption_obj.corruption_functions.keys()))))
             else:
-                output_dict = corruption_obj.apply_random_corruption(tokenized_sequence, context_before=context_before, context_after=context_after, meta_data=[convert_to], t_segment_ind=t_segment_ind, inference=False, corruption_type=corruption_type, run_corruption=True, exclude_idx=novelty_segments)
-            index = output_dict['index']
-            corrupted_sequence = output_dict['corrupted_sequence']
-            corrupted_sequence = unflatten_corrupted(corrupted_sequence)
-            refined_segment = refine_sequence(corrupted_sequence, tokenizer, decode_tokenizer, fusion_model, encoder_max_sequence_length, decoder_max_sequence_length, temperature=temperature)
-            flattened_refined_segment = flatten(refined_segment, add_special_tokens=True)
-            separated_sequence[index] = flattened_refined_segment
-            tokenized_sequence = corruption_obj.concatenate_list(separated_sequence)
-            if not quiet:
+                planned_segments.append((t_segment_ind, corruption_type))
+            segment_rngs[t_segment_ind] = get_variation_rngs(rng, num_variations)
+
+    # Group the planned segments so each group is refined with one generate call
+    refinement_groups = plan_refinement_groups(planned_segments, context_before, batch_size=batch_size, strict_dependencies=strict_dependencies)
+
+    # Initialize tqdm
+    progress_bar = tqdm(total=len(planned_segments), disable=quiet)
+
+    for group in refinement_groups:
+        # Corrupt every segment of the group against the same sequence state of each variation
+        variation_output_dicts = []
+        for v, segment_store in enumerate(segment_stores):
+            variation_output_dicts.append([segment_store.corrupt(t_segment_ind, context_before=context_before, context_after=context_after, meta_data=[convert_to], inference=False, corruption_type=corruption_type_tmp, run_corruption=True, 
+                                                                 rng=segment_rngs[t_segment_ind][v])
+                                           for t_segment_ind, corruption_type_tmp in group])
+
+        variation_refined_segments = refine_variations_batch([[output_dict['corrupted_sequence'] for output_dict in output_dicts] for output_dicts in variation_output_dicts], 
+                                                             tokenizer, decode_tokenizer, fusion_model, encoder_max_sequence_length, decoder_max_sequence_length, temperature=temperature, 
+                                                             dynamic_padding=dynamic_padding, pad_to_multiple_of=pad_to_multiple_of, cache=refinement_cache, 
+                                                             variation_seeds=get_variation_seeds(seed, pass_number, [t_segment_ind for t_segment_ind, _ in group], num_variations), 
+                                                             early_stopping=early_stopping, grammar_constraint=grammar_constraint)
+
+        for segment_store, output_dicts, refined_segments in zip(segment_stores, variation_output_dicts, variation_refined_segments):
+            for output_dict, refined_segment in zip(output_dicts, refined_segments):
+                flattened_refined_segment = flatten(refined_segment, add_special_tokens=True)
+                segment_store.replace(output_dict['index'], flattened_refined_segment)
+        if not quiet:
+            for (t_segment_ind, _), output_dict in zip(group, variation_output_dicts[0]):
                 print("Corrupted t_segment_ind:", t_segment_ind, "Corruption type:", output_dict['corruption_type'])
-        
-        t_segment_ind += jump_every
+
         # Update the progress bar
-        progress_bar.update(jump_every)
+        progress_bar.update(len(group))
 
     progress_bar.close()
+    if not quiet:
+        print_decoding_stats()
 
-    return tokenized_sequence
+    return [segment_store.to_sequence() for segment_store in segment_stores]
 
 
-def get_midi_notes_from_tick(midi_dict, midi_data, peak_times, quiet):
-    novel_note_numbers = []
-    novel_notes = []
-    for n, note in enumerate(midi_dict.note_msgs):
-        if len(peak_times) > 0:
-            tick = note['tick']
-            # tick_to_time
-            time_in_sec = pretty_midi.PrettyMIDI.tick_to_time(midi_data, tick)
+def get_novel_note_numbers(midi_file_path, audio_file_path, mid, tokenized_sequence, configs, quiet):
+    """
+    Numbers of the notes that start novel segments, found with the audio (SsmNet) or the symbolic novelty backend.
+    """
+    novelty_backend = configs['generation'].get('novelty_backend', 'audio')
+    if novelty_backend == 'audio' and (audio_file_path is None or audio_file_path == ""):
+        return []
 
-            if time_in_sec > peak_times[0]:
-                if not quiet:
-                    print(f"Note {n} is at {time_in_sec} seconds")
-                novel_note_numbers.append(n)
-                novel_notes.append(note)
-                peak_times = np.delete(peak_times, 0)
-        else:
-            return novel_note_numbers, novel_notes
+    ssm_config_file = "configs/config_ssm.yaml"
+    n_t_segments = len([t for t in tokenized_sequence if t == "<T>"])
+    novel_peaks_pct = configs['generation']['novel_peaks_pct']
+    n_novel_peaks = np.ceil(novel_peaks_pct * n_t_segments).astype(int)
+    if not quiet:
+        print("Number of novel peaks:", n_novel_peaks)
+    pretty_midi_data = pretty_midi.PrettyMIDI(midi_file_path)
+    if novelty_backend == 'symbolic':
+        segment_novelty = Symbolic_Novelty(ssm_config_file)
+        peak_times = segment_novelty.get_peak_timestamps(pretty_midi_data, n_novel_peaks)
+    else:
+        segment_novelty = Segment_Novelty(ssm_config_file, audio_file_path, cache_folder=configs.get('inference', {}).get('novelty_cache_folder'))
+        peak_times = segment_novelty.get_peak_timestamps(audio_file_path, n_novel_peaks)
+    novel_note_numbers, novel_notes = get_midi_notes_from_tick(mid, pretty_midi_data, peak_times, quiet)
 
+    return novel_note_numbers
 
-def add_novelty_segment_token(tokenized_sequence, novel_note_numbers):
-    note_number = 0
-    insertion_points = []
-    for note_idx, note in enumerate(tokenized_sequence):
-        if type(note) == list:
-            if note_number in novel_note_numbers:
-                insertion_points.append(note_idx)
-            note_number += 1
-    
-    new_tokenized_sequence = []
-    for idx, token in enumerate(tokenized_sequence):
-        if idx in insertion_points:
-            new_tokenized_sequence.append("<N>")
-        new_tokenized_sequence.append(token)
-    
-    return new_tokenized_sequence
+
+def get_variation_filename(midi_file_path, variation=0):
+    """
+    Name of the generated file of a variation, variation 0 is named like the output of a run without variations.
+    """
+    filename = os.path.basename(midi_file_path)
+    if variation == 0:
+        return "generated_" + filename
+    stem, extension = os.path.splitext(filename)
+    return f"generated_{stem}_variation_{variation}{extension}"
 
 
-def write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer):
+def write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer, variation=0):
     sequence = copy.deepcopy(tokenized_sequence)
     # Unflatten the tokenized sequence
     sequence = unflatten_for_aria(sequence)
@@ -169,18 +403,33 @@ def write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer
     generated_sequence = [('prefix', 'instrument', 'piano'), "<S>"] + sequence + ["<E>"]
     mid_dict = aria_tokenizer.detokenize(generated_sequence)
     generated_mid = mid_dict.to_midi()
-    filename = os.path.basename(midi_file_path)
     # Create output folder if it does not exist
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    generated_mid.save(os.path.join(output_folder, "generated_" + filename))
+    generated_mid.save(os.path.join(output_folder, get_variation_filename(midi_file_path, variation)))
+
+
+def should_write_pass(write_intermediate_passes, pass_number):
+    """
+    write_intermediate_passes is either a bool for every pass or a collection of the pass numbers to write.
+    """
+    if isinstance(write_intermediate_passes, bool):
+        return write_intermediate_passes
+    return pass_number in write_intermediate_passes
 
 
 def generate(midi_file_path, audio_file_path, fusion_model, configs, novel_peaks_pct,
              t_segment_start, convert_to, context_before, context_after, 
              corruption_passes, tokenizer, decode_tokenizer, output_folder, 
-             save_original=False, quiet=False, write_intermediate_passes=False, temperature=1.0, end_original=True, t_segment_stop=-1):
-    
+             save_original=False, quiet=False, write_intermediate_passes=False, temperature=1.0, end_original=True, t_segment_stop=-1,
+             batch_size=1, strict_dependencies=True, seed=None, num_variations=1):
+    """
+    Refine a piece over the corruption passes. With a seed, every segment of every pass corrupts and samples from
+    its own random streams, so sequential, batched and parallel runs of the piece produce the same MIDI file.
+    With num_variations, the piece is tokenized and segmented once and every variation evolves its own sequence,
+    refined together with the others. One MIDI file is written per variation.
+    """
+
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
@@ -203,19 +452,7 @@ def generate(midi_file_path, audio_file_path, fusion_model, configs, novel_peaks
     tokenized_sequence = tokenized_sequence[2:-1]
 
     # Novelty based segmentation
-    if audio_file_path is None or audio_file_path == "":
-        novel_note_numbers = []
-    else:
-        ssm_config_file = "configs/config_ssm.yaml"
-        n_t_segments = len([t for t in tokenized_sequence if t == "<T>"])
-        novel_peaks_pct = configs['generation']['novel_peaks_pct']
-        n_novel_peaks = np.ceil(novel_peaks_pct * n_t_segments).astype(int)
-        if not quiet:
-            print("Number of novel peaks:", n_novel_peaks)
-        segment_novelty = Segment_Novelty(ssm_config_file, audio_file_path)
-        peak_times = segment_novelty.get_peak_timestamps(audio_file_path, n_novel_peaks)
-        pretty_midi_data = pretty_midi.PrettyMIDI(midi_file_path)
-        novel_note_numbers, novel_notes = get_midi_notes_from_tick(mid, pretty_midi_data, peak_times, quiet)
+    novel_note_numbers = get_novel_note_numbers(midi_file_path, audio_file_path, mid, tokenized_sequence, configs, quiet)
 
     # Flatten the tokenized sequence
     tokenized_sequence = flatten(tokenized_sequence, add_special_tokens=True)
@@ -227,6 +464,7 @@ def generate(midi_file_path, audio_file_path, fusion_model, configs, novel_peaks
     passes = len(corruption_passes.keys())
     data_corruption_obj = DataCorruption()
     # corruptions = list(data_corruption_obj.corruption_functions.keys())
+    tokenized_sequences = [tokenized_sequence] * num_variations
     for i in range(passes):
         if not quiet:
             print("Pass:", i + 1)
@@ -235,22 +473,30 @@ def generate(midi_file_path, audio_file_path, fusion_model, configs, novel_peaks
         #     corruption_type = random.choice(corruptions)
         corruption_rate = corruption_passes['pass_' + str(i + 1)]['corruption_rate']
         # Generate the sequence
-        tokenized_sequence = generate_one_pass(tokenized_sequence, fusion_model, configs, 
-                                               t_segment_start, convert_to, context_before, 
-                                               context_after, corruption_type, corruption_rate, 
-                                               tokenizer, decode_tokenizer, quiet, temperature=temperature, 
-                                               end_original=end_original, t_segment_stop=t_segment_stop)
-
-        if write_intermediate_passes:
+        tokenized_sequences = generate_one_pass(tokenized_sequences, fusion_model, configs, 
+                                                t_segment_start, convert_to, context_before, 
+                                                context_after, corruption_type, corruption_rate, 
+                                                tokenizer, decode_tokenizer, quiet, temperature=temperature, 
+                                                end_original=end_original, t_segment_stop=t_segment_stop, 
+                                                batch_size=batch_size, strict_dependencies=strict_dependencies, seed=seed, pass_number=i + 1)
+
+        if should_write_pass(write_intermediate_passes, i + 1):
             pass_number = f"pass_{passes}"
             if pass_number in output_folder:
                 new_output_folder = output_folder.replace(pass_number, f"pass_{i + 1}")
             else:
                 new_output_folder = os.path.join(output_folder, f"pass_{i + 1}")
-            write_file(midi_file_path, new_output_folder, tokenized_sequence, aria_tokenizer)
+            for variation, tokenized_sequence in enumerate(tokenized_sequences):
+                write_file(midi_file_path, new_output_folder, tokenized_sequence, aria_tokenizer, variation=variation)
+
+    # Write the generated sequences to MIDI files
+    for variation, tokenized_sequence in enumerate(tokenized_sequences):
+        write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer, variation=variation)
 
-    # Write the generated sequence to a MIDI file
-    write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer)
+    refinement_cache = get_refinement_cache(configs)
+    if refinement_cache is not None and not quiet:
+        stats = refinement_cache.stats()
+        print(f"Refinement cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries ({stats['size_mb']:.1f} MB)")
 
 
 
@@ -281,9 +527,7 @@ if __name__ == "__main__":
     decode_tokenizer = {v: k for k, v in tokenizer.items()}
 
     # Load the fusion model
-    fusion_model = EncoderDecoderModel.from_pretrained(os.path.join(artifact_folder, "style_transfer", "fine_tuned_model"))
-    fusion_model.eval()
-    fusion_model.to("cuda" if cuda_available() else "cpu")
+    fusion_model = load_fusion_model(configs)
     print("Fusion model loaded")
 
     # Open JSON file
@@ -308,9 +552,14 @@ if __name__ == "__main__":
     temperature = configs['generation']['temperature']
     end_original = configs['generation']['end_original']
     t_segment_stop = configs['generation']['t_segment_stop']
+    batch_size = configs['generation'].get('batch_size', 1)
+    strict_dependencies = configs['generation'].get('strict_dependencies', True)
+    seed = configs['generation'].get('seed')
+    num_variations = configs['generation'].get('num_variations', 1)
 
     generate(midi_file_path, audio_file_path, fusion_model, configs, novel_peaks_pct,
              t_segment_start, convert_to, context_before, context_after, 
              corruption_passes, tokenizer, decode_tokenizer, output_folder, 
              save_original=True, quiet=False, write_intermediate_passes=write_intermediate_passes, 
-             temperature=temperature, end_original=end_original, t_segment_stop=t_segment_stop)
\ No newline at end of file
+             temperature=temperature, end_original=end_original, t_segment_stop=t_segment_stop,
+             batch_size=batch_size, strict_dependencies=strict_dependencies, seed=seed, num_variations=num_variations)
\ No newline at end of file
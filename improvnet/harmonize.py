@@ -11,257 +11,110 @@ from tqdm import tqdm
 import pretty_midi
 import torch
 from torch.nn import functional as F
-from transformers import EncoderDecoderModel
+from transformers import LogitsProcessorList
 from torch.cuda import is_available as cuda_available
 from ariautils.midi import MidiDict
 from ariautils.tokenizer import AbsTokenizer
 
-from corruptions import DataCorruption
+from corruptions import DataCorruption, SegmentStore
+from decoding import SameOnsetChordConstraint, reset_decoding_stats, print_decoding_stats
+from generation import refine_variations_batch, plan_refinement_groups, get_novel_note_numbers, get_segment_rng, get_variation_rngs, get_variation_seeds, get_variation_filename
+from refinement_cache import get_refinement_cache
+from inference import load_fusion_model
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
-from utils.utils import flatten, unflatten_corrupted, parse_generation, unflatten_for_aria, Segment_Novelty
+from utils.tokens import flatten, unflatten_for_aria, add_novelty_segment_token
 
 
-def refine_sequence_constraints(corrupted_sequence, tokenizer, decode_tokenizer, model, encoder_max_sequence_length, decoder_max_sequence_length, temperature=0.95):
-    chord_strength = 3
-    top_k = 50
-    top_p = 1.0
-    
-    # Tokenize the sequence
-    input_tokens = [tokenizer[token] for token in corrupted_sequence if token in tokenizer.keys()]
-    # Pad the sequences
-    if len(input_tokens) < encoder_max_sequence_length:
-        input_tokens = F.pad(torch.tensor(input_tokens), (0, encoder_max_sequence_length - len(input_tokens))).to(torch.int64)
-    else:
-        input_tokens = torch.tensor(input_tokens[0:encoder_max_sequence_length]).to(torch.int64)
-
-    # Attention mask based on non-padded tokens of the phrase
-    attention_mask = torch.where(input_tokens != 0, 1, 0).type(torch.bool)
-
-    # Generate the output sequence
-    with torch.no_grad():
-        input_tokens = input_tokens.unsqueeze(0).to("cuda" if cuda_available() else "cpu")
-        attention_mask = attention_mask.unsqueeze(0).to("cuda" if cuda_available() else "cpu")
-        # Initialize the output tokens
-        output_tokens = torch.tensor([[tokenizer["<S>"]]]).to(torch.int64).to("cuda" if cuda_available() else "cpu")
-        # Initialize the onset stack
-        same_onset_stack = []
-        # Initialize the constraint activation
-        activate_same_onset_constraint = False
-
-        for _ in range(decoder_max_sequence_length):
-            # Get model output
-            batch = {'input_ids': input_tokens, 'attention_mask': attention_mask}
-            outputs = model(input_ids=batch['input_ids'], attention_mask=batch['attention_mask'], decoder_input_ids=output_tokens)
-            next_token_logits = outputs.logits[:, -1, :]
-            
-            # Apply temperature
-            next_token_logits = next_token_logits / temperature   
-
-            # Apply constraints
-            if activate_same_onset_constraint:
-                # Set all tokens that are not same_onset_stack[-1] to -inf
-                include_onset_tokens = [('onset', same_onset_stack[-1][-1]), 
-                                        ('onset', same_onset_stack[-1][-1] + 10), 
-                                        ('onset', same_onset_stack[-1][-1] + 20), 
-                                        ('onset', same_onset_stack[-1][-1] + 30), 
-                                        ('onset', same_onset_stack[-1][-1] + 40), 
-                                        ('onset', same_onset_stack[-1][-1] + 50)]
-                include_onset_tokens = [token for token in include_onset_tokens if token in tokenizer]
-                include_tokens_idx = [tokenizer[token] for token in include_onset_tokens]
-                # Set all tokens that are not in include_tokens_idx to -inf
-                next_token_logits[0, [idx for idx in range(next_token_logits.shape[-1]) if idx not in include_tokens_idx]] = float('-inf')
-                activate_same_onset_constraint = False   
-            
-            # Apply top-k filtering
-            if top_k > 0:
-                top_k_logits, top_k_indices = torch.topk(next_token_logits, top_k)
-                next_token_logits[next_token_logits < top_k_logits[:, [-1]]] = float('-inf')
-            
-            # Apply top-p (nucleus) filtering
-            if top_p > 0.0:
-                sorted_logits, sorted_indices = torch.sort(next_token_logits, descending=True)
-                cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-                sorted_indices_to_remove = cumulative_probs > top_p
-                sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-                sorted_indices_to_remove[..., 0] = 0
-                indices_to_remove = sorted_indices[sorted_indices_to_remove]
-                next_token_logits[:, indices_to_remove] = float('-inf')
-            
-            # Convert logits to probabilities
-            probs = F.softmax(next_token_logits, dim=-1) 
-            
-            # Sample next token
-            next_token = torch.multinomial(probs, num_samples=1) # check shape
-            
-            # Append the next token to the sequence
-            output_tokens = torch.cat([output_tokens, next_token], dim=-1)
-
-            ### Constraints ###
-
-            # Check if the current token is an onset token
-            if "onset" in decode_tokenizer[next_token.item()]:
-                # Check if list is empty
-                if len(same_onset_stack) == 0:
-                    same_onset_stack.append(decode_tokenizer[next_token.item()])
-                # Check if the current token is close to the previous token indicating a chord
-                elif abs(same_onset_stack[-1][-1] - decode_tokenizer[next_token.item()][-1]) <= 50:
-                    same_onset_stack.append(decode_tokenizer[next_token.item()])
-            
-            # Check if we need to activate a constraint
-            if 1 <= len(same_onset_stack) < chord_strength and "piano" in decode_tokenizer[next_token.item()]:
-                activate_same_onset_constraint = True
-            elif len(same_onset_stack) >= chord_strength and "piano" in decode_tokenizer[next_token.item()]:
-                activate_same_onset_constraint = False
-
-            ### Constraints ###
-                
-            # Check if we've generated an EOS token
-            if next_token.item() == tokenizer["<E>"]:
-                break
-
-    # Decode the output tokens
-    output_sequence = [decode_tokenizer[token.item()] for token in output_tokens[0]]
-
-    generated_sequences = parse_generation(output_sequence, add_special_tokens = True)
-
-    # Remove special tokens
-    generated_sequences = [token for token in generated_sequences if token not in ["<S>", "<E>", "<SEP>"]]
-
-    return generated_sequences
-
-
-def refine_sequence(corrupted_sequence, tokenizer, decode_tokenizer, model, encoder_max_sequence_length, decoder_max_sequence_length, temperature=0.95):
-    # Tokenize the sequence
-    # input_tokens = [tokenizer[tuple(token)] if isinstance(token, list) else tokenizer[token] for token in corrupted_sequence]
-    input_tokens = [tokenizer[token] for token in corrupted_sequence if token in tokenizer.keys()]
-    # Pad the sequences
-    if len(input_tokens) < encoder_max_sequence_length:
-        input_tokens = F.pad(torch.tensor(input_tokens), (0, encoder_max_sequence_length - len(input_tokens))).to(torch.int64)
-    else:
-        input_tokens = torch.tensor(input_tokens[0:encoder_max_sequence_length]).to(torch.int64)
-
-    # Attention mask based on non-padded tokens of the phrase
-    attention_mask = torch.where(input_tokens != 0, 1, 0).type(torch.bool)
-
-    # Generate the output sequence
-    output_tokens = model.generate(input_ids=input_tokens.unsqueeze(0).to("cuda" if cuda_available() else "cpu"),
-                                    attention_mask=attention_mask.unsqueeze(0).to("cuda" if cuda_available() else "cpu"),
-                                    max_length=decoder_max_sequence_length,
-                                    num_beams=1,
-                                    early_stopping=False,
-                                    do_sample=True,
-                                    temperature=temperature,
-                                    top_k=50,
-                                    top_p=1.0,
-                                    pad_token_id=0,
-                                    eos_token_id=tokenizer["<E>"],
-                                    bos_token_id=tokenizer["<S>"])
-
-    # Decode the output tokens
-    output_sequence = [decode_tokenizer[token.item()] for token in output_tokens[0]]
-
-    generated_sequences = parse_generation(output_sequence, add_special_tokens = True)
-
-    # Remove special tokens
-    generated_sequences = [token for token in generated_sequences if token not in ["<S>", "<E>", "<SEP>"]]
-
-    return generated_sequences
-
-
-def generate_one_pass(pass_number, tokenized_sequence, fusion_model, configs, 
+def generate_one_pass(pass_number, tokenized_sequences, fusion_model, configs, 
                       t_segment_start, convert_to, context_before, 
                       context_after, corruption_type, corruption_rate, 
                       tokenizer, decode_tokenizer, quiet, use_constraints=True, 
-                      temperature=0.95, reharmonize=False, end_original=False):
+                      temperature=0.95, reharmonize=False, end_original=False, 
+                      batch_size=1, strict_dependencies=True, seed=None):
+    """
+    Harmonize one pass over the sequences of every variation of a piece and return the refined sequences.
+    """
 
     # Get the encoder and decoder max sequence length
     encoder_max_sequence_length = configs['model']['encoder_max_sequence_length']
     decoder_max_sequence_length = configs['model']['decoder_max_sequence_length']
+    # Pad encoder inputs to their true length instead of the maximum
+    dynamic_padding = configs.get('inference', {}).get('dynamic_padding', False)
+    pad_to_multiple_of = configs.get('inference', {}).get('pad_to_multiple_of', 64)
+    # Stop decoding segments once they are complete
+    early_stopping = configs.get('inference', {}).get('early_stopping', False)
+    # Only sample tokens that parse into notes
+    grammar_constraint = configs.get('inference', {}).get('grammar_constraint', False)
+    reset_decoding_stats()
+    # Reuse refinements of identical inputs from earlier seeded runs, constrained passes are not cached
+    # and unseeded runs draw fresh samples
+    num_variations = len(tokenized_sequences)
+    refinement_cache = get_refinement_cache(configs) if seed is not None else None
     
     corruption_obj = DataCorruption()
-    separated_sequence = corruption_obj.seperateitems(tokenized_sequence)
-    # Get the indices of the novelty tokens
-    novelty_segments = [n for n, i in enumerate(separated_sequence) if '<N>' in i]
-    all_segment_indices, _, _, _ = corruption_obj.get_segment_to_corrupt(separated_sequence, t_segment_ind=t_segment_start, exclude_idx=novelty_segments)
+    # Index the segments once, novelty segments are never corrupted
+    segment_stores = [SegmentStore(tokenized_sequence, corruption_obj) for tokenized_sequence in tokenized_sequences]
+    all_segment_indices = segment_stores[0].segment_indices
 
-    t_segment_ind = t_segment_start
     if end_original:
         n_iterations = len(all_segment_indices) - 1
     else:
         n_iterations = len(all_segment_indices)
-    # Initialize tqdm
-    progress_bar = tqdm(total=n_iterations, disable=quiet)
-    jump_every = 1
 
-    while t_segment_ind < n_iterations:
+    # Plan which segments get corrupted in this pass, a seeded piece draws every choice of a segment from its own stream
+    segment_rngs = {t_segment_ind: get_segment_rng(seed, pass_number, t_segment_ind) for t_segment_ind in range(t_segment_start, n_iterations)}
+    planned_segments = [(t_segment_ind, corruption_type) for t_segment_ind in range(t_segment_start, n_iterations) if segment_rngs[t_segment_ind].random() < corruption_rate]
+    variation_rngs = {t_segment_ind: get_variation_rngs(segment_rngs[t_segment_ind], num_variations) for t_segment_ind, _ in planned_segments}
 
-        if random.random() < corruption_rate:
-            if reharmonize:
-                output_dict = corruption_obj.apply_random_corruption(tokenized_sequence, context_before=context_before, context_after=context_after, meta_data=[convert_to], t_segment_ind=t_segment_ind, inference=False, corruption_type=corruption_type, run_corruption=True, exclude_idx=novelty_segments)
-            else:
-                output_dict = corruption_obj.apply_random_corruption(tokenized_sequence, context_before=context_before, context_after=context_after, meta_data=[convert_to], t_segment_ind=t_segment_ind, inference=False, corruption_type=corruption_type, run_corruption=False, exclude_idx=novelty_segments)
-            index = output_dict['index']
-            corrupted_sequence = output_dict['corrupted_sequence']
-            corrupted_sequence = unflatten_corrupted(corrupted_sequence)
-            if pass_number == 0 and use_constraints: #and np.random.rand() < 0.85
-                refined_segment = refine_sequence_constraints(corrupted_sequence, tokenizer, decode_tokenizer, fusion_model, encoder_max_sequence_length, decoder_max_sequence_length, temperature=temperature)
-            else:
-                refined_segment = refine_sequence(corrupted_sequence, tokenizer, decode_tokenizer, fusion_model, encoder_max_sequence_length, decoder_max_sequence_length, temperature=temperature)
-            flattened_refined_segment = flatten(refined_segment, add_special_tokens=True)
-            separated_sequence[index] = flattened_refined_segment
-            tokenized_sequence = corruption_obj.concatenate_list(separated_sequence)
-            if not quiet:
-                print("Corrupted t_segment_ind:", t_segment_ind, "Corruption type:", output_dict['corruption_type'])
-        
-        t_segment_ind += jump_every
-        # Update the progress bar
-        progress_bar.update(jump_every)
+    # Group the planned segments so each group is refined with one generate call
+    refinement_groups = plan_refinement_groups(planned_segments, context_before, batch_size=batch_size, strict_dependencies=strict_dependencies)
 
-    progress_bar.close()
+    if pass_number == 0 and use_constraints:
+        chord_constraint = SameOnsetChordConstraint(tokenizer, chord_strength=3)
 
-    return tokenized_sequence
-
-
-def get_midi_notes_from_tick(midi_dict, midi_data, peak_times, quiet):
-    novel_note_numbers = []
-    novel_notes = []
-    for n, note in enumerate(midi_dict.note_msgs):
-        if len(peak_times) > 0:
-            tick = note['tick']
-            # tick_to_time
-            time_in_sec = pretty_midi.PrettyMIDI.tick_to_time(midi_data, tick)
-
-            if time_in_sec > peak_times[0]:
-                if not quiet:
-                    print(f"Note {n} is at {time_in_sec} seconds")
-                novel_note_numbers.append(n)
-                novel_notes.append(note)
-                peak_times = np.delete(peak_times, 0)
+    # Initialize tqdm
+    progress_bar = tqdm(total=len(planned_segments), disable=quiet)
+
+    for group in refinement_groups:
+        # Corrupt every segment of the group against the same sequence state of each variation
+        variation_output_dicts = []
+        for v, segment_store in enumerate(segment_stores):
+            variation_output_dicts.append([segment_store.corrupt(t_segment_ind, context_before=context_before, context_after=context_after, meta_data=[convert_to], inference=False, corruption_type=corruption_type, run_corruption=reharmonize, 
+                                                                 rng=variation_rngs[t_segment_ind][v])
+                                           for t_segment_ind, _ in group])
+        variation_sequences = [[output_dict['corrupted_sequence'] for output_dict in output_dicts] for output_dicts in variation_output_dicts]
+
+        variation_seeds = get_variation_seeds(seed, pass_number, [t_segment_ind for t_segment_ind, _ in group], num_variations)
+        if pass_number == 0 and use_constraints: #and np.random.rand() < 0.85
+            variation_refined_segments = refine_variations_batch(variation_sequences, tokenizer, decode_tokenizer, fusion_model, encoder_max_sequence_length, decoder_max_sequence_length, temperature=temperature, 
+                                                                 logits_processor=LogitsProcessorList([chord_constraint]), dynamic_padding=dynamic_padding, pad_to_multiple_of=pad_to_multiple_of, 
+                                                                 variation_seeds=variation_seeds, early_stopping=early_stopping, grammar_constraint=grammar_constraint)
         else:
-            return novel_note_numbers, novel_notes
+            variation_refined_segments = refine_variations_batch(variation_sequences, tokenizer, decode_tokenizer, fusion_model, encoder_max_sequence_length, decoder_max_sequence_length, temperature=temperature, 
+                                                                 dynamic_padding=dynamic_padding, pad_to_multiple_of=pad_to_multiple_of, cache=refinement_cache, variation_seeds=variation_seeds, 
+                                                                 early_stopping=early_stopping, grammar_constraint=grammar_constraint)
+
+        for segment_store, output_dicts, refined_segments in zip(segment_stores, variation_output_dicts, variation_refined_segments):
+            for output_dict, refined_segment in zip(output_dicts, refined_segments):
+                flattened_refined_segment = flatten(refined_segment, add_special_tokens=True)
+                segment_store.replace(output_dict['index'], flattened_refined_segment)
+        if not quiet:
+            for (t_segment_ind, _), output_dict in zip(group, variation_output_dicts[0]):
+                print("Corrupted t_segment_ind:", t_segment_ind, "Corruption type:", output_dict['corruption_type'])
 
+        # Update the progress bar
+        progress_bar.update(len(group))
 
-def add_novelty_segment_token(tokenized_sequence, novel_note_numbers):
-    note_number = 0
-    insertion_points = []
-    for note_idx, note in enumerate(tokenized_sequence):
-        if type(note) == list:
-            if note_number in novel_note_numbers:
-                insertion_points.append(note_idx)
-            note_number += 1
-    
-    new_tokenized_sequence = []
-    for idx, token in enumerate(tokenized_sequence):
-        if idx in insertion_points:
-            new_tokenized_sequence.append("<N>")
-        new_tokenized_sequence.append(token)
-    
-    return new_tokenized_sequence
+    progress_bar.close()
+    if not quiet:
+        print_decoding_stats()
 
+    return [segment_store.to_sequence() for segment_store in segment_stores]
 
-def write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer):
+
+def write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer, variation=0):
     sequence = copy.deepcopy(tokenized_sequence)
     # Unflatten the tokenized sequence
     sequence = unflatten_for_aria(sequence)
@@ -273,19 +126,24 @@ def write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer
     generated_sequence = [('prefix', 'instrument', 'piano'), "<S>"] + sequence + ["<E>"]
     mid_dict = aria_tokenizer.detokenize(generated_sequence)
     generated_mid = mid_dict.to_midi()
-    filename = os.path.basename(midi_file_path)
     # Create output folder if it does not exist
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    generated_mid.save(os.path.join(output_folder, "generated_" + filename))
+    generated_mid.save(os.path.join(output_folder, get_variation_filename(midi_file_path, variation)))
 
 
 def harmonize(midi_file_path, audio_file_path, fusion_model, configs, novel_peaks_pct,
              t_segment_start, convert_to, context_before, context_after, 
              corruption_passes, tokenizer, decode_tokenizer, output_folder, 
              save_original=False, quiet=False, write_intermediate_passes=False, 
-             use_constraints=True, temperature=0.95, reharmonize=False, end_original=False):
-    
+             use_constraints=True, temperature=0.95, reharmonize=False, end_original=False, 
+             batch_size=1, strict_dependencies=True, seed=None, num_variations=1):
+    """
+    Harmonize the melody of a piece over the corruption passes, the first one with the chord constraint if use_constraints.
+    With a seed, every segment of every pass corrupts and samples from its own random streams. With num_variations,
+    one MIDI file is written per variation and the variations are harmonized together.
+    """
+
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
@@ -308,19 +166,7 @@ def harmonize(midi_file_path, audio_file_path, fusion_model, configs, novel_peak
     tokenized_sequence = tokenized_sequence[2:-1]
 
     # Novelty based segmentation
-    if audio_file_path is None or audio_file_path == "":
-        novel_note_numbers = []
-    else:
-        ssm_config_file = "configs/config_ssm.yaml"
-        n_t_segments = len([t for t in tokenized_sequence if t == "<T>"])
-        novel_peaks_pct = configs['generation']['novel_peaks_pct']
-        n_novel_peaks = np.ceil(novel_peaks_pct * n_t_segments).astype(int)
-        if not quiet:
-            print("Number of novel peaks:", n_novel_peaks)
-        segment_novelty = Segment_Novelty(ssm_config_file, audio_file_path)
-        peak_times = segment_novelty.get_peak_timestamps(audio_file_path, n_novel_peaks)
-        pretty_midi_data = pretty_midi.PrettyMIDI(midi_file_path)
-        novel_note_numbers, novel_notes = get_midi_notes_from_tick(mid, pretty_midi_data, peak_times, quiet)
+    novel_note_numbers = get_novel_note_numbers(midi_file_path, audio_file_path, mid, tokenized_sequence, configs, quiet)
 
     # Flatten the tokenized sequence
     tokenized_sequence = flatten(tokenized_sequence, add_special_tokens=True)
@@ -332,34 +178,38 @@ def harmonize(midi_file_path, audio_file_path, fusion_model, configs, novel_peak
     passes = len(corruption_passes.keys())
     data_corruption_obj = DataCorruption()
     corruptions = list(data_corruption_obj.corruption_functions.keys())
+    tokenized_sequences = [tokenized_sequence] * num_variations
     for i in range(passes):
         if not quiet:
             print("Pass:", i + 1)
         corruption_type = corruption_passes['pass_' + str(i + 1)]['corruption_type']
         if corruption_type == "random":
-            corruption_type = random.choice(corruptions)
+            corruption_type = get_segment_rng(seed, i, t_segment_start, stream='pass').choice(corruptions)
         corruption_rate = corruption_passes['pass_' + str(i + 1)]['corruption_rate']
         # Generate the sequence
         if i == 0:
             if use_constraints:                
                 # Generate the first pass without any context
-                tokenized_sequence = generate_one_pass(i, tokenized_sequence, fusion_model, configs, 
+                tokenized_sequences = generate_one_pass(i, tokenized_sequences, fusion_model, configs, 
                                                 t_segment_start, convert_to, context_before, 
                                                 0, corruption_type, corruption_rate, 
                                                 tokenizer, decode_tokenizer, quiet, 
-                                                use_constraints=use_constraints, temperature=temperature, reharmonize=reharmonize, end_original=end_original)
+                                                use_constraints=use_constraints, temperature=temperature, reharmonize=reharmonize, end_original=end_original, 
+                                                batch_size=batch_size, strict_dependencies=strict_dependencies, seed=seed)
             else:
-                tokenized_sequence = generate_one_pass(i, tokenized_sequence, fusion_model, configs, 
+                tokenized_sequences = generate_one_pass(i, tokenized_sequences, fusion_model, configs, 
                                                t_segment_start, convert_to, context_before, 
                                                context_after, corruption_type, corruption_rate, 
                                                tokenizer, decode_tokenizer, quiet, 
-                                               use_constraints=use_constraints, temperature=temperature, reharmonize=reharmonize, end_original=end_original)
+                                               use_constraints=use_constraints, temperature=temperature, reharmonize=reharmonize, end_original=end_original, 
+                                               batch_size=batch_size, strict_dependencies=strict_dependencies, seed=seed)
         else:
-            tokenized_sequence = generate_one_pass(i, tokenized_sequence, fusion_model, configs, 
+            tokenized_sequences = generate_one_pass(i, tokenized_sequences, fusion_model, configs, 
                                                t_segment_start, convert_to, context_before, 
                                                context_after, corruption_type, corruption_rate, 
                                                tokenizer, decode_tokenizer, quiet, 
-                                               use_constraints=use_constraints, temperature=temperature, reharmonize=reharmonize, end_original=end_original)
+                                               use_constraints=use_constraints, temperature=temperature, reharmonize=reharmonize, end_original=end_original, 
+                                               batch_size=batch_size, strict_dependencies=strict_dependencies, seed=seed)
 
         if write_intermediate_passes:
             pass_number = f"pass_{passes}"
@@ -367,11 +217,13 @@ def harmonize(midi_file_path, audio_file_path, fusion_model, configs, novel_peak
                 new_output_folder = output_folder.replace(pass_number, f"pass_{i + 1}")
             else:
                 new_output_folder = os.path.join(output_folder, f"pass_{i + 1}")
-            write_file(midi_file_path, new_output_folder, tokenized_sequence, aria_tokenizer)
+            for variation, tokenized_sequence in enumerate(tokenized_sequences):
+                write_file(midi_file_path, new_output_folder, tokenized_sequence, aria_tokenizer, variation=variation)
 
     if not write_intermediate_passes:
-        # Write the generated sequence to a MIDI file
-        write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer)
+        # Write the generated sequences to MIDI files
+        for variation, tokenized_sequence in enumerate(tokenized_sequences):
+            write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer, variation=variation)
 
 
 
@@ -402,9 +254,7 @@ if __name__ == "__main__":
     decode_tokenizer = {v: k for k, v in tokenizer.items()}
 
     # Load the fusion model
-    fusion_model = EncoderDecoderModel.from_pretrained(os.path.join(artifact_folder, "style_transfer", "fine_tuned_model"))
-    fusion_model.eval()
-    fusion_model.to("cuda" if cuda_available() else "cpu")
+    fusion_model = load_fusion_model(configs)
     print("Fusion model loaded")
 
     # Open JSON file
@@ -430,9 +280,14 @@ if __name__ == "__main__":
     temperature = configs['generation']['temperature']
     reharmonize = configs['generation']['reharmonize']
     end_original = configs['generation']['end_original']
+    batch_size = configs['generation'].get('batch_size', 1)
+    strict_dependencies = configs['generation'].get('strict_dependencies', True)
+    seed = configs['generation'].get('seed')
+    num_variations = configs['generation'].get('num_variations', 1)
 
     harmonize(midi_file_path, audio_file_path, fusion_model, configs, novel_peaks_pct,
              t_segment_start, convert_to, context_before, context_after, 
              corruption_passes, tokenizer, decode_tokenizer, output_folder, 
              save_original=False, quiet=False, write_intermediate_passes=write_intermediate_passes, 
-             use_constraints=use_constraints, temperature=temperature, reharmonize=reharmonize, end_original=end_original)
\ No newline at end of file
+             use_constraints=use_constraints, temperature=temperature, reharmonize=reharmonize, end_original=end_original, 
+             batch_size=batch_size, strict_dependencies=strict_dependencies, seed=seed, num_variations=num_variations)
\ No newline at end of file
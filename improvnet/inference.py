@@ -0,0 +1,277 @@
+import os
+import json
+import yaml
+import argparse
+import mmap
+import struct
+import pickle
+import torch
+from transformers import EncoderDecoderModel, EncoderDecoderConfig
+from transformers.modeling_utils import no_init_weights
+from torch.cuda import is_available as cuda_available
+
+
+# Tensor dtypes of the safetensors format
+SAFETENSORS_DTYPES = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+# Inference backends of the fusion model: fp32 eager torch, int8 dynamic quantization of the Linear layers on CPU,
+# or the exported encoder and decoder graphs run by ONNX Runtime on CPU
+BACKENDS = ['torch', 'int8', 'onnx']
+# Process-wide inference settings, set from the inference configs by configure_inference.
+# length_buckets are the padded encoder lengths of a compiled model, None without compilation.
+INFERENCE_SETTINGS = {'inference_mode': True, 'length_buckets': None}
+
+
+def load_tokenizer(configs):
+    """
+    Load the tokenizer dictionary of the fusion model and its reverse.
+    """
+    artifact_folder = configs["raw_data"]["artifact_folder"]
+    with open(os.path.join(artifact_folder, "style_transfer", "vocab_corrupted.pkl"), "rb") as f:
+        tokenizer = pickle.load(f)
+
+    # Reverse the tokenizer
+    decode_tokenizer = {v: k for k, v in tokenizer.items()}
+
+    return tokenizer, decode_tokenizer
+
+
+def get_model_folder(configs):
+    return os.path.join(configs["raw_data"]["artifact_folder"], "style_transfer", "fine_tuned_model")
+
+
+def get_safetensors_file(configs):
+    """
+    Path of the safetensors weights of the fine-tuned model, see write_safetensors_file.
+    """
+    return os.path.join(get_model_folder(configs), "model.safetensors")
+
+
+def write_safetensors_file(configs):
+    """
+    Write the safetensors weights of the fine-tuned model next to the checkpoint if it only has a .bin file.
+    Run once through this module's command line, loading never writes into the artifact folder.
+    """
+    model_folder = get_model_folder(configs)
+    safetensors_file = get_safetensors_file(configs)
+    if not os.path.exists(safetensors_file):
+        fusion_model = EncoderDecoderModel.from_pretrained(model_folder)
+        fusion_model.save_pretrained(model_folder, safe_serialization=True)
+        print("Fine-tuned weights written to", safetensors_file)
+
+    return safetensors_file
+
+
+def mmap_state_dict(safetensors_file):
+    """
+    Map the tensors of a safetensors file copy-on-write into memory without copying them.
+    Every process mapping the same file shares its pages through the page cache until it writes to a tensor,
+    which then gets a private copy of the written pages and never changes the file.
+    """
+    with open(safetensors_file, "rb") as f:
+        header_length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_length))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    state_dict = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info['dtype']]
+        start, end = info['data_offsets']
+        if end == start:
+            state_dict[name] = torch.empty(info['shape'], dtype=dtype)
+            continue
+        count = (end - start) // torch.tensor([], dtype=dtype).element_size()
+        state_dict[name] = torch.frombuffer(buffer, dtype=dtype, count=count, offset=8 + header_length + start).view(info['shape'])
+
+    return state_dict
+
+
+def get_weights_signature(model_folder):
+    """
+    Size and modification time of the fine-tuned weights, to tell whether a model derived from them is stale.
+    """
+    for weights_file in ["model.safetensors", "pytorch_model.bin"]:
+        weights_path = os.path.join(model_folder, weights_file)
+        if os.path.exists(weights_path):
+            return [weights_file, os.path.getsize(weights_path), os.path.getmtime(weights_path)]
+    raise FileNotFoundError(f"No fine-tuned weights in {model_folder}")
+
+
+def quantize_fusion_model(fusion_model):
+    """
+    Int8 dynamic quantization: Linear weights are stored in int8 and activations are quantized per call.
+    """
+    return torch.ao.quantization.quantize_dynamic(fusion_model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_quantized_fusion_model(configs):
+    """
+    Load the int8 fusion model from model_int8.pt next to the checkpoint. The fp32 weights are quantized
+    and the file written again whenever they changed since it was written.
+    """
+    model_folder = get_model_folder(configs)
+    quantized_file = os.path.join(model_folder, "model_int8.pt")
+    signature = get_weights_signature(model_folder)
+    fusion_model = None
+    if os.path.exists(quantized_file):
+        # Quantized modules hold packed weights, so the whole module is pickled
+        checkpoint = torch.load(quantized_file, weights_only=False)
+        if checkpoint['signature'] == signature:
+            fusion_model = checkpoint['model'].eval()
+    if fusion_model is None:
+        fusion_model = EncoderDecoderModel.from_pretrained(model_folder)
+        fusion_model.eval()
+        fusion_model = quantize_fusion_model(fusion_model)
+        torch.save({'signature': signature, 'model': fusion_model}, quantized_file)
+        print("Int8 model written to", quantized_file)
+
+    # Refinement cache keys tell the backends apart
+    fusion_model.inference_backend = 'int8'
+    fusion_model.backend_signature = signature
+
+    return fusion_model
+
+
+def get_length_buckets(encoder_max_sequence_length, pad_to_multiple_of=64):
+    """
+    Padded encoder lengths of a compiled model: pad_to_multiple_of doubled up to encoder_max_sequence_length.
+    """
+    length_buckets = []
+    length = pad_to_multiple_of
+    while length < encoder_max_sequence_length:
+        length_buckets.append(length)
+        length *= 2
+    return length_buckets + [encoder_max_sequence_length]
+
+
+def configure_inference(configs):
+    """
+    Apply the inference configs to this process: inference mode for refinement and classifier calls, and the
+    intra-op threads of torch with num_threads.
+    """
+    inference_configs = configs.get('inference', {})
+    INFERENCE_SETTINGS['inference_mode'] = inference_configs.get('inference_mode', True)
+    INFERENCE_SETTINGS['length_buckets'] = None
+    if inference_configs.get('num_threads') is not None:
+        torch.set_num_threads(inference_configs['num_threads'])
+
+
+def inference_context():
+    """
+    Context of every model call: inference mode, or no_grad when inference_mode is disabled in the configs.
+    """
+    return torch.inference_mode() if INFERENCE_SETTINGS['inference_mode'] else torch.no_grad()
+
+
+def compile_fusion_model(fusion_model):
+    """
+    Compile the encoder, called with the bucketed input lengths, and the decoder, called with a growing
+    attention cache, so generate runs the compiled forward passes.
+    """
+    fusion_model.encoder.forward = torch.compile(fusion_model.encoder.forward, dynamic=False)
+    fusion_model.decoder.forward = torch.compile(fusion_model.decoder.forward, dynamic=True)
+    return fusion_model
+
+
+def load_fusion_model(configs, device=None, mmap_weights=None, backend=None):
+    """
+    Load the fine-tuned fusion model in eval mode on the given device, the GPU if available by default.
+    With mmap_weights, inference.fast_load by default, the model reads its weights straight from the memory-mapped
+    safetensors file instead of from_pretrained. Pages are only read when a tensor is first used or copied to the GPU,
+    and a pool of CPU processes holds a single copy of them. Without the file, see write_safetensors_file, the model
+    falls back to from_pretrained.
+    The backend, inference.backend of the configs by default, is one of BACKENDS. The int8 and onnx backends run on CPU.
+    The torch model is compiled with inference.compile, see compile_fusion_model.
+    """
+    configure_inference(configs)
+    inference_configs = configs.get('inference', {})
+    if backend is None:
+        backend = inference_configs.get('backend', 'torch')
+    if mmap_weights is None:
+        mmap_weights = inference_configs.get('fast_load', False)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend}, choose from {BACKENDS}")
+
+    if backend != 'torch' and device is not None and device != "cpu":
+        raise ValueError(f"The {backend} backend runs on CPU, not {device}")
+    if backend == 'int8':
+        return load_quantized_fusion_model(configs)
+    if backend == 'onnx':
+        # Imported here, onnxruntime is only needed by this backend
+        from onnx_model import OnnxFusionModel
+        return OnnxFusionModel(configs)
+
+    if device is None:
+        device = "cuda" if cuda_available() else "cpu"
+
+    if mmap_weights and not os.path.exists(get_safetensors_file(configs)):
+        print(f"No {get_safetensors_file(configs)} to map, loading the model with from_pretrained")
+        mmap_weights = False
+
+    if mmap_weights:
+        model_folder = get_model_folder(configs)
+        # Parameters are allocated but never initialised, the mapped tensors replace them
+        with no_init_weights():
+            fusion_model = EncoderDecoderModel(config=EncoderDecoderConfig.from_pretrained(model_folder))
+        state_dict = mmap_state_dict(get_safetensors_file(configs))
+        missing_keys, unexpected_keys = fusion_model.load_state_dict(state_dict, strict=False, assign=True)
+        # Shared tensors are stored once in safetensors files, tying restores the others
+        fusion_model.tie_weights()
+        mapped_pointers = {tensor.data_ptr() for tensor in state_dict.values()}
+        model_state_dict = fusion_model.state_dict()
+        untied_keys = [key for key in missing_keys if model_state_dict[key].data_ptr() not in mapped_pointers]
+        if len(unexpected_keys) > 0 or len(untied_keys) > 0:
+            raise ValueError(f"Weights in {model_folder} do not match the model: missing {untied_keys}, unexpected {unexpected_keys}")
+    else:
+        fusion_model = EncoderDecoderModel.from_pretrained(get_model_folder(configs))
+    # A no-op for the mapped CPU model
+    fusion_model.to(device)
+    fusion_model.eval()
+
+    if inference_configs.get('compile', False):
+        fusion_model = compile_fusion_model(fusion_model)
+        # Each padded length is a compiled encoder graph, so lengths are rounded up to a few buckets
+        INFERENCE_SETTINGS['length_buckets'] = get_length_buckets(configs['model']['encoder_max_sequence_length'],
+                                                                  inference_configs.get('pad_to_multiple_of', 64))
+
+    return fusion_model
+
+
+def get_cpu_split(n_workers=None, threads_per_worker=4):
+    """
+    Split the cores available to this process between worker processes so that workers × threads matches the
+    core count. Returns the number of workers and the intra-op threads of each.
+    """
+    n_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    if n_workers is None:
+        n_workers = max(1, n_cores // threads_per_worker)
+    n_workers = min(n_workers, n_cores)
+
+    return n_workers, max(1, n_cores // n_workers)
+
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default=os.path.normpath("configs/config_style_transfer.yaml"),
+                        help="Path to the config file")
+    args = parser.parse_args()
+
+    # Load config file
+    with open(args.config, 'r') as f:
+        configs = yaml.safe_load(f)
+
+    # Converts the checkpoint once so that inference.fast_load can map it
+    write_safetensors_file(configs)
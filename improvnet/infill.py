@@ -11,70 +11,48 @@ from tqdm import tqdm
 import pretty_midi
 import torch
 from torch.nn import functional as F
-from transformers import EncoderDecoderModel
 from torch.cuda import is_available as cuda_available
 from ariautils.midi import MidiDict
 from ariautils.tokenizer import AbsTokenizer
 
-from corruptions import DataCorruption
+from corruptions import DataCorruption, SegmentStore
+from generation import refine_variations_batch, get_novel_note_numbers, get_segment_rng, get_variation_rngs, get_variation_seeds, get_variation_filename
+from refinement_cache import get_refinement_cache
+from decoding import reset_decoding_stats, print_decoding_stats
+from inference import load_fusion_model
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
-from utils.utils import flatten, unflatten_corrupted, parse_generation, unflatten_for_aria, Segment_Novelty
+from utils.tokens import flatten, unflatten_for_aria, add_novelty_segment_token
 
 
-def refine_sequence(corrupted_sequence, tokenizer, decode_tokenizer, model, encoder_max_sequence_length, decoder_max_sequence_length, temperature=1.0):
-    # Tokenize the sequence
-    # input_tokens = [tokenizer[tuple(token)] if isinstance(token, list) else tokenizer[token] for token in corrupted_sequence]
-    input_tokens = [tokenizer[token] for token in corrupted_sequence if token in tokenizer.keys()]
-    # Pad the sequences
-    if len(input_tokens) < encoder_max_sequence_length:
-        input_tokens = F.pad(torch.tensor(input_tokens), (0, encoder_max_sequence_length - len(input_tokens))).to(torch.int64)
-    else:
-        input_tokens = torch.tensor(input_tokens[0:encoder_max_sequence_length]).to(torch.int64)
-
-    # Attention mask based on non-padded tokens of the phrase
-    attention_mask = torch.where(input_tokens != 0, 1, 0).type(torch.bool)
-
-    # Generate the output sequence
-    output_tokens = model.generate(input_ids=input_tokens.unsqueeze(0).to("cuda" if cuda_available() else "cpu"),
-                                    attention_mask=attention_mask.unsqueeze(0).to("cuda" if cuda_available() else "cpu"),
-                                    max_length=decoder_max_sequence_length,
-                                    num_beams=1,
-                                    early_stopping=False,
-                                    do_sample=True,
-                                    temperature=temperature,
-                                    top_k=50,
-                                    top_p=1.0,
-                                    pad_token_id=0,
-                                    eos_token_id=tokenizer["<E>"],
-                                    bos_token_id=tokenizer["<S>"])
-
-    # Decode the output tokens
-    output_sequence = [decode_tokenizer[token.item()] for token in output_tokens[0]]
-
-    generated_sequences = parse_generation(output_sequence, add_special_tokens = True)
-
-    # Remove special tokens
-    generated_sequences = [token for token in generated_sequences if token not in ["<S>", "<E>", "<SEP>"]]
-
-    return generated_sequences
-
-
-def generate_one_pass(tokenized_sequence, fusion_model, configs, 
+def generate_one_pass(tokenized_sequences, fusion_model, configs, 
                       t_segment_start, convert_to, context_before, 
                       context_after, context_infilling, corruption_type, corruption_rate, 
-                      tokenizer, decode_tokenizer, quiet, temperature=1.0, save_infilling_only=False):
+                      tokenizer, decode_tokenizer, quiet, temperature=1.0, save_infilling_only=False, seed=None, pass_number=1):
+    """
+    Infill one pass over the sequences of every variation of a piece and return their cropped sequences.
+    """
 
     # Get the encoder and decoder max sequence length
     encoder_max_sequence_length = configs['model']['encoder_max_sequence_length']
     decoder_max_sequence_length = configs['model']['decoder_max_sequence_length']
+    # Pad encoder inputs to their true length instead of the maximum
+    dynamic_padding = configs.get('inference', {}).get('dynamic_padding', False)
+    pad_to_multiple_of = configs.get('inference', {}).get('pad_to_multiple_of', 64)
+    # Stop decoding segments once they are complete
+    early_stopping = configs.get('inference', {}).get('early_stopping', False)
+    # Only sample tokens that parse into notes
+    grammar_constraint = configs.get('inference', {}).get('grammar_constraint', False)
+    reset_decoding_stats()
+    # Reuse refinements of identical inputs from earlier seeded runs, unseeded runs draw fresh samples
+    num_variations = len(tokenized_sequences)
+    refinement_cache = get_refinement_cache(configs) if seed is not None else None
     
     corruption_obj = DataCorruption()
-    separated_sequence = corruption_obj.seperateitems(tokenized_sequence)
-    # Get the indices of the novelty tokens
-    novelty_segments = [n for n, i in enumerate(separated_sequence) if '<N>' in i]
-    all_segment_indices, _, _, _ = corruption_obj.get_segment_to_corrupt(separated_sequence, t_segment_ind=t_segment_start, exclude_idx=novelty_segments)
+    # Index the segments once, novelty segments are never corrupted
+    segment_stores = [SegmentStore(tokenized_sequence, corruption_obj) for tokenized_sequence in tokenized_sequences]
+    all_segment_indices = segment_stores[0].segment_indices
 
     n_iterations = t_segment_start + context_infilling #len(all_segment_indices)
 
@@ -86,26 +64,31 @@ def generate_one_pass(tokenized_sequence, fusion_model, configs,
 
     while t_segment_ind < n_iterations:
 
-        if random.random() < corruption_rate:
-            if t_segment_ind == n_iterations - 1:
-                output_dict = corruption_obj.apply_random_corruption(tokenized_sequence, context_before=context_before, context_after=context_after, meta_data=[convert_to], t_segment_ind=t_segment_ind, inference=False, corruption_type=corruption_type, run_corruption=True, exclude_idx=novelty_segments)
-            else:
-                output_dict = corruption_obj.apply_random_corruption(tokenized_sequence, context_before=context_before, context_after=0, meta_data=[convert_to], t_segment_ind=t_segment_ind, inference=False, corruption_type=corruption_type, run_corruption=True, exclude_idx=novelty_segments)
-            index = output_dict['index']
-            corrupted_sequence = output_dict['corrupted_sequence']
-            corrupted_sequence = unflatten_corrupted(corrupted_sequence)
-            refined_segment = refine_sequence(corrupted_sequence, tokenizer, decode_tokenizer, fusion_model, encoder_max_sequence_length, decoder_max_sequence_length, temperature=temperature)
-            flattened_refined_segment = flatten(refined_segment, add_special_tokens=True)
-            separated_sequence[index] = flattened_refined_segment
-            tokenized_sequence = corruption_obj.concatenate_list(separated_sequence)
+        # A seeded piece draws every choice of a segment from its own stream
+        rng = get_segment_rng(seed, pass_number, t_segment_ind)
+        if rng.random() < corruption_rate:
+            # The last infilled segment also sees the context after it
+            segment_context_after = context_after if t_segment_ind == n_iterations - 1 else 0
+            output_dicts = [segment_store.corrupt(t_segment_ind, context_before=context_before, context_after=segment_context_after, meta_data=[convert_to], inference=False, corruption_type=corruption_type, run_corruption=True, rng=variation_rng)
+                            for segment_store, variation_rng in zip(segment_stores, get_variation_rngs(rng, num_variations))]
+            variation_refined_segments = refine_variations_batch([[output_dict['corrupted_sequence']] for output_dict in output_dicts], tokenizer, decode_tokenizer, fusion_model, 
+                                                                 encoder_max_sequence_length, decoder_max_sequence_length, temperature=temperature, 
+                                                                 dynamic_padding=dynamic_padding, pad_to_multiple_of=pad_to_multiple_of, cache=refinement_cache, 
+                                                                 variation_seeds=get_variation_seeds(seed, pass_number, [t_segment_ind], num_variations), early_stopping=early_stopping, 
+                                                                 grammar_constraint=grammar_constraint)
+            for segment_store, output_dict, refined_segments in zip(segment_stores, output_dicts, variation_refined_segments):
+                flattened_refined_segment = flatten(refined_segments[0], add_special_tokens=True)
+                segment_store.replace(output_dict['index'], flattened_refined_segment)
             if not quiet:
-                print("Corrupted t_segment_ind:", t_segment_ind, "Corruption type:", output_dict['corruption_type'])
+                print("Corrupted t_segment_ind:", t_segment_ind, "Corruption type:", output_dicts[0]['corruption_type'])
         
         t_segment_ind += jump_every
         # Update the progress bar
         progress_bar.update(jump_every)
 
     progress_bar.close()
+    if not quiet:
+        print_decoding_stats()
 
     # Crop the sequence based on total context
     if save_infilling_only:
@@ -113,50 +96,16 @@ def generate_one_pass(tokenized_sequence, fusion_model, configs,
         context_before = 0
     else:
         context_after = context_infilling + context_after - 1
-    output_dict = corruption_obj.apply_random_corruption(tokenized_sequence, context_before=context_before, context_after=context_after, meta_data=[convert_to], t_segment_ind=t_segment_start, inference=False, corruption_type=corruption_type, run_corruption=False, exclude_idx=novelty_segments)
-    tokenized_sequence = output_dict['corrupted_sequence']
-
-    return tokenized_sequence
-
-
-def get_midi_notes_from_tick(midi_dict, midi_data, peak_times, quiet):
-    novel_note_numbers = []
-    novel_notes = []
-    for n, note in enumerate(midi_dict.note_msgs):
-        if len(peak_times) > 0:
-            tick = note['tick']
-            # tick_to_time
-            time_in_sec = pretty_midi.PrettyMIDI.tick_to_time(midi_data, tick)
-
-            if time_in_sec > peak_times[0]:
-                if not quiet:
-                    print(f"Note {n} is at {time_in_sec} seconds")
-                novel_note_numbers.append(n)
-                novel_notes.append(note)
-                peak_times = np.delete(peak_times, 0)
-        else:
-            return novel_note_numbers, novel_notes
-
+    tokenized_sequences = []
+    for segment_store in segment_stores:
+        output_dict = segment_store.corrupt(t_segment_start, context_before=context_before, context_after=context_after, meta_data=[convert_to], inference=False, corruption_type=corruption_type, run_corruption=False, 
+                                            rng=get_segment_rng(seed, pass_number, t_segment_start, stream='pass'))
+        tokenized_sequences.append(output_dict['corrupted_sequence'])
 
-def add_novelty_segment_token(tokenized_sequence, novel_note_numbers):
-    note_number = 0
-    insertion_points = []
-    for note_idx, note in enumerate(tokenized_sequence):
-        if type(note) == list:
-            if note_number in novel_note_numbers:
-                insertion_points.append(note_idx)
-            note_number += 1
-    
-    new_tokenized_sequence = []
-    for idx, token in enumerate(tokenized_sequence):
-        if idx in insertion_points:
-            new_tokenized_sequence.append("<N>")
-        new_tokenized_sequence.append(token)
-    
-    return new_tokenized_sequence
+    return tokenized_sequences
 
 
-def write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer):
+def write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer, variation=0):
     sequence = copy.deepcopy(tokenized_sequence)
     # Unflatten the tokenized sequence
     sequence = unflatten_for_aria(sequence)
@@ -168,18 +117,22 @@ def write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer
     generated_sequence = [('prefix', 'instrument', 'piano'), "<S>"] + sequence + ["<E>"]
     mid_dict = aria_tokenizer.detokenize(generated_sequence)
     generated_mid = mid_dict.to_midi()
-    filename = os.path.basename(midi_file_path)
     # Create output folder if it does not exist
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    generated_mid.save(os.path.join(output_folder, "generated_" + filename))
+    generated_mid.save(os.path.join(output_folder, get_variation_filename(midi_file_path, variation)))
 
 
 def infill(midi_file_path, audio_file_path, fusion_model, configs, novel_peaks_pct,
              t_segment_start, convert_to, context_before, context_after, context_infilling,
              corruption_passes, tokenizer, decode_tokenizer, output_folder, 
-             save_original=False, quiet=False, write_intermediate_passes=False, temperature=1.0, save_infilling_only=False):
-    
+             save_original=False, quiet=False, write_intermediate_passes=False, temperature=1.0, save_infilling_only=False, seed=None, num_variations=1):
+    """
+    Infill context_infilling segments from t_segment_start over the corruption passes. With a seed, every segment
+    of every pass corrupts and samples from its own random streams. With num_variations, one MIDI file is written
+    per variation and the variations are infilled together.
+    """
+
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
@@ -221,19 +174,7 @@ def infill(midi_file_path, audio_file_path, fusion_model, configs, novel_peaks_p
     tokenized_sequence = tokenized_sequence[2:-1]
 
     # Novelty based segmentation
-    if audio_file_path is None or audio_file_path == "":
-        novel_note_numbers = []
-    else:
-        ssm_config_file = "configs/config_ssm.yaml"
-        n_t_segments = len([t for t in tokenized_sequence if t == "<T>"])
-        novel_peaks_pct = configs['generation']['novel_peaks_pct']
-        n_novel_peaks = np.ceil(novel_peaks_pct * n_t_segments).astype(int)
-        if not quiet:
-            print("Number of novel peaks:", n_novel_peaks)
-        segment_novelty = Segment_Novelty(ssm_config_file, audio_file_path)
-        peak_times = segment_novelty.get_peak_timestamps(audio_file_path, n_novel_peaks)
-        pretty_midi_data = pretty_midi.PrettyMIDI(midi_file_path)
-        novel_note_numbers, novel_notes = get_midi_notes_from_tick(mid, pretty_midi_data, peak_times, quiet)
+    novel_note_numbers = get_novel_note_numbers(midi_file_path, audio_file_path, mid, tokenized_sequence, configs, quiet)
 
     # Flatten the tokenized sequence
     tokenized_sequence = flatten(tokenized_sequence, add_special_tokens=True)
@@ -243,16 +184,18 @@ def infill(midi_file_path, audio_file_path, fusion_model, configs, novel_peaks_p
 
     # Generate by iterating with multiple passes
     passes = len(corruption_passes.keys())
+    tokenized_sequences = [tokenized_sequence] * num_variations
     for i in range(passes):
         if not quiet:
             print("Pass:", i + 1)
         corruption_type = corruption_passes['pass_' + str(i + 1)]['corruption_type']        
         corruption_rate = corruption_passes['pass_' + str(i + 1)]['corruption_rate']
         # Generate the sequence
-        tokenized_sequence = generate_one_pass(tokenized_sequence, fusion_model, configs, 
-                                               t_segment_start, convert_to, context_before, 
-                                               context_after, context_infilling, corruption_type, corruption_rate, 
-                                               tokenizer, decode_tokenizer, quiet, temperature=temperature, save_infilling_only=save_infilling_only)
+        tokenized_sequences = generate_one_pass(tokenized_sequences, fusion_model, configs, 
+                                                t_segment_start, convert_to, context_before, 
+                                                context_after, context_infilling, corruption_type, corruption_rate, 
+                                                tokenizer, decode_tokenizer, quiet, temperature=temperature, save_infilling_only=save_infilling_only, 
+                                                seed=seed, pass_number=i + 1)
 
         if write_intermediate_passes:
             pass_number = f"pass_{passes}"
@@ -260,10 +203,12 @@ def infill(midi_file_path, audio_file_path, fusion_model, configs, novel_peaks_p
                 new_output_folder = output_folder.replace(pass_number, f"pass_{i + 1}")
             else:
                 new_output_folder = os.path.join(output_folder, f"pass_{i + 1}")
-            write_file(midi_file_path, new_output_folder, tokenized_sequence, aria_tokenizer)
+            for variation, tokenized_sequence in enumerate(tokenized_sequences):
+                write_file(midi_file_path, new_output_folder, tokenized_sequence, aria_tokenizer, variation=variation)
 
-    # Write the generated sequence to a MIDI file
-    write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer)
+    # Write the generated sequences to MIDI files
+    for variation, tokenized_sequence in enumerate(tokenized_sequences):
+        write_file(midi_file_path, output_folder, tokenized_sequence, aria_tokenizer, variation=variation)
 
 
 
@@ -294,9 +239,7 @@ if __name__ == "__main__":
     decode_tokenizer = {v: k for k, v in tokenizer.items()}
 
     # Load the fusion model
-    fusion_model = EncoderDecoderModel.from_pretrained(os.path.join(artifact_folder, "style_transfer", "fine_tuned_model"))
-    fusion_model.eval()
-    fusion_model.to("cuda" if cuda_available() else "cpu")
+    fusion_model = load_fusion_model(configs)
     print("Fusion model loaded")
 
     # Open JSON file
@@ -321,9 +264,11 @@ if __name__ == "__main__":
     write_intermediate_passes = configs['generation']['write_intermediate_passes']
     temperature = configs['generation']['temperature']
     save_infilling_only = configs['generation']['save_infilling_only']
+    seed = configs['generation'].get('seed')
+    num_variations = configs['generation'].get('num_variations', 1)
 
     infill(midi_file_path, audio_file_path, fusion_model, configs, novel_peaks_pct,
              t_segment_start, convert_to, context_before, context_after, context_infilling,
              corruption_passes, tokenizer, decode_tokenizer, output_folder, 
              save_original=True, quiet=False, write_intermediate_passes=write_intermediate_passes, 
-             temperature=temperature, save_infilling_only=save_infilling_only)
\ No newline at end of file
+             temperature=temperature, save_infilling_only=save_infilling_only, seed=seed, num_variations=num_variations)
\ No newline at end of file
@@ -0,0 +1,96 @@
+import yaml
+import json
+import os
+import glob
+import time
+import asyncio
+import argparse
+import numpy as np
+
+
+async def send_socket_job(socket_path, request):
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write((json.dumps(request) + "\n").encode())
+    await writer.drain()
+    response = json.loads(await reader.readline())
+    writer.close()
+    return response
+
+
+async def send_http_job(host, port, request, method="POST", path="/jobs"):
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(request).encode() if request is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    # The server closes the connection after the reply
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+async def run_load_test(args, send_job, get_stats):
+    midi_file_paths = sorted(glob.glob(os.path.join(args.input_folder, "*.mid")))
+    overrides = json.loads(args.generation) if args.generation else {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_one(job_index):
+        request = {'id': job_index, 'task': args.task, 'midi_file_path': os.path.abspath(midi_file_paths[job_index % len(midi_file_paths)]),
+                   'output_folder': os.path.join(args.output_folder, str(job_index)), 'generation': overrides}
+        async with semaphore:
+            start_time = time.perf_counter()
+            response = await send_job(request)
+            return response, time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*[run_one(job_index) for job_index in range(args.n_jobs)])
+    elapsed = time.perf_counter() - start_time
+
+    latencies = [latency for response, latency in results if response['status'] == 'ok']
+    for response, _ in results:
+        if response['status'] != 'ok':
+            print(f"Job {response['id']} failed: {response['error']}")
+
+    print(f"Jobs: {len(latencies)}/{args.n_jobs} succeeded with concurrency {args.concurrency} in {elapsed:.1f} s")
+    if len(latencies) > 0:
+        print(f"Latency: p50 {np.percentile(latencies, 50):.2f} s, p99 {np.percentile(latencies, 99):.2f} s, mean {np.mean(latencies):.2f} s")
+        print(f"Throughput: {len(latencies) / elapsed:.3f} jobs/s")
+    stats = await get_stats()
+    print(f"Server: {stats['batches']} decoder calls for {stats['calls']} refinements, {stats['mean_batch_rows']:.2f} segments per call")
+
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default=os.path.normpath("configs/config_style_transfer.yaml"),
+                        help="Path to the config file the server was started with")
+    parser.add_argument("--transport", type=str, default="socket", choices=["socket", "http"],
+                        help="Send jobs over the Unix socket or HTTP")
+    parser.add_argument("--task", type=str, default="style_transfer",
+                        help="Task of every job")
+    parser.add_argument("--input_folder", type=str, default="input",
+                        help="Folder with the MIDI pieces the jobs cycle through")
+    parser.add_argument("--output_folder", type=str, default=os.path.join("output", "load_test"),
+                        help="Every job writes to a subfolder named after its index")
+    parser.add_argument("--n_jobs", type=int, default=32,
+                        help="Total number of jobs sent")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Number of jobs in flight at the same time")
+    parser.add_argument("--generation", type=str, default=None,
+                        help="JSON object of generation config overrides sent with every job, e.g. '{\"t_segment_stop\": 6}'")
+    args = parser.parse_args()
+
+    # Load config file
+    with open(args.config, 'r') as f:
+        configs = yaml.safe_load(f)
+    inference_configs = configs.get('inference', {})
+
+    if args.transport == "socket":
+        socket_path = inference_configs.get('socket_path')
+        send_job = lambda request: send_socket_job(socket_path, request)
+        get_stats = lambda: send_socket_job(socket_path, {'task': 'stats'})
+    else:
+        host, port = inference_configs.get('http_host', "127.0.0.1"), inference_configs.get('http_port')
+        send_job = lambda request: send_http_job(host, port, request)
+        get_stats = lambda: send_http_job(host, port, None, method="GET", path="/stats")
+
+    asyncio.run(run_load_test(args, send_job, get_stats))
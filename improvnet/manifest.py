@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+from utils.novelty import hash_file
+
+
+# Keyword arguments that locate a job instead of configuring it
+LOCATION_KWARGS = ['midi_file_path', 'audio_file_path', 'output_folder']
+
+
+def to_json(value):
+    # Sets of pass numbers are written in a stable order
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return str(value)
+
+
+def hash_config(job):
+    """
+    Hash of everything that changes the output of a job except its input files.
+    """
+    config = {'task': job['task'], 'kwargs': {key: value for key, value in job['kwargs'].items() if key not in LOCATION_KWARGS}}
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=to_json).encode()).hexdigest()
+
+
+class Manifest:
+    """
+    SQLite record of the jobs of a sweep: input hash, config hash, seed, status, output path and timing.
+    A job is done when its last run finished without error for the same input, config and seed,
+    so relaunching a sweep only schedules the jobs that are missing, failed or were interrupted.
+    """
+    def __init__(self, manifest_file):
+        if os.path.dirname(manifest_file) and not os.path.exists(os.path.dirname(manifest_file)):
+            os.makedirs(os.path.dirname(manifest_file))
+        self.manifest_file = manifest_file
+        self.connection = sqlite3.connect(manifest_file)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                   job_id TEXT PRIMARY KEY, experiment TEXT, task TEXT, midi_file_path TEXT, output_path TEXT,
+                                   input_hash TEXT, config_hash TEXT, seed INTEGER, status TEXT, worker_id INTEGER,
+                                   started REAL, finished REAL, elapsed REAL, error TEXT)""")
+        self.connection.commit()
+
+    def get_record(self, job):
+        midi_file_path = job['kwargs']['midi_file_path']
+        output_path = job['kwargs']['output_folder']
+        return {'job_id': hashlib.sha256(f"{job['task']}:{midi_file_path}:{output_path}".encode()).hexdigest()[:32],
+                'experiment': job.get('experiment'), 'task': job['task'], 'midi_file_path': midi_file_path, 'output_path': output_path,
+                'input_hash': hash_file(midi_file_path), 'config_hash': hash_config(job), 'seed': job.get('seed')}
+
+    def is_done(self, record):
+        row = self.connection.execute("SELECT input_hash, config_hash, seed, status FROM jobs WHERE job_id = ?", (record['job_id'],)).fetchone()
+        return row is not None and row == (record['input_hash'], record['config_hash'], record['seed'], 'done')
+
+    def start(self, records):
+        self.connection.executemany("""INSERT OR REPLACE INTO jobs (job_id, experiment, task, midi_file_path, output_path, input_hash, config_hash, seed, status, started)
+                                       VALUES (:job_id, :experiment, :task, :midi_file_path, :output_path, :input_hash, :config_hash, :seed, 'running', :started)""",
+                                    [{**record, 'started': time.time()} for record in records])
+        self.connection.commit()
+
+    def finish(self, job_id, worker_id, elapsed, error=None):
+        self.connection.execute("UPDATE jobs SET status = ?, worker_id = ?, finished = ?, elapsed = ?, error = ? WHERE job_id = ?",
+                                ('done' if error is None else 'failed', worker_id, time.time(), elapsed, error, job_id))
+        self.connection.commit()
+
+    def summary(self):
+        """
+        Number of jobs and compute time per experiment and status.
+        """
+        return self.connection.execute("""SELECT experiment, status, COUNT(*), COALESCE(SUM(elapsed), 0) FROM jobs
+                                          GROUP BY experiment, status ORDER BY experiment, status""").fetchall()
+
+    def print_summary(self):
+        print(f"{'Experiment':<20} {'Status':<8} {'Jobs':>6} {'Compute h':>10}")
+        for experiment, status, n_jobs, elapsed in self.summary():
+            print(f"{str(experiment):<20} {status:<8} {n_jobs:>6} {elapsed / 3600:>10.2f}")
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manifest", type=str, required=True,
+                        help="Path to the manifest of a sweep")
+    parser.add_argument("--failed", action="store_true",
+                        help="List the failed jobs with their errors")
+    args = parser.parse_args()
+
+    manifest = Manifest(args.manifest)
+    manifest.print_summary()
+    if args.failed:
+        for midi_file_path, output_path, error in manifest.connection.execute("SELECT midi_file_path, output_path, error FROM jobs WHERE status = 'failed'"):
+            print(f"{midi_file_path} -> {output_path}: {error}")
+    manifest.close()
@@ -0,0 +1,245 @@
+import os
+import json
+import yaml
+import argparse
+import numpy as np
+import torch
+import onnxruntime
+from transformers import EncoderDecoderModel, EncoderDecoderConfig
+from transformers.modeling_outputs import BaseModelOutput
+
+from inference import get_model_folder, get_weights_signature
+
+
+# Cached attention tensors of every decoder layer, in the order of the legacy past_key_values tuples
+PAST_NAMES = ['self_key', 'self_value', 'cross_key', 'cross_value']
+ONNX_FILES = ['encoder.onnx', 'decoder.onnx', 'decoder_with_past.onnx']
+
+
+class EncoderExport(torch.nn.Module):
+    """
+    Encoder of the fusion model, returning the hidden states the decoder attends to.
+    """
+    def __init__(self, fusion_model):
+        super().__init__()
+        self.encoder = fusion_model.get_encoder()
+        # Only present when the encoder and decoder hidden sizes differ
+        self.enc_to_dec_proj = getattr(fusion_model, 'enc_to_dec_proj', None)
+
+    def forward(self, input_ids, attention_mask):
+        encoder_hidden_states = self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+        if self.enc_to_dec_proj is not None:
+            encoder_hidden_states = self.enc_to_dec_proj(encoder_hidden_states)
+        return encoder_hidden_states
+
+
+class DecoderExport(torch.nn.Module):
+    """
+    Decoder of the fusion model returning the logits and the attention cache. Without past it returns the self and
+    cross attention tensors of every layer, with past only the self attention ones, the cross attention ones do not change.
+    """
+    def __init__(self, fusion_model, with_past):
+        super().__init__()
+        self.decoder = fusion_model.get_decoder()
+        self.with_past = with_past
+
+    def forward(self, input_ids, encoder_hidden_states, encoder_attention_mask, *past_key_values):
+        past = None
+        if self.with_past:
+            past = tuple(tuple(past_key_values[i:i + len(PAST_NAMES)]) for i in range(0, len(past_key_values), len(PAST_NAMES)))
+        outputs = self.decoder(input_ids=input_ids, encoder_hidden_states=encoder_hidden_states, encoder_attention_mask=encoder_attention_mask,
+                               past_key_values=past, use_cache=True, return_dict=True)
+        presents = [tensor for layer_past in outputs.past_key_values for tensor in (layer_past[:2] if self.with_past else layer_past)]
+        return (outputs.logits, *presents)
+
+
+def get_onnx_folder(configs):
+    return configs.get('inference', {}).get('onnx_folder') or os.path.join(get_model_folder(configs), "onnx")
+
+
+def export_onnx_model(configs, onnx_folder=None, opset_version=17):
+    """
+    Export the fine-tuned fusion model to encoder.onnx, decoder.onnx for the first decoding step and decoder_with_past.onnx
+    for the following ones, and record the signature of the weights they were exported from.
+    """
+    model_folder = get_model_folder(configs)
+    if onnx_folder is None:
+        onnx_folder = get_onnx_folder(configs)
+    os.makedirs(onnx_folder, exist_ok=True)
+
+    fusion_model = EncoderDecoderModel.from_pretrained(model_folder)
+    fusion_model.eval()
+    decoder_config = fusion_model.config.decoder
+    n_layers = decoder_config.num_hidden_layers
+    n_heads = decoder_config.num_attention_heads
+    head_size = decoder_config.hidden_size // n_heads
+
+    # Dummy sizes above 1, the exporter would otherwise fix dimensions of size 1
+    batch_size, encoder_length, decoder_length, past_length = 2, 16, 2, 3
+    input_ids = torch.ones(batch_size, encoder_length, dtype=torch.int64)
+    attention_mask = torch.ones(batch_size, encoder_length, dtype=torch.int64)
+    encoder_hidden_states = torch.zeros(batch_size, encoder_length, decoder_config.hidden_size)
+    past_names = [f"past_{n}_{name}" for n in range(n_layers) for name in PAST_NAMES]
+    past_key_values = [torch.zeros(batch_size, n_heads, encoder_length if name.startswith('cross') else past_length, head_size)
+                       for n in range(n_layers) for name in PAST_NAMES]
+
+    def get_cache_axes(names):
+        return {name: {0: 'batch', 2: 'encoder_sequence' if 'cross' in name else 'past_sequence'} for name in names}
+
+    encoder_axes = {'input_ids': {0: 'batch', 1: 'encoder_sequence'}, 'attention_mask': {0: 'batch', 1: 'encoder_sequence'},
+                    'encoder_hidden_states': {0: 'batch', 1: 'encoder_sequence'}}
+    decoder_axes = {'input_ids': {0: 'batch', 1: 'sequence'}, 'encoder_hidden_states': {0: 'batch', 1: 'encoder_sequence'},
+                    'encoder_attention_mask': {0: 'batch', 1: 'encoder_sequence'}, 'logits': {0: 'batch', 1: 'sequence'}}
+    present_names = [f"present_{n}_{name}" for n in range(n_layers) for name in PAST_NAMES]
+    self_present_names = [f"present_{n}_{name}" for n in range(n_layers) for name in PAST_NAMES[:2]]
+
+    with torch.no_grad():
+        torch.onnx.export(EncoderExport(fusion_model), (input_ids, attention_mask), os.path.join(onnx_folder, "encoder.onnx"),
+                          input_names=['input_ids', 'attention_mask'], output_names=['encoder_hidden_states'],
+                          dynamic_axes=encoder_axes, opset_version=opset_version)
+        torch.onnx.export(DecoderExport(fusion_model, with_past=False),
+                          (torch.ones(batch_size, decoder_length, dtype=torch.int64), encoder_hidden_states, attention_mask),
+                          os.path.join(onnx_folder, "decoder.onnx"),
+                          input_names=['input_ids', 'encoder_hidden_states', 'encoder_attention_mask'], output_names=['logits'] + present_names,
+                          dynamic_axes={**decoder_axes, **get_cache_axes(present_names)}, opset_version=opset_version)
+        torch.onnx.export(DecoderExport(fusion_model, with_past=True),
+                          (torch.ones(batch_size, 1, dtype=torch.int64), encoder_hidden_states, attention_mask, *past_key_values),
+                          os.path.join(onnx_folder, "decoder_with_past.onnx"),
+                          input_names=['input_ids', 'encoder_hidden_states', 'encoder_attention_mask'] + past_names, output_names=['logits'] + self_present_names,
+                          dynamic_axes={**decoder_axes, **get_cache_axes(past_names), **get_cache_axes(self_present_names)}, opset_version=opset_version)
+
+    with open(os.path.join(onnx_folder, "signature.json"), "w") as f:
+        json.dump(get_weights_signature(model_folder), f)
+    print("ONNX graphs written to", onnx_folder)
+
+    return onnx_folder
+
+
+class OnnxFusionModel:
+    """
+    Fusion model run by ONNX Runtime on CPU. generate follows the sampling of EncoderDecoderModel.generate used by
+    refine_sequence_batch, including logits processors and stopping criteria, so it can replace the torch model there.
+    Custom samplers can call encode and decode_step directly to get the logits of every step.
+    """
+    def __init__(self, configs, num_threads=None):
+        model_folder = get_model_folder(configs)
+        self.config = EncoderDecoderConfig.from_pretrained(model_folder)
+        self.device = torch.device("cpu")
+        self.n_layers = self.config.decoder.num_hidden_layers
+
+        onnx_folder = get_onnx_folder(configs)
+        signature_file = os.path.join(onnx_folder, "signature.json")
+        exported = os.path.exists(signature_file) and all(os.path.exists(os.path.join(onnx_folder, onnx_file)) for onnx_file in ONNX_FILES)
+        if exported:
+            with open(signature_file, "r") as f:
+                exported = json.load(f) == get_weights_signature(model_folder)
+        if not exported:
+            export_onnx_model(configs, onnx_folder)
+        # Refinement cache keys tell the backends apart
+        self.inference_backend = 'onnx'
+        with open(signature_file, "r") as f:
+            self.backend_signature = json.load(f)
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # Same intra-op threads as torch, so both backends compare on the same cores
+        session_options.intra_op_num_threads = num_threads if num_threads is not None else torch.get_num_threads()
+        self.encoder_session, self.decoder_session, self.decoder_with_past_session = [
+            onnxruntime.InferenceSession(os.path.join(onnx_folder, onnx_file), session_options, providers=['CPUExecutionProvider'])
+            for onnx_file in ONNX_FILES]
+
+    @staticmethod
+    def run(session, feeds):
+        # The exporter drops inputs a graph does not use
+        return session.run(None, {node.name: feeds[node.name] for node in session.get_inputs()})
+
+    def eval(self):
+        return self
+
+    def get_encoder(self):
+        def encoder(input_ids, attention_mask, return_dict=True):
+            return BaseModelOutput(last_hidden_state=torch.from_numpy(self.encode(input_ids, attention_mask)))
+        return encoder
+
+    def encode(self, input_ids, attention_mask):
+        return self.run(self.encoder_session, {'input_ids': input_ids.cpu().numpy().astype(np.int64),
+                                               'attention_mask': attention_mask.cpu().numpy().astype(np.int64)})[0]
+
+    def decode_step(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask, past_key_values=None):
+        """
+        Run the decoder on the tokens of decoder_input_ids not covered by past_key_values. Returns the logits of
+        the next token of every row and the attention cache of the next step.
+        """
+        feeds = {'encoder_hidden_states': encoder_hidden_states, 'encoder_attention_mask': encoder_attention_mask}
+        if past_key_values is None:
+            outputs = self.run(self.decoder_session, {**feeds, 'input_ids': decoder_input_ids.numpy()})
+            past_key_values = outputs[1:]
+        else:
+            feeds.update({f"past_{n}_{name}": past_key_values[len(PAST_NAMES) * n + i] for n in range(self.n_layers) for i, name in enumerate(PAST_NAMES)})
+            outputs = self.run(self.decoder_with_past_session, {**feeds, 'input_ids': decoder_input_ids[:, -1:].numpy()})
+            past_key_values = [tensor for n in range(self.n_layers)
+                               for tensor in outputs[1 + 2 * n:3 + 2 * n] + past_key_values[len(PAST_NAMES) * n + 2:len(PAST_NAMES) * (n + 1)]]
+
+        return torch.from_numpy(outputs[0][:, -1, :]), past_key_values
+
+    def generate(self, input_ids=None, attention_mask=None, encoder_outputs=None, max_length=512, num_beams=1, early_stopping=False, do_sample=True,
+                 temperature=1.0, top_k=50, top_p=1.0, pad_token_id=0, eos_token_id=None, bos_token_id=None, logits_processor=None, stopping_criteria=None):
+        """
+        Sample or, with do_sample False, greedily decode the output tokens. The processors see the decoded tokens and the
+        logits of every step before the temperature and top-k warping, as in EncoderDecoderModel.generate.
+        """
+        if num_beams != 1 or top_p != 1.0:
+            raise ValueError("The ONNX decode loop only samples without beams or top-p filtering")
+        if encoder_outputs is None:
+            encoder_hidden_states = self.encode(input_ids, attention_mask)
+        else:
+            encoder_hidden_states = encoder_outputs.last_hidden_state.cpu().numpy()
+        encoder_attention_mask = attention_mask.cpu().numpy().astype(np.int64)
+
+        batch_size = encoder_hidden_states.shape[0]
+        decoder_start_token_id = self.config.decoder_start_token_id if self.config.decoder_start_token_id is not None else bos_token_id
+        decoder_input_ids = torch.full((batch_size, 1), decoder_start_token_id, dtype=torch.int64)
+        unfinished = torch.ones(batch_size, dtype=torch.bool)
+        past_key_values = None
+        while decoder_input_ids.shape[1] < max_length:
+            logits, past_key_values = self.decode_step(decoder_input_ids, encoder_hidden_states, encoder_attention_mask, past_key_values)
+            scores = logits_processor(decoder_input_ids, logits) if logits_processor is not None else logits
+            if do_sample:
+                if temperature != 1.0:
+                    scores = scores / temperature
+                if top_k is not None and top_k < scores.shape[-1]:
+                    kth_scores = torch.topk(scores, top_k, dim=-1).values[:, -1:]
+                    scores = scores.masked_fill(scores < kth_scores, float('-inf'))
+                next_tokens = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+            else:
+                next_tokens = torch.argmax(scores, dim=-1)
+
+            # Finished rows are padded
+            next_tokens = torch.where(unfinished, next_tokens, pad_token_id)
+            decoder_input_ids = torch.cat([decoder_input_ids, next_tokens[:, None]], dim=-1)
+            if eos_token_id is not None:
+                unfinished &= next_tokens != eos_token_id
+            if stopping_criteria is not None:
+                unfinished &= ~stopping_criteria(decoder_input_ids, scores)
+            if not unfinished.any():
+                break
+
+        return decoder_input_ids
+
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default=os.path.normpath("configs/config_style_transfer.yaml"),
+                        help="Path to the config file")
+    parser.add_argument("--output_folder", type=str, default=None,
+                        help="Folder of the ONNX graphs, inference.onnx_folder or fine_tuned_model/onnx by default")
+    parser.add_argument("--opset_version", type=int, default=17,
+                        help="ONNX opset of the exported graphs")
+    args = parser.parse_args()
+
+    # Load config file
+    with open(args.config, 'r') as f:
+        configs = yaml.safe_load(f)
+
+    export_onnx_model(configs, args.output_folder, opset_version=args.opset_version)
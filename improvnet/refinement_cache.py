@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+
+
+# Open caches of this process by folder, so hit and miss counts cover every pass and job
+_REFINEMENT_CACHES = {}
+
+
+class RefinementCache:
+    """
+    On-disk cache of refined segments keyed by the encoder input ids, the sampling parameters and the seed.
+    Once the cache holds more than max_size_mb, the least recently used entries are evicted.
+    Worker processes can share a cache folder, SQLite serialises their writes.
+    """
+    def __init__(self, cache_folder, max_size_mb=1024):
+        os.makedirs(cache_folder, exist_ok=True)
+        self.cache_file = os.path.join(cache_folder, "refinements.sqlite")
+        self.max_size = int(max_size_mb * 2**20)
+        self.hits = 0
+        self.misses = 0
+        # The inference server refines from several threads
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.cache_file, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS refinements (key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS refinements_last_used ON refinements (last_used)")
+        self.connection.commit()
+
+    @staticmethod
+    def get_key(input_ids, sampling_parameters, seed):
+        key_hash = hashlib.sha256(np.asarray(input_ids, dtype=np.int64).tobytes())
+        key_hash.update(json.dumps(sampling_parameters, sort_keys=True).encode())
+        key_hash.update(str(seed).encode())
+        return key_hash.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM refinements WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute("UPDATE refinements SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+            self.hits += 1
+        return pickle.loads(row[0])
+
+    def put_many(self, items):
+        """
+        Store (key, refined segment) pairs and evict the least recently used entries above the size bound.
+        """
+        values = [(key, pickle.dumps(refined_segment)) for key, refined_segment in items]
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO refinements (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                                        [(key, value, len(value), time.time()) for key, value in values])
+            total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM refinements").fetchone()[0]
+            if total_size > self.max_size:
+                evicted_keys = []
+                for key, size in self.connection.execute("SELECT key, size FROM refinements ORDER BY last_used"):
+                    if total_size <= self.max_size:
+                        break
+                    evicted_keys.append((key,))
+                    total_size -= size
+                self.connection.executemany("DELETE FROM refinements WHERE key = ?", evicted_keys)
+            self.connection.commit()
+
+    def stats(self):
+        with self.lock:
+            n_entries, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM refinements").fetchone()
+        n_lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / n_lookups if n_lookups > 0 else 0.0,
+                'entries': n_entries, 'size_mb': size / 2**20}
+
+    def close(self):
+        self.connection.close()
+
+
+def get_refinement_cache(configs):
+    """
+    Refinement cache of the inference config, None unless refinement_cache_folder is set.
+    """
+    inference_configs = configs.get('inference', {})
+    cache_folder = inference_configs.get('refinement_cache_folder')
+    if cache_folder is None:
+        return None
+    if cache_folder not in _REFINEMENT_CACHES:
+        _REFINEMENT_CACHES[cache_folder] = RefinementCache(cache_folder, max_size_mb=inference_configs.get('refinement_cache_max_mb', 1024))
+
+    return _REFINEMENT_CACHES[cache_folder]
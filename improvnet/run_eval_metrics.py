@@ -18,6 +18,8 @@ from transformers import AutoProcessor, ClapModel
 from transformers import AutoModelForSequenceClassification
 from data_loader import Genre_Classifier_Dataset
 from corruptions import DataCorruption
+from codec import pad_ids
+from inference import inference_context
 import os
 os.environ["OMP_NUM_THREADS"] = "6"
 os.environ["OPENBLAS_NUM_THREADS"] = "6"
@@ -28,7 +30,7 @@ os.environ["NUMEXPR_NUM_THREADS"] = "6"
 import sys
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
-from utils.utils import convert_midi_to_wav
+from utils.audio import convert_midi_to_wav
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(os.path.dirname(SCRIPT_DIR), "eval"))
@@ -66,16 +68,10 @@ def get_genre_probabilities(midi_file_path, tokenizer, model, dataset_obj, encod
 
     while t_segment_ind < n_iterations:
         # Get the cropped sequence
-        input_tokens = dataset_obj.get_cropped_sequence(tokens, meta_data=None, t_segment_ind=t_segment_ind)
-
-        # Tokenize the sequences
-        input_tokens = [tokenizer[tuple(token)] if isinstance(token, list) else tokenizer[token] for token in input_tokens]
+        input_tokens = dataset_obj.get_cropped_sequence(tokens, meta_data=None, t_segment_ind=t_segment_ind, return_ids=True)
 
         # Pad the sequences
-        if len(input_tokens) < encoder_max_sequence_length:
-            input_tokens = F.pad(torch.tensor(input_tokens), (0, encoder_max_sequence_length - len(input_tokens))).to(torch.int64)
-        else:
-            input_tokens = torch.tensor(input_tokens[0:encoder_max_sequence_length]).to(torch.int64)
+        input_tokens = torch.from_numpy(pad_ids(input_tokens, encoder_max_sequence_length))
 
         # Attention mask based on non-padded tokens of the phrase
         attention_mask = torch.where(input_tokens != 0, 1, 0).type(torch.bool)
@@ -85,7 +81,8 @@ def get_genre_probabilities(midi_file_path, tokenizer, model, dataset_obj, encod
         attention_mask = attention_mask.to(device)
 
         # Get the prediction
-        outputs = model(input_tokens.unsqueeze(0), attention_mask=attention_mask.unsqueeze(0))
+        with inference_context():
+            outputs = model(input_tokens.unsqueeze(0), attention_mask=attention_mask.unsqueeze(0))
         logits = outputs.logits
         # Get probabilities from the logits
         probs = F.softmax(logits, dim=1)
@@ -219,8 +216,9 @@ def clap_similarity_score(audio_sample, text, model, processor):
     audio_input = processor(audios=audio_sample, return_tensors="pt", sampling_rate=48000).to(device)
 
     # Generate embeddings
-    text_embeddings = model.get_text_features(**text_input)
-    audio_embeddings = model.get_audio_features(**audio_input)
+    with inference_context():
+        text_embeddings = model.get_text_features(**text_input)
+        audio_embeddings = model.get_audio_features(**audio_input)
 
     # Normalize embeddings
     text_embeddings = text_embeddings / torch.norm(text_embeddings, dim=1, keepdim=True)
@@ -269,10 +267,63 @@ def compare_clap_similarity_score(wav_filepath, model, processor, verbose=True):
     }
 
     return clap_scores
-        
-    
 
 
+class StyleTransferEvaluator:
+    """
+    Genre classifier loaded once to score generated pieces against their originals. The genre probabilities of
+    an original are computed once and shared by all its generations.
+    """
+    def __init__(self, configs):
+        artifact_folder = configs["raw_data"]["artifact_folder"]
+        # Get the encoder max sequence length
+        self.encoder_max_sequence_length = configs['classifier_model']['encoder_max_sequence_length']
+
+        # Load the tokenizer dictionary
+        with open(os.path.join(artifact_folder, "style_transfer", "vocab_corrupted.pkl"), "rb") as f:
+            self.tokenizer = pickle.load(f)
+        self.aria_tokenizer = AbsTokenizer()
+
+        # Load the model
+        self.model = AutoModelForSequenceClassification.from_pretrained(os.path.join(artifact_folder, "style_transfer", "classifier_model"))
+        self.model.eval()
+        print("Genre classifier model loaded")
+
+        # Load the dataset
+        self.dataset_obj = Genre_Classifier_Dataset(configs, data_list=[], mode="eval", shuffle=False)
+        self.original_genre_probs = {}
+
+    def get_genre_probabilities(self, midi_file_path):
+        return get_genre_probabilities(midi_file_path, self.tokenizer, self.model, self.dataset_obj, self.encoder_max_sequence_length, self.aria_tokenizer, verbose=False)
+
+    def evaluate(self, original_midi_file_path, generated_midi_file_path, generated_wav_file):
+        """
+        Write metrics.json next to the generated piece. The original WAV is expected next to the original MIDI file.
+        """
+        if original_midi_file_path not in self.original_genre_probs:
+            self.original_genre_probs[original_midi_file_path] = self.get_genre_probabilities(original_midi_file_path)
+        generated_genre_probs = self.get_genre_probabilities(generated_midi_file_path)
+
+        # Get the similarity matrices
+        original_wav_file = original_midi_file_path.replace(".mid", ".wav")
+        try:
+            ssm_score, chroma_score = compare_similarity_matrices(original_wav_file, generated_wav_file, verbose=False)
+        except Exception as e:
+            ssm_score, chroma_score = None, None
+
+        metrics = {
+            "Original Genre Probabilities": self.original_genre_probs[original_midi_file_path],
+            "Generated Genre Probabilities": generated_genre_probs,
+            "SSM Similarity Score": ssm_score,
+            "Chroma Frame Similarity Score": chroma_score,
+        }
+
+        # Save the metrics as a JSON file
+        with open(os.path.join(os.path.dirname(generated_midi_file_path), "metrics.json"), "w") as f:
+            json.dump(metrics, f)
+
+        return metrics
+
 
 if __name__ == "__main__":
 
@@ -294,31 +345,14 @@ if __name__ == "__main__":
 
     if args.experiment_name == "experiment_1" or args.experiment_name == "all":
 
-        # Get the encoder max sequence length
-        encoder_max_sequence_length = configs['classifier_model']['encoder_max_sequence_length']
-
-        # Get tokenizer
-        tokenizer_filepath = os.path.join(artifact_folder, "style_transfer", "vocab_corrupted.pkl")
-        # Load the tokenizer dictionary
-        with open(tokenizer_filepath, "rb") as f:
-            tokenizer = pickle.load(f)
-
-        aria_tokenizer = AbsTokenizer()
-
-        # Load the model
-        model_path = os.path.join(artifact_folder, "style_transfer", "classifier_model")
-        model = AutoModelForSequenceClassification.from_pretrained(model_path)
-        model.eval()
-        print("Genre classifier model loaded")
+        # Load the genre classifier
+        evaluator = StyleTransferEvaluator(configs)
 
         clap_model = ClapModel.from_pretrained("laion/larger_clap_music_and_speech")
         clap_model.eval()
         processor = AutoProcessor.from_pretrained("laion/larger_clap_music_and_speech")
         print("CLAP model loaded")
 
-        # Load the dataset
-        dataset_obj = Genre_Classifier_Dataset(configs, data_list=[], mode="eval", shuffle=False)
-
         # Get file paths of the original and generated midi files from eval_folder
         all_midi_files = glob.glob(os.path.join(eval_folder, "**/*.mid"), recursive=True)
         original_midi_file_paths = [f for f in all_midi_files if "generated" not in f and "pop" not in f and "harmony" not in f and "experiment_5" not in f and "experiment_6" not in f]
@@ -335,7 +369,6 @@ if __name__ == "__main__":
 
         for original_midi_file_path in original_midi_file_paths:
             matching_generation_file_paths = [f for f in generated_midi_file_paths if os.path.join(os.path.dirname(original_midi_file_path), "experiment_") in f]
-            original_genre_probs = get_genre_probabilities(original_midi_file_path, tokenizer, model, dataset_obj, encoder_max_sequence_length, aria_tokenizer, verbose=False)
             for generated_midi_file_path in tqdm(matching_generation_file_paths):
 
                 generated_midi_folder = os.path.dirname(generated_midi_file_path)
@@ -346,19 +379,13 @@ if __name__ == "__main__":
                     print("Metrics file already exists")
                     continue
 
-                generated_genre_probs = get_genre_probabilities(generated_midi_file_path, tokenizer, model, dataset_obj, encoder_max_sequence_length, aria_tokenizer, verbose=False)
-
                 # Convert the midi files to wav
-                original_wav_file = original_midi_file_path.replace(".mid", ".wav")
                 generated_wav_file = convert_midi_to_wav([generated_midi_file_path], "/homes/kb658/fusion/artifacts/soundfont.sf", max_workers=1, verbose=False)
                 generated_wav_file = generated_wav_file[0]
                 print("Wav file created")
 
-                # Get the similarity matrices
-                try:
-                    ssm_score, chroma_score = compare_similarity_matrices(original_wav_file, generated_wav_file, verbose=False)
-                except Exception as e:
-                    ssm_score, chroma_score = None, None
+                # Get the genre probabilities and similarity matrices
+                evaluator.evaluate(original_midi_file_path, generated_midi_file_path, generated_wav_file)
                 print("Similarity matrices calculated")
 
                 # # Get the CLAP similarity scores
@@ -366,19 +393,6 @@ if __name__ == "__main__":
                 # generated_clap_score = compare_clap_similarity_score(generated_wav_file, clap_model, processor, verbose=False)
                 # print("CLAP similarity scores calculated")
 
-                metrics = {
-                    "Original Genre Probabilities": original_genre_probs,
-                    "Generated Genre Probabilities": generated_genre_probs,
-                    "SSM Similarity Score": ssm_score,
-                    "Chroma Frame Similarity Score": chroma_score,
-                    # "Original CLAP Score": original_clap_score,
-                    # "Generated CLAP Score": generated_clap_score
-                }
-
-                # Save the metrics as a JSON file
-                with open(os.path.join(generated_midi_folder, "metrics.json"), "w") as f:
-                    json.dump(metrics, f)
-
                 # Delete the generated wav file
                 os.remove(generated_wav_file)
 
@@ -0,0 +1,189 @@
+import os
+import zlib
+import time
+import queue
+import random
+import multiprocessing
+import numpy as np
+from tqdm import tqdm
+import torch
+
+from inference import load_tokenizer, load_fusion_model, get_safetensors_file
+from generation import generate
+from infill import infill
+from harmonize import harmonize
+
+
+# Job task name: function called with the worker's model and tokenizers
+JOB_FUNCTIONS = {
+    'generate': generate,
+    'infill': infill,
+    'harmonize': harmonize,
+}
+
+
+def set_seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def file_seed(midi_file_path, seed=0):
+    """
+    Seed of the jobs of one input file. It does not depend on the rest of the job, so runs of the same
+    file that share their first passes draw the same random numbers in them.
+    """
+    return (zlib.crc32(os.path.abspath(midi_file_path).encode()) + seed) % 2**32
+
+
+def run_worker(worker_id, device, configs, job_queue, result_queue, num_threads=None, mmap_weights=False):
+    """
+    Load the fusion model once on the device and run jobs from the shared queue until a None job arrives.
+    """
+    if device.startswith("cuda"):
+        torch.cuda.set_device(device)
+    if num_threads is not None:
+        # Keep workers × intra-op threads within the cores of the host, load_fusion_model pins them
+        configs = {**configs, 'inference': {**configs.get('inference', {}), 'num_threads': num_threads}}
+    tokenizer, decode_tokenizer = load_tokenizer(configs)
+    fusion_model = load_fusion_model(configs, device=device, mmap_weights=mmap_weights)
+    result_queue.put({'type': 'ready', 'worker_id': worker_id})
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        if job.get('seed') is not None:
+            set_seed(job['seed'])
+        start_time = time.perf_counter()
+        error = None
+        try:
+            # The job seed also gives every segment of the piece its own random streams
+            JOB_FUNCTIONS[job['task']](fusion_model=fusion_model, tokenizer=tokenizer, decode_tokenizer=decode_tokenizer, seed=job.get('seed'), **job['kwargs'])
+        except Exception as e:
+            error = repr(e)
+        result_queue.put({'type': 'done', 'worker_id': worker_id, 'job_index': job['job_index'], 'midi_file_path': job['kwargs']['midi_file_path'],
+                          'error': error, 'busy_time': time.perf_counter() - start_time})
+
+
+class JobScheduler:
+    """
+    Persistent worker processes that pull (file, config) jobs from one shared queue, so a long piece only
+    keeps its own worker busy instead of the files statically assigned after it.
+    Workers load the fusion model once and are reused by every call to run until close. With mmap_weights
+    CPU workers share one copy-on-write mapping of the weights, and num_threads sets the intra-op threads of each worker.
+    """
+    def __init__(self, configs, devices, processes_per_device=1, num_threads=None, mmap_weights=False):
+        if len(devices) * processes_per_device == 0:
+            raise ValueError("The scheduler needs at least one device and one process per device")
+        self.devices = devices
+        self.processes_per_device = processes_per_device
+        self.num_threads = num_threads
+        if mmap_weights and not os.path.exists(get_safetensors_file(configs)):
+            # Every worker would load its own copy, see inference.write_safetensors_file
+            print(f"No {get_safetensors_file(configs)} to map, workers load the model with from_pretrained")
+            mmap_weights = False
+        context = multiprocessing.get_context('spawn')
+        self.job_queue = context.Queue()
+        self.result_queue = context.Queue()
+        self.workers = []
+        for device in devices:
+            for _ in range(processes_per_device):
+                worker = context.Process(target=run_worker, args=(len(self.workers), device, configs, self.job_queue, self.result_queue, num_threads, mmap_weights),
+                                         daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+        # Wait for every model to be loaded so utilisation only covers the jobs
+        n_ready = 0
+        while n_ready < len(self.workers):
+            result = self.get_result()
+            n_ready += result['type'] == 'ready'
+        print(f"{len(self.workers)} workers ready on {devices}" + (f" with {num_threads} threads each" if num_threads is not None else ""))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_result(self):
+        while True:
+            try:
+                return self.result_queue.get(timeout=10)
+            except queue.Empty:
+                # A worker that died without reporting would block the run forever
+                dead_workers = [n for n, worker in enumerate(self.workers) if not worker.is_alive()]
+                if len(dead_workers) > 0:
+                    raise RuntimeError(f"Workers {dead_workers} exited unexpectedly")
+
+    def iter_results(self, jobs, manifest=None):
+        """
+        Submit the jobs, dicts with a task from JOB_FUNCTIONS, its kwargs without the model and tokenizers, an optional
+        seed and an optional experiment name, and yield their results as they finish. Jobs are taken in the given order,
+        so put the longest first. With a manifest, jobs it records as done are yielded first as skipped and the others
+        are recorded as they finish.
+        """
+        skipped = []
+        records = {}
+        for job_index, job in enumerate(jobs):
+            if manifest is not None:
+                record = manifest.get_record(job)
+                if manifest.is_done(record):
+                    skipped.append({'type': 'skipped', 'worker_id': None, 'job_index': job_index, 'midi_file_path': record['midi_file_path'],
+                                    'error': None, 'busy_time': 0.0})
+                    continue
+                records[job_index] = record
+            self.job_queue.put({**job, 'job_index': job_index})
+        if manifest is not None:
+            manifest.start(list(records.values()))
+
+        yield from skipped
+        for _ in range(len(jobs) - len(skipped)):
+            result = self.get_result()
+            if manifest is not None:
+                manifest.finish(records[result['job_index']]['job_id'], result['worker_id'], result['busy_time'], result['error'])
+            yield result
+
+    def run(self, jobs, quiet=False, manifest=None):
+        """
+        Run the jobs to completion, see iter_results. Returns one result per job in job order.
+        """
+        start_time = time.perf_counter()
+        results = [None] * len(jobs)
+        for result in tqdm(self.iter_results(jobs, manifest=manifest), total=len(jobs), disable=quiet):
+            results[result['job_index']] = result
+            if result['error'] is not None:
+                tqdm.write(f"Error in processing file: {result['midi_file_path']}")
+                tqdm.write(f"Error: {result['error']}")
+        wall_time = time.perf_counter() - start_time
+
+        n_skipped = len([result for result in results if result['type'] == 'skipped'])
+        if not quiet and n_skipped > 0:
+            print(f"Skipped {n_skipped} jobs already done in {manifest.manifest_file}")
+        if not quiet and n_skipped < len(jobs):
+            self.print_utilisation(results, wall_time)
+
+        return results
+
+    def print_utilisation(self, results, wall_time):
+        print(f"{'Worker':>6} {'Device':>8} {'Jobs':>5} {'Busy s':>8} {'Utilisation':>12}")
+        for worker_id in range(len(self.workers)):
+            busy_times = [result['busy_time'] for result in results if result['worker_id'] == worker_id]
+            device = self.devices[worker_id // self.processes_per_device]
+            print(f"{worker_id:>6} {device:>8} {len(busy_times):>5} {sum(busy_times):>8.1f} {100 * sum(busy_times) / wall_time:>11.1f}%")
+        print(f"Wall time {wall_time:.1f} s for {len([result for result in results if result['type'] == 'done'])} jobs")
+
+    def close(self):
+        for _ in self.workers:
+            self.job_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+
+def longest_first(midi_file_paths):
+    """
+    Order files by decreasing size, a cheap proxy for the number of segments to refine.
+    """
+    return sorted(midi_file_paths, key=lambda midi_file_path: os.path.getsize(midi_file_path), reverse=True)
@@ -0,0 +1,358 @@
+import yaml
+import json
+import os
+import copy
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from transformers import LogitsProcessorList
+
+from decoding import SeededSampler
+from inference import load_tokenizer, load_fusion_model, inference_context
+from generation import generate
+from infill import infill
+from harmonize import harmonize
+
+
+class BatchingModel:
+    """
+    Stand-in for the fusion model that coalesces the generate calls of concurrent jobs into shared decoder calls.
+    Jobs run in worker threads and block on generate, while a task on the event loop collects pending calls
+    with identical sampling arguments for up to max_wait_ms or max_batch_size rows and runs them as one batch.
+    Seeded calls are batched too, their SeededSampler is rebuilt from the seeds of every row of the batch.
+    Calls with precomputed encoder_outputs, as made for variations, run on their own on the thread that owns the model.
+    """
+    def __init__(self, model, loop, max_batch_size=8, max_wait_ms=10):
+        self.model = model
+        self.loop = loop
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        # A single thread owns the model so decoder calls never overlap
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = {'calls': 0, 'batches': 0, 'rows': 0}
+
+    def __getattr__(self, name):
+        # Everything other than generate goes straight to the resident model
+        return getattr(self.__dict__['model'], name)
+
+    def get_encoder(self):
+        # The encoder runs on the thread that owns the model, like every decoder call
+        encoder = self.model.get_encoder()
+
+        def run_encoder(**encoder_kwargs):
+            def encode():
+                with inference_context():
+                    return encoder(**encoder_kwargs)
+            return self.executor.submit(encode).result()
+
+        return run_encoder
+
+    def generate(self, input_ids=None, attention_mask=None, **generate_kwargs):
+        # A seeded sampler alone is carried as the seeds of its rows, calls with the same temperature and top-k share one sampler
+        seeds = None
+        logits_processor = list(generate_kwargs.get('logits_processor') or [])
+        if len(logits_processor) == 1 and isinstance(logits_processor[0], SeededSampler):
+            sampler = generate_kwargs.pop('logits_processor')[0]
+            seeds = sampler.seeds
+            generate_kwargs['sampler_settings'] = (sampler.temperature, sampler.top_k)
+        # Other logits processors and stopping criteria keep state for the rows they were built for, so those calls are never shared
+        # and encoder outputs are not padded together
+        if generate_kwargs.get('logits_processor') is not None or generate_kwargs.get('stopping_criteria') is not None or 'encoder_outputs' in generate_kwargs:
+            key = None
+        else:
+            key = tuple(sorted(generate_kwargs.items()))
+        future = asyncio.run_coroutine_threadsafe(self.submit(key, input_ids, attention_mask, generate_kwargs, seeds), self.loop)
+
+        return future.result()
+
+    async def submit(self, key, input_ids, attention_mask, generate_kwargs, seeds=None):
+        request = {'key': key, 'input_ids': input_ids, 'attention_mask': attention_mask, 'generate_kwargs': generate_kwargs,
+                   'seeds': seeds, 'time': self.loop.time(), 'future': self.loop.create_future()}
+        await self.queue.put(request)
+
+        return await request['future']
+
+    def take_batch(self, pending):
+        # The oldest request decides which calls can share its batch
+        oldest = pending[0]
+        batch, rest = [oldest], []
+        n_rows = oldest['attention_mask'].shape[0]
+        for request in pending[1:]:
+            n_request_rows = request['attention_mask'].shape[0]
+            if oldest['key'] is not None and request['key'] == oldest['key'] and n_rows + n_request_rows <= self.max_batch_size:
+                batch.append(request)
+                n_rows += n_request_rows
+            else:
+                rest.append(request)
+
+        return batch, rest, n_rows
+
+    def run_batch(self, batch):
+        generate_kwargs = dict(batch[0]['generate_kwargs'])
+        if 'sampler_settings' in generate_kwargs:
+            # One sampler for the rows of every request, each row keeps its own stream
+            temperature, top_k = generate_kwargs.pop('sampler_settings')
+            seeds = [seed for request in batch for seed in request['seeds']]
+            generate_kwargs['logits_processor'] = LogitsProcessorList([SeededSampler(seeds, temperature=temperature, top_k=top_k)])
+
+        if 'encoder_outputs' in generate_kwargs:
+            # Already encoded, the request is always alone in its batch
+            with inference_context():
+                return [self.model.generate(attention_mask=batch[0]['attention_mask'], **generate_kwargs)]
+
+        # Right pad every request to the longest encoder input of the batch
+        n_rows = sum(request['input_ids'].shape[0] for request in batch)
+        padded_length = max(request['input_ids'].shape[1] for request in batch)
+        input_ids = batch[0]['input_ids'].new_zeros((n_rows, padded_length))
+        attention_mask = batch[0]['attention_mask'].new_zeros((n_rows, padded_length))
+        row = 0
+        for request in batch:
+            n_request_rows, length = request['input_ids'].shape
+            input_ids[row:row + n_request_rows, :length] = request['input_ids']
+            attention_mask[row:row + n_request_rows, :length] = request['attention_mask']
+            row += n_request_rows
+
+        with inference_context():
+            output_tokens = self.model.generate(input_ids=input_ids, attention_mask=attention_mask, **generate_kwargs)
+
+        # Split the rows back, shorter rows are padded with 0 after <E> which decoding skips
+        outputs, row = [], 0
+        for request in batch:
+            n_request_rows = request['input_ids'].shape[0]
+            outputs.append(output_tokens[row:row + n_request_rows])
+            row += n_request_rows
+
+        return outputs
+
+    async def run(self):
+        pending = []
+        while True:
+            if len(pending) == 0:
+                pending.append(await self.queue.get())
+
+            # Wait for more calls until the oldest one has waited max_wait or its batch is full
+            while True:
+                while not self.queue.empty():
+                    pending.append(self.queue.get_nowait())
+                batch, rest, n_rows = self.take_batch(pending)
+                timeout = pending[0]['time'] + self.max_wait - self.loop.time()
+                if batch[0]['key'] is None or n_rows >= self.max_batch_size or timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            batch, pending, n_rows = self.take_batch(pending)
+            self.stats['calls'] += len(batch)
+            self.stats['batches'] += 1
+            self.stats['rows'] += n_rows
+            try:
+                outputs = await self.loop.run_in_executor(self.executor, self.run_batch, batch)
+            except Exception as error:
+                for request in batch:
+                    request['future'].set_exception(error)
+            else:
+                for request, output in zip(batch, outputs):
+                    request['future'].set_result(output)
+
+
+def run_style_transfer(request, configs, model, tokenizer, decode_tokenizer, output_folder):
+    generation_configs = configs['generation']
+    generate(request['midi_file_path'], request.get('wav_file_path'), model, configs, generation_configs['novel_peaks_pct'],
+             generation_configs['t_segment_start'], generation_configs['convert_to'], generation_configs['context_before'], generation_configs['context_after'],
+             generation_configs['passes'], tokenizer, decode_tokenizer, output_folder,
+             save_original=request.get('save_original', False), quiet=True, write_intermediate_passes=generation_configs['write_intermediate_passes'],
+             temperature=generation_configs['temperature'], end_original=generation_configs['end_original'], t_segment_stop=generation_configs['t_segment_stop'],
+             batch_size=generation_configs.get('batch_size', 1), strict_dependencies=generation_configs.get('strict_dependencies', True),
+             seed=generation_configs.get('seed'), num_variations=generation_configs.get('num_variations', 1))
+
+
+def run_infilling(request, configs, model, tokenizer, decode_tokenizer, output_folder):
+    generation_configs = configs['generation']
+    infill(request['midi_file_path'], request.get('wav_file_path'), model, configs, generation_configs['novel_peaks_pct'],
+           generation_configs['t_segment_start'], generation_configs['convert_to'], generation_configs['context_before'], generation_configs['context_after'],
+           generation_configs['context_infilling'], generation_configs['passes'], tokenizer, decode_tokenizer, output_folder,
+           save_original=request.get('save_original', False), quiet=True, write_intermediate_passes=generation_configs['write_intermediate_passes'],
+           temperature=generation_configs['temperature'], save_infilling_only=generation_configs['save_infilling_only'], seed=generation_configs.get('seed'),
+           num_variations=generation_configs.get('num_variations', 1))
+
+
+def run_harmony(request, configs, model, tokenizer, decode_tokenizer, output_folder):
+    generation_configs = configs['generation']
+    harmonize(request['midi_file_path'], request.get('wav_file_path'), model, configs, generation_configs['novel_peaks_pct'],
+              generation_configs['t_segment_start'], generation_configs['convert_to'], generation_configs['context_before'], generation_configs['context_after'],
+              generation_configs['passes'], tokenizer, decode_tokenizer, output_folder,
+              save_original=request.get('save_original', False), quiet=True, write_intermediate_passes=generation_configs['write_intermediate_passes'],
+              use_constraints=generation_configs['use_constraints'], temperature=generation_configs['temperature'], reharmonize=generation_configs['reharmonize'],
+              end_original=generation_configs['end_original'], batch_size=generation_configs.get('batch_size', 1),
+              strict_dependencies=generation_configs.get('strict_dependencies', True), seed=generation_configs.get('seed'), num_variations=generation_configs.get('num_variations', 1))
+
+
+# Task name: (default config file, job function)
+TASKS = {
+    'style_transfer': (os.path.normpath("configs/config_style_transfer.yaml"), run_style_transfer),
+    'infilling': (os.path.normpath("configs/config_infilling.yaml"), run_infilling),
+    'prompt_generation': (os.path.normpath("configs/config_prompt_generation.yaml"), run_infilling),
+    'harmony': (os.path.normpath("configs/config_harmony.yaml"), run_harmony),
+}
+
+
+class InferenceServer:
+    """
+    Keeps the fusion model resident and runs generation jobs received over a Unix socket or HTTP.
+    Unix socket clients send one JSON job per line and receive one JSON reply per line, HTTP clients POST a job to /jobs.
+    A job names a task, a midi_file_path and optionally a wav_file_path, an output_folder and generation config overrides.
+    """
+    def __init__(self, model, tokenizer, decode_tokenizer, task_configs, output_folder="output", max_batch_size=8, max_wait_ms=10, max_concurrent_jobs=8):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.decode_tokenizer = decode_tokenizer
+        self.task_configs = task_configs
+        self.output_folder = output_folder
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        # Jobs are host-bound between decoder calls, so each one gets its own thread
+        self.job_executor = ThreadPoolExecutor(max_workers=max_concurrent_jobs)
+        self.batching_model = None
+        self.n_jobs = 0
+        self.n_failed = 0
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self.batching_model = BatchingModel(self.model, loop, max_batch_size=self.max_batch_size, max_wait_ms=self.max_wait_ms)
+        return loop.create_task(self.batching_model.run())
+
+    def get_stats(self):
+        stats = {'jobs': self.n_jobs, 'failed': self.n_failed, **self.batching_model.stats}
+        stats['mean_batch_rows'] = stats['rows'] / max(stats['batches'], 1)
+        return stats
+
+    async def run_job(self, request):
+        self.n_jobs += 1
+        job_id = request.get('id', self.n_jobs)
+        task = request.get('task', 'style_transfer')
+        start_time = time.perf_counter()
+        try:
+            if task not in self.task_configs:
+                raise ValueError(f"Unknown task {task}, choose from {list(self.task_configs.keys())}")
+            if not request.get('midi_file_path'):
+                raise ValueError("The job has no midi_file_path")
+
+            # Apply the generation overrides of the job to a copy of the task configs
+            configs = copy.deepcopy(self.task_configs[task])
+            configs['generation'].update(request.get('generation', {}))
+            output_folder = request.get('output_folder', os.path.join(self.output_folder, str(job_id)))
+
+            await asyncio.get_running_loop().run_in_executor(self.job_executor, TASKS[task][1], request, configs, self.batching_model,
+                                                             self.tokenizer, self.decode_tokenizer, output_folder)
+        except Exception as error:
+            self.n_failed += 1
+            return {'id': job_id, 'status': 'error', 'error': repr(error), 'latency': time.perf_counter() - start_time}
+
+        return {'id': job_id, 'status': 'ok', 'output_folder': output_folder, 'latency': time.perf_counter() - start_time}
+
+    async def handle_socket(self, reader, writer):
+        lock = asyncio.Lock()
+
+        async def reply(request):
+            if request.get('task') == 'stats':
+                response = self.get_stats()
+            else:
+                response = await self.run_job(request)
+            async with lock:
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+
+        # Jobs of one connection run concurrently and reply as soon as they finish
+        tasks = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.strip():
+                tasks.append(asyncio.create_task(reply(json.loads(line))))
+        await asyncio.gather(*tasks)
+        writer.close()
+
+    async def handle_http(self, reader, writer):
+        request_line = (await reader.readline()).decode()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode()
+            if line in ["\r\n", "\n", ""]:
+                break
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+        method, path = request_line.split(" ")[:2] if request_line.count(" ") >= 2 else ("", "")
+        if method == "POST" and path == "/jobs":
+            response = await self.run_job(json.loads(body or b"{}"))
+            status = "200 OK" if response['status'] == 'ok' else "500 Internal Server Error"
+        elif method == "GET" and path == "/stats":
+            response, status = self.get_stats(), "200 OK"
+        else:
+            response, status = {'status': 'error', 'error': f"No route for {method} {path}"}, "404 Not Found"
+
+        payload = json.dumps(response).encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+        await writer.drain()
+        writer.close()
+
+
+async def serve(server, socket_path=None, host="127.0.0.1", port=None):
+    batcher = server.start()
+    listeners = []
+    if socket_path:
+        # Remove the socket left behind by a previous run
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        listeners.append(await asyncio.start_unix_server(server.handle_socket, path=socket_path))
+        print("Listening on", socket_path)
+    if port:
+        listeners.append(await asyncio.start_server(server.handle_http, host, port))
+        print(f"Listening on http://{host}:{port}")
+    if len(listeners) == 0:
+        raise ValueError("Set a socket path, a port or both")
+
+    await asyncio.gather(batcher, *[listener.serve_forever() for listener in listeners])
+
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default=os.path.normpath("configs/config_style_transfer.yaml"),
+                        help="Path to the config file with the model artifacts and server settings")
+    parser.add_argument("--output_folder", type=str, default="output",
+                        help="Jobs without an output_folder write to a subfolder named after the job id")
+    parser.add_argument("--socket_path", type=str, default=None,
+                        help="Unix socket to listen on, overrides the config")
+    parser.add_argument("--port", type=int, default=None,
+                        help="HTTP port to listen on, overrides the config")
+    args = parser.parse_args()
+
+    # Load config file
+    with open(args.config, 'r') as f:
+        configs = yaml.safe_load(f)
+    inference_configs = configs.get('inference', {})
+
+    # Every task keeps its own generation settings
+    task_configs = {}
+    for task, (config_file, _) in TASKS.items():
+        with open(config_file, 'r') as f:
+            task_configs[task] = yaml.safe_load(f)
+
+    tokenizer, decode_tokenizer = load_tokenizer(configs)
+    fusion_model = load_fusion_model(configs)
+    print("Fusion model loaded on", fusion_model.device)
+
+    server = InferenceServer(fusion_model, tokenizer, decode_tokenizer, task_configs, output_folder=args.output_folder,
+                             max_batch_size=inference_configs.get('max_batch_size', 8),
+                             max_wait_ms=inference_configs.get('max_wait_ms', 10),
+                             max_concurrent_jobs=inference_configs.get('max_concurrent_jobs', 8))
+    socket_path = args.socket_path or inference_configs.get('socket_path')
+    port = args.port or inference_configs.get('http_port')
+    asyncio.run(serve(server, socket_path=socket_path, host=inference_configs.get('http_host', "127.0.0.1"), port=port))
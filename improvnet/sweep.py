@@ -0,0 +1,218 @@
+import yaml
+import os
+import sys
+import time
+import glob
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from scheduler import file_seed
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+from utils.audio import save_wav
+
+
+# Keyword arguments of each task that the sweep does not set, as in the hard-coded experiments
+TASK_DEFAULTS = {
+    'generate': {'save_original': False, 'quiet': True},
+    'infill': {'save_original': True, 'quiet': False},
+    'harmonize': {'save_original': True, 'quiet': False},
+}
+# Grid and params keys that describe the corruption passes instead of being passed to the task
+PASS_KEYS = ['passes', 'corruption_type', 'corruption_rate']
+
+
+def load_sweep(sweep_file):
+    with open(sweep_file, 'r') as f:
+        spec = yaml.safe_load(f)
+    if spec['task'] not in TASK_DEFAULTS:
+        raise ValueError(f"Unknown task {spec['task']} in {sweep_file}, choose from {list(TASK_DEFAULTS.keys())}")
+    for stage in spec.get('stages', ['generate']):
+        if stage not in ['generate', 'render', 'metrics']:
+            raise ValueError(f"Unknown stage {stage} in {sweep_file}")
+    if 'metrics' in spec.get('stages', []) and spec['task'] != 'generate':
+        raise ValueError("The metrics stage scores style transfer and only applies to generate sweeps")
+    return spec
+
+
+def expand_grid(grid):
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def get_input_files(spec, eval_folder, convert_to):
+    inputs = spec['inputs']
+    midi_file_paths = sorted(glob.glob(os.path.join(eval_folder, inputs['glob'])))
+    midi_file_paths = [f for f in midi_file_paths if not any(pattern in f for pattern in inputs.get('exclude', []))]
+    # Pieces already in the target genre have it in their path
+    genre = inputs.get('genre', 'all')
+    if genre == 'target':
+        midi_file_paths = [f for f in midi_file_paths if convert_to in f]
+    elif genre == 'other':
+        midi_file_paths = [f for f in midi_file_paths if convert_to not in f]
+    return midi_file_paths
+
+
+def plan_sweep(spec, configs, seed=0):
+    """
+    Expand a sweep spec into a deduplicated job DAG. Nodes are keyed by what they write, so points of the grid
+    that produce the same output share one node. Returns a dict node_id: node, where a node has a stage
+    ('generate', 'render' or 'metrics'), the node ids it depends on and the job or file paths of its stage.
+    Pass counts that differ only in 'passes' are prefixes of one chain, which runs once and writes every
+    requested pass count from its intermediate passes.
+    """
+    eval_folder = configs["raw_data"]["eval_folder"]
+    stages = spec.get('stages', ['generate'])
+    params = spec.get('params', {})
+    nodes = {}
+
+    def add_node(node_id, node):
+        if node_id not in nodes:
+            nodes[node_id] = node
+        return node_id
+
+    # Group the grid points by everything but the number of passes
+    chains = {}
+    for point in expand_grid(spec['grid']):
+        point = {**params, **point}
+        if 'context' in point:
+            point['context_before'] = point['context_after'] = point.pop('context')
+        passes = point.pop('passes', 1)
+        chains.setdefault(tuple(sorted(point.items(), key=lambda item: item[0])), set()).add(passes)
+
+    for chain_key, requested_passes in chains.items():
+        point = dict(chain_key)
+        n_passes = max(requested_passes)
+        corruption_passes = {f'pass_{n}': {'corruption_rate': point['corruption_rate'], 'corruption_type': point['corruption_type']}
+                             for n in range(1, n_passes + 1)}
+        write_intermediate_passes = point.pop('write_intermediate_passes', False) or requested_passes
+        task_kwargs = {key: value for key, value in point.items() if key not in PASS_KEYS}
+        written_passes = range(1, n_passes + 1) if write_intermediate_passes is True else sorted(requested_passes)
+
+        for midi_file_path in get_input_files(spec, eval_folder, point['convert_to']):
+            def get_output_folder(pass_number):
+                output_folder = spec['output_folder'].format(name=spec['name'], passes=pass_number, **point)
+                return os.path.join(os.path.dirname(midi_file_path), output_folder)
+
+            output_folder = get_output_folder(n_passes)
+            generate_id = add_node(f"generate:{output_folder}", {
+                'stage': 'generate', 'deps': [],
+                'job': {'task': spec['task'], 'seed': file_seed(midi_file_path, seed), 'experiment': spec['name'],
+                        'kwargs': {**TASK_DEFAULTS[spec['task']], **task_kwargs, 'midi_file_path': midi_file_path,
+                                   'audio_file_path': midi_file_path.replace(".mid", ".wav"), 'configs': configs,
+                                   'corruption_passes': corruption_passes, 'output_folder': output_folder,
+                                   'write_intermediate_passes': write_intermediate_passes}}})
+            if 'render' not in stages:
+                continue
+
+            original_wav_id = add_node(f"render:{midi_file_path}", {'stage': 'render', 'deps': [], 'midi_file_path': midi_file_path})
+            for pass_number in written_passes:
+                generated_midi_file_path = os.path.join(get_output_folder(pass_number), "generated_" + os.path.basename(midi_file_path))
+                render_id = add_node(f"render:{generated_midi_file_path}", {'stage': 'render', 'deps': [generate_id], 'midi_file_path': generated_midi_file_path})
+                if 'metrics' in stages:
+                    add_node(f"metrics:{generated_midi_file_path}", {'stage': 'metrics', 'deps': [original_wav_id, render_id],
+                                                                     'original_midi_file_path': midi_file_path,
+                                                                     'generated_midi_file_path': generated_midi_file_path})
+
+    return nodes
+
+
+def run_sweep(nodes, scheduler, manifest=None, soundfont_path="/homes/kb658/fusion/artifacts/soundfont.sf", render_workers=6, evaluator=None, quiet=False):
+    """
+    Run a planned sweep. Generation jobs go to the scheduler's workers, and every node starts as soon as the nodes
+    it depends on finish, so rendering and metrics of finished pieces overlap with the generation of the rest.
+    A node whose dependency failed is skipped. Returns the ids of the failed and skipped nodes.
+    """
+    lock = threading.Lock()
+    all_done = threading.Event()
+    remaining_deps = {node_id: set(node['deps']) for node_id, node in nodes.items()}
+    dependents = {node_id: [] for node_id in nodes}
+    for node_id, node in nodes.items():
+        for dep in node['deps']:
+            dependents[dep].append(node_id)
+    finished, failed = set(), set()
+    progress_bar = tqdm(total=len(nodes), disable=quiet)
+    # fluidsynth runs in a subprocess, so threads are enough to render in parallel
+    render_executor = ThreadPoolExecutor(max_workers=render_workers)
+    # The genre classifier is loaded once and scores one piece at a time
+    metrics_executor = ThreadPoolExecutor(max_workers=1)
+
+    def complete(node_id, error=None):
+        ready = []
+        with lock:
+            if node_id in finished:
+                return
+            finished.add(node_id)
+            progress_bar.update(1)
+            if error is not None:
+                failed.add(node_id)
+                tqdm.write(f"Failed {node_id}: {error}")
+            for dependent in dependents[node_id]:
+                remaining_deps[dependent].discard(node_id)
+                if error is not None or (len(remaining_deps[dependent]) == 0 and not any(dep in failed for dep in nodes[dependent]['deps'])):
+                    ready.append(dependent)
+            if len(finished) == len(nodes):
+                all_done.set()
+        for dependent in ready:
+            if error is not None:
+                complete(dependent, error=f"skipped after {node_id} failed")
+            else:
+                start(dependent)
+
+    def metrics_done(node_id):
+        return os.path.exists(os.path.join(os.path.dirname(nodes[node_id]['generated_midi_file_path']), "metrics.json"))
+
+    def start(node_id):
+        node = nodes[node_id]
+        if node['stage'] == 'render':
+            # A resumed sweep does no audio work for pieces whose metrics are already written
+            metrics_ids = [dependent for dependent in dependents[node_id] if nodes[dependent]['stage'] == 'metrics']
+            if len(metrics_ids) > 0 and all(metrics_done(metrics_id) for metrics_id in metrics_ids):
+                complete(node_id)
+                return
+            wav_file_path = node['midi_file_path'].replace(".mid", ".wav")
+            # Original WAVs are shared by every generation of a piece and kept between sweeps
+            if os.path.exists(wav_file_path):
+                complete(node_id)
+                return
+            future = render_executor.submit(save_wav, node['midi_file_path'], soundfont_path)
+        elif node['stage'] == 'metrics':
+            if metrics_done(node_id):
+                complete(node_id)
+                return
+            future = metrics_executor.submit(run_metrics, evaluator, node['original_midi_file_path'], node['generated_midi_file_path'])
+        future.add_done_callback(lambda future: complete(node_id, error=repr(future.exception()) if future.exception() is not None else None))
+
+    # Nodes without dependencies besides generation start right away
+    for node_id, node in nodes.items():
+        if node['stage'] != 'generate' and len(node['deps']) == 0:
+            start(node_id)
+
+    # Long pieces go first so they do not end up in the tail
+    generate_ids = sorted([node_id for node_id, node in nodes.items() if node['stage'] == 'generate'],
+                          key=lambda node_id: os.path.getsize(nodes[node_id]['job']['kwargs']['midi_file_path']), reverse=True)
+    start_time = time.perf_counter()
+    generate_results = []
+    for result in scheduler.iter_results([nodes[node_id]['job'] for node_id in generate_ids], manifest=manifest):
+        generate_results.append(result)
+        complete(generate_ids[result['job_index']], error=result['error'])
+    if not quiet and any(result['type'] == 'done' for result in generate_results):
+        scheduler.print_utilisation(generate_results, time.perf_counter() - start_time)
+
+    if len(nodes) > 0:
+        all_done.wait()
+    render_executor.shutdown()
+    metrics_executor.shutdown()
+    progress_bar.close()
+
+    return failed
+
+
+def run_metrics(evaluator, original_midi_file_path, generated_midi_file_path):
+    generated_wav_file = generated_midi_file_path.replace(".mid", ".wav")
+    evaluator.evaluate(original_midi_file_path, generated_midi_file_path, generated_wav_file)
+    # Delete the generated wav file
+    os.remove(generated_wav_file)
@@ -0,0 +1,33 @@
+import os
+import sys
+import pytest
+
+# Modules of improvnet import each other by name and utils from the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "improvnet"))
+
+
+def build_vocab():
+    """
+    The vocab_corrupted.pkl dictionary as written by build_vocab.py.
+    """
+    vocab = {}
+    for v in [0, 15, 30, 45, 60, 75, 90, 105, 120, 127]:
+        for p in range(0, 128):
+            vocab[("piano", p, v)] = len(vocab) + 1
+    for o in range(0, 5001, 10):
+        vocab[("onset", o)] = len(vocab) + 1
+    for d in range(0, 5001, 10):
+        vocab[("dur", d)] = len(vocab) + 1
+    for token in ["classical", "pop", "jazz", "O", "D", "PVM", "mask", "pitch_velocity_mask", "onset_duration_mask", "whole_mask",
+                  "pitch_permutation", "pitch_velocity_permutation", "fragmentation", "incorrect_transposition", "skyline",
+                  "note_modification", ("prefix", "instrument", "piano"), "<T>", "<D>", "<U>", "<S>", "<E>", "SEP"]:
+        vocab[token] = len(vocab) + 1
+
+    return vocab
+
+
+@pytest.fixture
+def vocab():
+    return build_vocab()
@@ -0,0 +1,10 @@
+from codec import TokenCodec, check_round_trip
+from utils.tokens import unflatten_corrupted
+
+
+def test_round_trip(vocab):
+    check_round_trip(vocab, unflatten_corrupted, n_random=20000)
+
+
+def test_vocab_size(vocab):
+    assert TokenCodec.from_vocab(vocab).vocab_size == len(vocab) + 1
@@ -0,0 +1,9 @@
+from utils.import_check import IMPORT_BUDGET_MS, measure_token_helper_import
+
+
+def test_token_helpers_import_no_heavy_modules():
+    assert measure_token_helper_import(n_runs=1)[1] == []
+
+
+def test_token_helpers_import_within_budget():
+    assert 1000 * measure_token_helper_import()[0] <= IMPORT_BUDGET_MS
@@ -0,0 +1,129 @@
+import random
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("ariautils")
+
+from transformers import BertConfig, EncoderDecoderConfig, EncoderDecoderModel
+
+from decoding import SeededSampler
+from generation import RNG_STREAMS, segment_seed, get_segment_rng, get_decoding_seed, generate_one_pass
+
+
+def test_segment_seed_only_depends_on_its_arguments():
+    random.seed(0)
+    torch.manual_seed(0)
+    first = segment_seed(7, 1, 3, 'corruption')
+    random.seed(1)
+    torch.manual_seed(1)
+    assert segment_seed(7, 1, 3, 'corruption') == first
+    assert 0 <= first < 2**63
+
+
+def test_segment_seed_separates_streams_segments_and_passes():
+    seeds = {segment_seed(7, pass_number, t_segment_ind, stream) for pass_number in range(1, 3) for t_segment_ind in range(4) for stream in RNG_STREAMS}
+    assert len(seeds) == 2 * 4 * len(RNG_STREAMS)
+    assert segment_seed(7, 1, 3, 'decoding', variation=0) == segment_seed(7, 1, 3, 'decoding')
+    assert segment_seed(7, 1, 3, 'decoding', variation=1) != segment_seed(7, 1, 3, 'decoding')
+
+
+def test_get_segment_rng():
+    assert get_segment_rng(None, 1, 0) is random
+    random.seed(0)
+    first = [get_segment_rng(7, 1, 0).random() for _ in range(3)]
+    random.seed(1)
+    assert [get_segment_rng(7, 1, 0).random() for _ in range(3)] == first
+    assert get_segment_rng(7, 1, 0).random() != get_segment_rng(7, 1, 1).random()
+    assert get_decoding_seed(None, 1, 0) is None
+
+
+def sample(sampler, scores, n_steps):
+    """
+    Tokens chosen greedily from the perturbed scores of n_steps decoding steps that start with the <S> token.
+    """
+    input_ids = torch.zeros((scores.shape[0], 1), dtype=torch.long)
+    for _ in range(n_steps):
+        tokens = sampler(input_ids, scores).argmax(dim=-1, keepdim=True)
+        input_ids = torch.cat([input_ids, tokens], dim=-1)
+    return input_ids[:, 1:]
+
+
+def test_seeded_sampler_rows_are_independent():
+    torch.manual_seed(0)
+    scores = torch.randn(3, 100)
+    batched = sample(SeededSampler([11, 12, 13], top_k=20), scores, 8)
+    for row, seed in enumerate([11, 12, 13]):
+        torch.manual_seed(row + 1)
+        assert torch.equal(sample(SeededSampler([seed], top_k=20), scores[row:row + 1], 8)[0], batched[row])
+    # Another neighbour leaves the row unchanged
+    assert torch.equal(sample(SeededSampler([11, 99], top_k=20), scores[:2], 8)[0], batched[0])
+
+
+def test_seeded_sampler_restarts_with_every_generation():
+    scores = torch.randn(2, 100)
+    sampler = SeededSampler([11, 12], top_k=20)
+    assert torch.equal(sample(sampler, scores, 8), sample(sampler, scores, 8))
+
+
+def build_fusion_model(tokenizer, encoder_max_sequence_length, decoder_max_sequence_length):
+    """
+    Randomly initialised fusion model with the architecture of train.py, a layer each and a small hidden size.
+    """
+    def bert_config(max_sequence_length, **kwargs):
+        return BertConfig(vocab_size=len(tokenizer) + 1, max_position_embeddings=max_sequence_length, pad_token_id=0, bos_token_id=tokenizer["<S>"],
+                          eos_token_id=tokenizer["<E>"], num_hidden_layers=1, num_attention_heads=2, hidden_size=32, intermediate_size=64, **kwargs)
+    config = EncoderDecoderConfig.from_encoder_decoder_configs(bert_config(encoder_max_sequence_length),
+                                                               bert_config(decoder_max_sequence_length, is_decoder=True, add_cross_attention=True))
+    config.decoder_start_token_id = tokenizer["<S>"]
+    config.pad_token_id = 0
+    torch.manual_seed(0)
+    return EncoderDecoderModel(config=config).eval()
+
+
+def build_piece(n_segments=12, n_notes=4):
+    """
+    Flattened piece of n_segments 5 second segments of n_notes notes each, as generate tokenizes a MIDI file.
+    """
+    rng = random.Random(0)
+    sequence = []
+    for t in range(n_segments):
+        if t > 0:
+            sequence.append("<T>")
+        for onset in sorted(rng.randrange(0, 5000, 10) for _ in range(n_notes)):
+            sequence.append([rng.randint(40, 90), rng.choice([45, 60, 75, 90]), onset, rng.randrange(10, 1000, 10)])
+    return sequence
+
+
+@pytest.mark.parametrize("context_before, corruption_rate", [(0, 1.0), (2, 0.6)])
+def test_seeded_pass_is_the_same_sequential_and_batched(vocab, context_before, corruption_rate):
+    configs = {'model': {'encoder_max_sequence_length': 512, 'decoder_max_sequence_length': 32}, 'inference': {}}
+    model = build_fusion_model(vocab, 512, 32)
+    decode_tokenizer = {v: k for k, v in vocab.items()}
+    generate_calls = []
+    model_generate = model.generate
+
+    def generate(*args, **kwargs):
+        generate_calls.append(kwargs['input_ids'].shape[0])
+        return model_generate(*args, **kwargs)
+    model.generate = generate
+
+    outputs = {}
+    for global_seed, batch_size in enumerate([1, 4]):
+        # A seeded pass never draws from the global streams
+        random.seed(global_seed)
+        torch.manual_seed(global_seed)
+        generate_calls.clear()
+        outputs[batch_size] = generate_one_pass([build_piece()], model, configs, t_segment_start=0, convert_to="jazz", context_before=context_before,
+                                                context_after=2, corruption_type="pitch_velocity_mask", corruption_rate=corruption_rate,
+                                                tokenizer=vocab, decode_tokenizer=decode_tokenizer, quiet=True, batch_size=batch_size,
+                                                strict_dependencies=True, seed=7, pass_number=1)
+        if batch_size == 1:
+            assert len(generate_calls) > 0 and set(generate_calls) == {1}
+
+    if context_before == 0:
+        # Without earlier context every group is full
+        assert max(generate_calls) == 4
+    assert outputs[4] == outputs[1]
+    assert outputs[1] != [build_piece()]
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("ariautils")
+
+import server
+from decoding import SeededSampler
+from transformers import LogitsProcessorList
+
+
+class StubModel:
+    """
+    Fusion model stand-in that echoes its encoder inputs and records the calls and the threads they ran on.
+    """
+    device = torch.device("cpu")
+
+    def __init__(self):
+        self.calls = []
+        self.threads = []
+
+    def get_encoder(self):
+        def encoder(input_ids, attention_mask, return_dict=True):
+            self.threads.append(threading.current_thread())
+            return SimpleNamespace(last_hidden_state=input_ids.unsqueeze(-1).float())
+        return encoder
+
+    def generate(self, input_ids=None, attention_mask=None, encoder_outputs=None, **generate_kwargs):
+        self.threads.append(threading.current_thread())
+        self.calls.append({'input_ids': input_ids, 'encoder_outputs': encoder_outputs, **generate_kwargs})
+        if encoder_outputs is not None:
+            return encoder_outputs.last_hidden_state[:, :, 0].long()
+        return input_ids.clone()
+
+
+@pytest.fixture
+def batching_model():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    model = server.BatchingModel(StubModel(), loop, max_batch_size=8, max_wait_ms=200)
+    asyncio.run_coroutine_threadsafe(model.run(), loop)
+    yield model
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+def run_concurrently(*calls):
+    results = [None] * len(calls)
+
+    def run(n):
+        results[n] = calls[n]()
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(len(calls))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_seeded_calls_share_one_sampler(batching_model):
+    def seeded_call(input_ids, seeds):
+        return lambda: batching_model.generate(input_ids=input_ids, attention_mask=input_ids != 0, do_sample=False,
+                                               logits_processor=LogitsProcessorList([SeededSampler(seeds, temperature=0.9, top_k=50)]))
+    first, second = torch.tensor([[1, 2, 3]]), torch.tensor([[4, 5, 0, 0], [6, 7, 8, 9]])
+    outputs = run_concurrently(seeded_call(first, [11]), seeded_call(second, [12, 13]))
+
+    assert batching_model.stats['batches'] == 1
+    (call,) = batching_model.model.calls
+    sampler = call['logits_processor'][0]
+    assert sorted(sampler.seeds) == [11, 12, 13]
+    assert (sampler.temperature, sampler.top_k) == (0.9, 50)
+    # Every request gets its own rows back, in the order of the sampler seeds
+    rows = {seed: row for seed, row in zip(sampler.seeds, call['input_ids'].tolist())}
+    assert outputs[0].tolist() == [rows[11]]
+    assert outputs[1].tolist() == [rows[12], rows[13]]
+    assert rows[12][:4] == [4, 5, 0, 0] and rows[13][:4] == [6, 7, 8, 9]
+
+
+def test_encoder_outputs_run_on_the_model_thread(batching_model):
+    input_ids = torch.tensor([[1, 2, 3], [4, 5, 6]])
+    encoder_outputs = batching_model.get_encoder()(input_ids=input_ids, attention_mask=input_ids != 0, return_dict=True)
+    encoder_outputs.last_hidden_state = encoder_outputs.last_hidden_state.repeat_interleave(2, dim=0)
+    output = batching_model.generate(encoder_outputs=encoder_outputs, attention_mask=(input_ids != 0).repeat_interleave(2, dim=0), do_sample=True)
+
+    assert output.tolist() == input_ids.repeat_interleave(2, dim=0).tolist()
+    threads = batching_model.model.threads
+    assert len(threads) == 2 and threads[0] is threads[1] and threads[0] is not threading.current_thread()
+
+
+@pytest.mark.parametrize("task", ['style_transfer', 'infilling', 'harmony'])
+def test_jobs_forward_num_variations(monkeypatch, task):
+    calls = []
+    for name in ['generate', 'infill', 'harmonize']:
+        monkeypatch.setattr(server, name, lambda *args, **kwargs: calls.append(kwargs))
+    generation_configs = {'novel_peaks_pct': 0, 't_segment_start': 0, 'convert_to': 'jazz', 'context_before': 5, 'context_after': 5,
+                          'context_infilling': 5, 'passes': {}, 'write_intermediate_passes': False, 'temperature': 1.0, 'end_original': True,
+                          't_segment_stop': -1, 'save_infilling_only': False, 'use_constraints': True, 'reharmonize': False, 'num_variations': 4}
+    server.TASKS[task][1]({'midi_file_path': "piece.mid"}, {'generation': generation_configs}, None, {}, {}, "output")
+
+    assert calls[0]['num_variations'] == 4
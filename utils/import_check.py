@@ -0,0 +1,38 @@
+import os
+import sys
+import json
+import subprocess
+
+
+# Modules a token helper import must not pull in
+HEAVY_MODULES = ['torch', 'transformers', 'pandas', 'miditoolkit', 'music21', 'ssmnet', 'librosa']
+# Run in a fresh interpreter: the import time of a token helper and the heavy modules it loaded
+IMPORTS_SCRIPT = """
+import sys
+import json
+import time
+sys.path.insert(0, sys.argv[1])
+start_time = time.perf_counter()
+from utils.utils import flatten
+import_time = time.perf_counter() - start_time
+print(json.dumps({'import_time': import_time, 'heavy_modules': [name for name in json.loads(sys.argv[2]) if name in sys.modules]}))
+"""
+# Import time budget of the token helpers in milliseconds
+IMPORT_BUDGET_MS = 100
+
+
+def measure_token_helper_import(n_runs=5):
+    """
+    Import time of `from utils.utils import flatten` in a fresh interpreter, the best of n_runs, and the HEAVY_MODULES
+    loaded by any run. Only needs the standard library, so it can guard the import time without the model stack.
+    """
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for _ in range(n_runs):
+        result = subprocess.run([sys.executable, "-c", IMPORTS_SCRIPT, repo_root, json.dumps(HEAVY_MODULES)],
+                                capture_output=True, text=True, check=True)
+        results.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    import_time = min(result['import_time'] for result in results)
+    heavy_modules = sorted({name for result in results for name in result['heavy_modules']})
+
+    return import_time, heavy_modules
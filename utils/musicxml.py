@@ -0,0 +1,60 @@
+from music21 import converter, instrument, stream, note
+
+
+def xml_to_monophonic_midi(musicxml_file, midi_output_file):
+    # Load the MusicXML file
+    score = converter.parse(musicxml_file)
+
+    # Assuming the monophonic melody is in the first part (usually in leadsheets)
+    # You may need to adjust if the monophonic part is in a different part
+    melody_part = score.parts[0]
+
+    # Filter out any chord symbols (only keeping monophonic notes)
+    melody_notes = stream.Stream()
+    # Iterate through elements and only add individual notes, ignoring chords and other elements
+    for elem in melody_part.flat.notesAndRests:  # 'flat' allows for easier access to all notes/rests
+        if isinstance(elem, note.Note):  # Add only individual notes, no chords
+            melody_notes.append(elem)
+        elif isinstance(elem, note.Rest):  # If you want to keep rests in the melody
+            melody_notes.append(elem)
+
+    # Set the instrument to Piano
+    piano_instrument = instrument.Piano()
+    melody_notes.insert(0, piano_instrument)
+
+    # Save the melody as a MIDI file
+    melody_notes.write('midi', midi_output_file)
+
+    print(f"Monophonic melody saved as {midi_output_file}")
+
+
+def xml_to_midi(musicxml_file, midi_output_file):
+    # Load the MusicXML file
+    score = converter.parse(musicxml_file)
+
+    # Print the part names (optional, for debugging)
+    print(f"Loaded parts: {[p.partName for p in score.parts]}")
+
+    # Create a new stream to hold all converted parts
+    piano_score = stream.Stream()
+
+    # Loop through each part in the score
+    for part in score.parts:
+        # Create a new stream for the piano part
+        piano_part = stream.Part()
+        
+        # Set the instrument to piano (MIDI program number for acoustic piano is 0)
+        piano_instrument = instrument.Piano()
+        piano_part.insert(0, piano_instrument)
+        
+        # Add all the notes and rests from the original part to the new piano part
+        for elem in part.flat.notesAndRests:
+            piano_part.append(elem)
+        
+        # Append the piano part to the new score
+        piano_score.append(piano_part)
+
+    # Save the entire score as a MIDI file
+    piano_score.write('midi', midi_output_file)
+
+    print(f"All tracks saved as piano MIDI in {midi_output_file}")
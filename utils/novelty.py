@@ -0,0 +1,217 @@
+import os
+import hashlib
+import yaml
+import numpy as np
+
+
+# SsmNet models shared by all Segment_Novelty objects of a process, keyed by the hash of the config file contents
+_SSMNET_MODELS = {}
+
+def get_ssmnet(config_file):
+    with open(config_file, "rb") as fid:
+        config_bytes = fid.read()
+    config_hash = hashlib.sha256(config_bytes).hexdigest()
+    if config_hash not in _SSMNET_MODELS:
+        # Imported here, ssmnet is only needed for the novelty of WAV files
+        from ssmnet.core import SsmNetDeploy
+        _SSMNET_MODELS[config_hash] = SsmNetDeploy(yaml.safe_load(config_bytes))
+    return _SSMNET_MODELS[config_hash], config_hash
+
+def hash_file(file_path, chunk_size=1 << 20):
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as fid:
+        for chunk in iter(lambda: fid.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+class Segment_Novelty:
+    def __init__(self, config_file, audio_file, cache_folder=None):
+
+        self.ssmnet, self.config_hash = get_ssmnet(config_file)
+        self.audio_file = audio_file
+        # Folder of the on-disk novelty analysis cache, None disables it
+        self.cache_folder = cache_folder
+
+    def m_get_features(self, audio_file):
+        return self.ssmnet.m_get_features(audio_file)
+
+    def m_get_ssm_novelty(self, feat_3m):
+        return self.ssmnet.m_get_ssm_novelty(feat_3m)
+
+    def m_get_boundaries(self, hat_novelty_np, time_sec_v):
+        return self.ssmnet.m_get_boundaries(hat_novelty_np, time_sec_v)
+
+    def m_plot(self, hat_ssm_np, hat_novelty_np, hat_boundary_frame_v, output_pdf_file):
+        return self.ssmnet.m_plot(hat_ssm_np, hat_novelty_np, hat_boundary_frame_v, output_pdf_file)
+
+    def m_export_csv(self, hat_boundary_sec_v, output_csv_file):
+        return self.ssmnet.m_export_csv(hat_boundary_sec_v, output_csv_file)
+    
+    def max_items(self, values, indices, n):
+        sorted_items = np.argsort(values)[::-1]
+        top_items = sorted_items[:n]
+        return indices[top_items]
+    
+    def find_novelty_timestamps(self, top_peak_indices, timestampsarray):
+        return timestampsarray[top_peak_indices]
+    
+    def locate_peak_timestamps(self, indices, values, n_peaks, time_sec_v=None):
+        top_novelty_indices = self.max_items(values, indices, n_peaks)
+        if time_sec_v is None:
+            _, time_sec_v = self.m_get_features(self.audio_file)
+        timestamps = self.find_novelty_timestamps(top_novelty_indices, time_sec_v)
+        sorted_timestamps = np.sort(timestamps)
+        return sorted_timestamps
+
+    def get_novelty_analysis(self, audio_file):
+        """
+        Features, novelty curve and boundaries of an audio file, computed once and cached on disk
+        under the hash of the audio file and the SsmNet config contents.
+        """
+        cache_file = None
+        if self.cache_folder is not None:
+            cache_key = hashlib.sha256((hash_file(audio_file) + self.config_hash).encode()).hexdigest()
+            cache_file = os.path.join(self.cache_folder, cache_key + ".npz")
+            if os.path.exists(cache_file):
+                with np.load(cache_file) as cached:
+                    return {key: cached[key] for key in cached.files}
+
+        feat_3m, time_sec_v = self.m_get_features(audio_file)
+        hat_ssm_np, hat_novelty_np = self.m_get_ssm_novelty(feat_3m)
+        _, hat_boundary_frame_v = self.m_get_boundaries(hat_novelty_np, time_sec_v)
+        analysis = {
+            'feat_3m': np.asarray(feat_3m),
+            'time_sec_v': np.asarray(time_sec_v),
+            'hat_ssm_np': np.asarray(hat_ssm_np),
+            'hat_novelty_np': np.asarray(hat_novelty_np),
+            'hat_boundary_frame_v': np.asarray(hat_boundary_frame_v),
+        }
+
+        if cache_file is not None:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            # Write to a temporary file first so concurrent workers never read a partial file
+            tmp_file = cache_file + f".{os.getpid()}.tmp"
+            with open(tmp_file, "wb") as fid:
+                np.savez(fid, **analysis)
+            os.replace(tmp_file, cache_file)
+
+        return analysis
+
+    def get_peak_timestamps(self, audio_file, n_peaks):
+        analysis = self.get_novelty_analysis(audio_file)
+        hat_novelty_np, hat_boundary_frame_v = analysis['hat_novelty_np'], analysis['hat_boundary_frame_v']
+        all_novelty_values = hat_novelty_np[hat_boundary_frame_v]
+        return self.locate_peak_timestamps(hat_boundary_frame_v, all_novelty_values, n_peaks, time_sec_v=analysis['time_sec_v'])
+
+
+
+class Symbolic_Novelty:
+    """
+    Novelty based segmentation computed from the MIDI notes instead of rendered audio: a smoothed chroma
+    self-similarity matrix, a Gaussian checkerboard kernel along its diagonal and peak picking with the
+    kernel and postprocessing parameters of the SsmNet config.
+    """
+    def __init__(self, config_file):
+
+        with open(config_file, "r", encoding="utf-8") as fid:
+            config_d = yaml.safe_load(fid)
+
+        self.step_sec = config_d['features']['step_target_sec']
+        self.feature_halfduration_frame = config_d['features']['patch_halfduration_frame']
+        # Novelty is computed on frames taken every patch_hop_frame steps, as SsmNet does
+        self.patch_hop_frame = config_d['features']['patch_hop_frame']
+        self.frame_sec = self.step_sec * self.patch_hop_frame
+        self.kernel_halfduration_frame = max(int(round(config_d['model']['kernel_Ldemi_sec'] / self.frame_sec)), 1)
+        self.kernel_sigma_frame = config_d['model']['kernel_sigma_sec'] / self.frame_sec
+        self.peak_mean_halfduration_frame = int(round(config_d['postprocessing']['peak_mean_Ldemi_sec'] / self.frame_sec))
+        self.peak_distance_frame = max(int(round(config_d['postprocessing']['peak_distance_sec'] / self.frame_sec)), 1)
+        self.peak_threshold = config_d['postprocessing']['peak_threshold']
+
+    @staticmethod
+    def moving_average(values, halfduration, axis=-1):
+        padded = np.pad(values, [(0, 0)] * (values.ndim - 1) + [(halfduration, halfduration)], mode="edge")
+        cumsum = np.cumsum(np.insert(padded, 0, 0, axis=axis), axis=axis)
+        return (cumsum[..., 2 * halfduration + 1:] - cumsum[..., :-2 * halfduration - 1]) / (2 * halfduration + 1)
+
+    def get_features(self, midi_data):
+        chroma = midi_data.get_chroma(fs=1 / self.step_sec)
+        # Smooth over the SsmNet patch duration so frames describe the local harmony rather than single onsets
+        features = self.moving_average(chroma.astype(np.float32), self.feature_halfduration_frame)[:, ::self.patch_hop_frame]
+        features /= np.linalg.norm(features, axis=0, keepdims=True) + 1e-8
+        time_sec_v = np.arange(features.shape[1]) * self.frame_sec
+        return features, time_sec_v
+
+    def get_checkerboard_kernel(self):
+        positions = np.arange(-self.kernel_halfduration_frame, self.kernel_halfduration_frame) + 0.5
+        gaussian = np.exp(-0.5 * (positions / self.kernel_sigma_frame) ** 2)
+        return (np.outer(np.sign(positions), np.sign(positions)) * np.outer(gaussian, gaussian)).astype(np.float32)
+
+    def get_ssm_novelty(self, features):
+        ssm = features.T @ features
+        kernel = self.get_checkerboard_kernel()
+        width = len(kernel)
+        # Edge padding so the start and end of the piece do not look like boundaries
+        padded = np.pad(ssm, self.kernel_halfduration_frame, mode="edge")
+        novelty = np.array([np.sum(kernel * padded[t:t + width, t:t + width]) for t in range(ssm.shape[0])])
+        novelty = np.maximum(novelty, 0)
+        if novelty.max() > 0:
+            novelty /= novelty.max()
+        return ssm, novelty
+
+    def get_boundaries(self, novelty):
+        # Peaks are local maxima within peak_distance and above peak_threshold times the local mean
+        padded = np.pad(novelty, self.peak_distance_frame, constant_values=-np.inf)
+        local_max = np.lib.stride_tricks.sliding_window_view(padded, 2 * self.peak_distance_frame + 1).max(axis=1)
+        local_mean = self.moving_average(novelty, self.peak_mean_halfduration_frame)
+        return np.flatnonzero((novelty == local_max) & (novelty > self.peak_threshold * local_mean) & (novelty > 0))
+
+    def get_peak_timestamps(self, midi_data, n_peaks):
+        features, time_sec_v = self.get_features(midi_data)
+        _, novelty = self.get_ssm_novelty(features)
+        boundary_frames = self.get_boundaries(novelty)
+        top_novelty_indices = boundary_frames[np.argsort(novelty[boundary_frames])[::-1][:n_peaks]]
+        return np.sort(time_sec_v[top_novelty_indices])
+
+
+
+def ticks_to_times(midi_data, ticks):
+    """
+    Convert an array of ticks to seconds with the tempo map of a PrettyMIDI object, giving the same
+    values as PrettyMIDI.tick_to_time without building its per-tick lookup array.
+    """
+    ticks = np.asarray(ticks, dtype=np.int64)
+    scale_ticks = np.array([tick for tick, _ in midi_data._tick_scales], dtype=np.int64)
+    scales = np.array([scale for _, scale in midi_data._tick_scales])
+    # Time of each tempo change, accumulated like PrettyMIDI does
+    change_times = np.concatenate([[0.], np.cumsum(scales[:-1] * np.diff(scale_ticks))])
+    scale_idx = np.maximum(np.searchsorted(scale_ticks, ticks, side='right') - 1, 0)
+    return change_times[scale_idx] + scales[scale_idx] * (ticks - scale_ticks[scale_idx])
+
+def get_midi_notes_from_tick(midi_dict, midi_data, peak_times, quiet):
+    """
+    For each sorted peak time, the first note after the previously selected note that starts later than the peak.
+    """
+    note_msgs = midi_dict.note_msgs
+    peak_times = np.sort(np.asarray(peak_times, dtype=float))
+    if len(note_msgs) == 0 or len(peak_times) == 0:
+        return [], []
+
+    note_times = ticks_to_times(midi_data, [note['tick'] for note in note_msgs])
+    # Running maximum keeps the search valid if note messages are not strictly in tick order
+    first_notes = np.searchsorted(np.maximum.accumulate(note_times), peak_times, side='right')
+
+    novel_note_numbers = []
+    novel_notes = []
+    previous = -1
+    for n in first_notes.tolist():
+        # Every peak takes a different note, later than the note of the previous peak
+        n = max(n, previous + 1)
+        if n >= len(note_msgs):
+            break
+        if not quiet:
+            print(f"Note {n} is at {note_times[n]} seconds")
+        novel_note_numbers.append(n)
+        novel_notes.append(note_msgs[n])
+        previous = n
+
+    return novel_note_numbers, novel_notes